@@ -1,74 +1,353 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
+from google.genai import errors as genai_errors
 import os
-import base64
+import time
+import asyncio
+import httpx
 from structure import EstimationResponse
+from ai.llm_cache import llm_cache
+from ai.attachments import PreparedAttachments
+from ai.resilience import resilient_call
+from ai.context_cache import (CONTEXT_CACHE_ENABLED, prompt_layout, prompt_cache_key, cached_ratio,
+                              gemini_context_cache, context_cache_stats)
+from ai.fake_llm import fake_provider
+from ai.metrics import metrics, estimate_cost
 
 load_dotenv(override=True)
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-gemini_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-
-
-# Call OpenAI
-async def openai_call(system_prompt, user_prompt,file_list=[], output_structure = EstimationResponse, model="gpt-4.1"):
-
-    # 1. Standard messages
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-
-    # 2. Add each file as a separate entry
-    if file_list:
-        for file_obj in file_list:
-            # Encode bytes to base64 string
-            b64_string = base64.b64encode(file_obj['data']).decode('utf-8')
-
-            # Assuming your wrapper supports this custom role/format:
-            messages.append({
-                "role": "user", 
-                "content": [
-                    {
-                        "type": "input_file",
-                        "filename": file_obj['name'],
-                        "file_data": f"data:application/pdf;base64,{b64_string}"
-                    }
-                ],
-            })
-
-    response = openai_client.responses.parse( # or beta.chat.completions.parse
+
+# Connection pool settings shared by both providers
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "32"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_WARMUP_TIMEOUT = float(os.getenv("LLM_WARMUP_TIMEOUT", "10"))
+
+# Per provider timeouts (seconds)
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "600"))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", "600"))
+
+# "fake" answers every call locally (ai.fake_llm), for offline runs and checks
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "")
+
+# Spooled files bigger than this are streamed from disk to the Gemini file store
+# instead of being sent inline (inline data has to be copied out of the memory map)
+GEMINI_INLINE_MAX_BYTES = int(os.getenv("GEMINI_INLINE_MAX_BYTES", str(8 * 1024 * 1024)))
+# Files bigger than this go to the OpenAI file store instead of an inline data URL
+# (the base64 string would hold about 1.33x the file size in memory)
+OPENAI_INLINE_MAX_BYTES = int(os.getenv("OPENAI_INLINE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+
+# Keep-alive connection pool for one provider
+def _build_http_client(connect_timeout, read_timeout):
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+openai_http_client = _build_http_client(OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT)
+gemini_http_client = _build_http_client(GEMINI_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT)
+
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=openai_http_client,
+    timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    max_retries=0,  # retries are handled by ai.resilience
+)
+gemini_client = genai.Client(
+    api_key=os.getenv("GOOGLE_API_KEY"),
+    http_options=types.HttpOptions(
+        timeout=int(GEMINI_READ_TIMEOUT * 1000),  # milliseconds
+        httpx_async_client=gemini_http_client,
+    ),
+)
+
+
+# Open the TLS connections up front so the first request does not pay for them
+async def warmup_clients():
+    if LLM_PROVIDER == "fake":
+        return
+
+    async def warm_openai():
+        await openai_client.models.list()
+
+    async def warm_gemini():
+        await gemini_client.aio.models.list(config={"page_size": 1})
+
+    results = await asyncio.gather(
+        asyncio.wait_for(warm_openai(), LLM_WARMUP_TIMEOUT),
+        asyncio.wait_for(warm_gemini(), LLM_WARMUP_TIMEOUT),
+        return_exceptions=True,
+    )
+    for provider, result in zip(["openai", "gemini"], results):
+        if isinstance(result, BaseException):
+            print(f"Warmup failed for {provider}: {result!r}")
+        else:
+            print(f"Warmed up {provider} connections...")
+
+
+# OpenAI file store used by the "upload" attachment mode
+class OpenAIFileStore:
+
+    async def upload(self, prepared_file):
+        with prepared_file.open() as fh:
+            uploaded = await openai_client.files.create(
+                file=(prepared_file.name, fh, prepared_file.mime or "application/pdf"),
+                purpose="user_data",
+            )
+        return uploaded.id
+
+    async def delete(self, ref):
+        await openai_client.files.delete(ref)
+
+
+# Gemini file store used by the "upload" attachment mode
+class GeminiFileStore:
+
+    async def upload(self, prepared_file):
+        with prepared_file.open() as fh:
+            uploaded = await gemini_client.aio.files.upload(
+                file=fh,
+                config={"mime_type": "application/pdf", "display_name": prepared_file.name},
+            )
+        return uploaded.uri
+
+    async def delete(self, ref):
+        await gemini_client.aio.files.delete(name="files/" + ref.rsplit("/", 1)[-1])
+
+
+openai_file_store = OpenAIFileStore()
+gemini_file_store = GeminiFileStore()
+
+
+# Release the pooled connections (and the Gemini context caches) on shutdown
+async def close_clients():
+    for name in gemini_context_cache.drain():
+        try:
+            await gemini_client.aio.caches.delete(name=name)
+        except Exception as e:
+            print(f"Failed to delete Gemini context cache {name}: {e!r}")
+    await openai_client.close()
+    await gemini_client.aio.aclose()
+    await gemini_http_client.aclose()
+
+
+# Token usage of one call: kept in the per-model counters and /metrics, printed,
+# and handed to the caller's `usage` callback (e.g. PipelineContext.usage_recorder)
+def _report_usage(provider, model, tokens, started, usage = None, context_cache = None, cached_response = False):
+    latency = time.perf_counter() - started
+    if cached_response:
+        metrics.inc("llm_cached_responses_total", provider=provider, model=model)
+    else:
+        context_cache_stats.record(provider, model, tokens["input_tokens"], tokens["cached_tokens"], tokens["output_tokens"])
+        metrics.record_llm_call(provider, model, tokens, latency)
+        print(f"{provider}:{model} used {tokens['input_tokens']} input tokens "
+              f"({cached_ratio(tokens['input_tokens'], tokens['cached_tokens']):.0%} cached)")
+    if usage is not None:
+        usage({
+            "provider": provider,
+            "model": model,
+            **tokens,
+            "cached_ratio": cached_ratio(tokens["input_tokens"], tokens["cached_tokens"]),
+            "cost_usd": estimate_cost(model, tokens["input_tokens"], tokens["cached_tokens"], tokens["output_tokens"]),
+            "latency": round(latency, 3),
+            "context_cache": context_cache,
+            "cached_response": cached_response,
+        })
+
+
+NO_TOKENS = {"input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+
+# Prompt in send order for the fake provider
+def _segments(prefix, attachments, request_context, user_prompt):
+    segments = [("file", file_obj) for file_obj in attachments]
+    segments += [("text", text) for text in (prefix, request_context, user_prompt) if text]
+    return segments
+
+
+# Call OpenAI. The files go first, then `static_prompt` (the constant stage
+# instructions), then the rest of the system prompt and the user prompt, so the
+# long shared prefix is served from OpenAI's prompt cache on the later calls and stages.
+async def openai_call(system_prompt, user_prompt,file_list=[], output_structure = EstimationResponse, model="gpt-4.1", use_cache=True,
+                      static_prompt=None, usage=None):
+    started = time.perf_counter()
+
+    # Files are encoded (or uploaded) once per request and shared by every call
+    attachments = PreparedAttachments.from_uploads(file_list)
+    prefix, request_context = prompt_layout(system_prompt, static_prompt)
+
+    # 0. Serve repeated requests from the cache (use_cache=False skips the lookup but refreshes the entry)
+    cache_key = llm_cache.make_key("openai", model, prefix + (request_context or ""), user_prompt, attachments.digests, output_structure)
+    if use_cache:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            _report_usage("openai", model, NO_TOKENS, started, usage, cached_response=True)
+            return cached
+
+    if LLM_PROVIDER == "fake":
+        result, tokens = await fake_provider.call(f"openai:{model}", _segments(prefix, attachments, request_context, user_prompt), output_structure)
+        _report_usage("openai", model, tokens, started, usage, context_cache="fake")
+        await llm_cache.set(cache_key, result)
+        return result
+
+    # 1. Add each file as a separate entry
+    messages = []
+    if attachments.upload:
+        await attachments.ensure_uploaded("openai", openai_file_store)
+    else:
+        large = [f for f in attachments if f.size > OPENAI_INLINE_MAX_BYTES]
+        if large:
+            await attachments.ensure_uploaded("openai", openai_file_store, files=large)
+        await attachments.encode_inline("openai")
+    for file_obj in attachments:
+        if "openai" in file_obj.remote_refs:
+            # Reference to the copy in the OpenAI file store
+            file_content = {"type": "input_file", "file_id": file_obj.remote_refs["openai"]}
+        else:
+            # Inline base64 (small files only, encoded once per file)
+            file_content = {"type": "input_file", "filename": file_obj.name, "file_data": file_obj.data_url}
+        messages.append({"role": "user", "content": [file_content]})
+
+    # 2. Constant instructions, then the per request parts
+    messages.append({"role": "system", "content": prefix})
+    if request_context:
+        messages.append({"role": "system", "content": request_context})
+    messages.append({"role": "user", "content": user_prompt})
+
+    # Same prefix -> same prompt cache key, so the calls are routed to the same cache
+    extra = {"prompt_cache_key": prompt_cache_key(prefix, attachments.digests)} if CONTEXT_CACHE_ENABLED else {}
+
+    # 3. Call with retries behind the model's circuit breaker
+    response = await resilient_call(f"openai:{model}", lambda: openai_client.responses.parse( # or beta.chat.completions.parse
         model=model,
         input=messages, # Pass the list containing multiple file entries
         text_format=output_structure,
+        **extra,
+    ))
+
+    usage_info = response.usage
+    details = getattr(usage_info, "input_tokens_details", None)
+    tokens = {
+        "input_tokens": getattr(usage_info, "input_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        "output_tokens": getattr(usage_info, "output_tokens", 0) or 0,
+    }
+    _report_usage("openai", model, tokens, started, usage, context_cache="prompt_cache_key" if extra else None)
+
+    result = response.output_parsed.model_dump()
+    await llm_cache.set(cache_key, result)
+    return result
+
+# Gemini part for one prepared file. The SDK only accepts `bytes` for inline data,
+# so a spooled file is copied out of its memory map here (small files only, see
+# GEMINI_INLINE_MAX_BYTES); the OpenAI data URL is encoded straight from the map.
+def _gemini_part(file_obj):
+    file_uri = file_obj.remote_refs.get("gemini")
+    if file_uri is not None:
+        return types.Part.from_uri(file_uri=file_uri, mime_type='application/pdf')
+    return types.Part.from_bytes(
+        data=bytes(file_obj.data),
+        mime_type='application/pdf' # Or use file_obj.mime
     )
 
-    return response.output_parsed.model_dump()
+# Call Gemini. Files big enough to cache live in a Gemini cached content of the model
+# (created on the first call, reused by the later calls and stages) and the
+# instructions follow them as text, since a cached content cannot be combined with
+# a per call system instruction. Otherwise the instructions stay the system instruction.
+async def gemini_call(system_prompt, user_prompt, file_list=[], output_structure = EstimationResponse, model="gemini-2.0-flash", use_cache=True,
+                      static_prompt=None, usage=None):
+    started = time.perf_counter()
 
-async def gemini_call(system_prompt, user_prompt, file_list=[], output_structure = EstimationResponse, model="gemini-2.0-flash"):
+    # Files are encoded (or uploaded) once per request and shared by every call
+    attachments = PreparedAttachments.from_uploads(file_list)
+    prefix, request_context = prompt_layout(system_prompt, static_prompt)
 
-    # 1. Create the text part
-    request_contents = [user_prompt]
+    # 0. Serve repeated requests from the cache (use_cache=False skips the lookup but refreshes the entry)
+    cache_key = llm_cache.make_key("gemini", model, prefix + (request_context or ""), user_prompt, attachments.digests, output_structure)
+    if use_cache:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            _report_usage("gemini", model, NO_TOKENS, started, usage, cached_response=True)
+            return cached
 
-    # 2. Append each file as a separate "Part"
-    if file_list:
-        for file_obj in file_list:
-            request_contents.append(
-                types.Part.from_bytes(
-                    data=file_obj['data'],
-                    mime_type='application/pdf' # Or use file_obj['mime']
-                )
-            )
+    if LLM_PROVIDER == "fake":
+        result, tokens = await fake_provider.call(f"gemini:{model}", _segments(prefix, attachments, request_context, user_prompt), output_structure)
+        _report_usage("gemini", model, tokens, started, usage, context_cache="fake")
+        await llm_cache.set(cache_key, result)
+        return result
 
-    response = gemini_client.models.generate_content(
-        model=model,   
-        contents=request_contents, # Pass the list containing prompt + all PDFs
-        config={
-            "system_instruction": system_prompt,
-            "response_mime_type": "application/json",
-            "response_json_schema": output_structure.model_json_schema(),
-        },
-    )
+    # 1. One "Part" per file (built once per file)
+    if attachments.upload:
+        await attachments.ensure_uploaded("gemini", gemini_file_store)
+    else:
+        large = [f for f in attachments if f.path and f.size > GEMINI_INLINE_MAX_BYTES]
+        if large:
+            await attachments.ensure_uploaded("gemini", gemini_file_store, files=large)
+    file_parts = [file_obj.part("gemini", _gemini_part) for file_obj in attachments]
+    config = {
+        "response_mime_type": "application/json",
+        "response_json_schema": output_structure.model_json_schema(),
+    }
+
+    # 2. Files from the model's cached content when they are big enough
+    context_key = None
+    cache_name = None
+    if file_parts and gemini_context_cache.worth_caching(attachments):
+        context_key = gemini_context_cache.key(model, attachments.digests)
+
+        async def create(ttl):
+            cached_content = await gemini_client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=file_parts)],
+                ttl=ttl,
+                display_name="estimator-context",
+            ))
+            return cached_content.name
+
+        cache_name = await gemini_context_cache.get(context_key, create)
+
+    async def generate(cache_name):
+        request_parts = [text for text in (request_context, user_prompt) if text]
+        if cache_name is not None:
+            # A cached content cannot be combined with a system instruction: the
+            # instructions follow the cached files as text
+            return await gemini_client.aio.models.generate_content(
+                model=model, contents=[prefix] + request_parts if prefix else request_parts,
+                config={**config, "cached_content": cache_name})
+        return await gemini_client.aio.models.generate_content(
+            model=model,
+            contents=file_parts + request_parts, # Pass the list containing all PDFs + prompt
+            config={**config, "system_instruction": prefix} if prefix else config,
+        )
+
+    # 3. Call with retries behind the model's circuit breaker (without the cache if it is gone)
+    try:
+        response = await resilient_call(f"gemini:{model}", lambda: generate(cache_name))
+    except genai_errors.ClientError as e:
+        # Only a cache that is gone (expired / deleted) is worked around, other client errors are real
+        if cache_name is None or (e.code != 404 and e.status != "NOT_FOUND"):
+            raise
+        print(f"Gemini context cache {cache_name} not found, sending the full prompt...")
+        gemini_context_cache.invalidate(context_key)
+        cache_name = None
+        response = await resilient_call(f"gemini:{model}", lambda: generate(None))
+
+    usage_info = response.usage_metadata
+    tokens = {
+        "input_tokens": getattr(usage_info, "prompt_token_count", 0) or 0,
+        "cached_tokens": getattr(usage_info, "cached_content_token_count", 0) or 0,
+        "output_tokens": getattr(usage_info, "candidates_token_count", 0) or 0,
+    }
+    _report_usage("gemini", model, tokens, started, usage, context_cache="cached_content" if cache_name else None)
 
-    return response.parsed
\ No newline at end of file
+    result = response.parsed
+    await llm_cache.set(cache_key, result)
+    return result
@@ -1,6 +1,6 @@
-
-import pprint
+import os
 import asyncio
+import functools
 from collections import defaultdict
 from ai.ai_instructions import (FEATURE_LISTING_INSTRUCTION, 
                                 BRAINSTORM_SYSTEM_INSTRUCTION, 
@@ -11,8 +11,33 @@ from ai.ai_instructions import (FEATURE_LISTING_INSTRUCTION,
 # Feature list structure
 from structure import EstimationResponse, RankingResponse, Metadatastructure, ProjectType, FeatureList_Structure
 from ai.ai_models import gemini_call, openai_call
-import json
-import yaml
+from ai.pipeline_context import PipelineContext
+from ai.fanout import FanOut
+from ai.prompt_builder import PromptBuilder, format_estimates, format_baseline, compact_estimates, encode_stage_results
+from ai.consensus import build_consensus, name_similarity, CONSENSUS_MATCH_THRESHOLD
+from ai.feature_store import match_features
+
+
+# One response out of the partial responses of a sharded brainstorm. Each chunk
+# keeps the features it was asked for; a feature a chunk adds on its own is dropped
+# when it is one of the requested features (estimated by its own chunk) or was
+# already added by another chunk, so nothing is counted twice.
+def merge_feature_parts(parts, shards):
+    features = []
+    extras = []
+    for shard, part in zip(shards, parts):
+        matched, unmatched = match_features(shard, (part or {}).get("features", []))
+        features.extend(matched[feature] for feature in shard if feature in matched)
+        extras.extend(unmatched)
+
+    known = [feature for shard in shards for feature in shard] + [feature.get("name") for feature in features]
+    for extra in extras:
+        if any(name_similarity(extra.get("name"), name) >= CONSENSUS_MATCH_THRESHOLD for name in known):
+            continue
+        features.append(extra)
+        known.append(extra.get("name"))
+    return {"features": features}
+
 
 class Ai_process:
     
@@ -26,14 +51,32 @@ class Ai_process:
         self.openai_metadata_model = "gpt-4.1"
         self.openai_featurelist_model = "gpt-5"
 
-    async def combine_results(self):
-        # Load ranked (rank) file
-        with open("combined_ranked_json.json", encoding="utf-8") as f:
-            ranked = json.load(f)
-
-        # Load model result file
-        with open("combined_json.json", encoding="utf-8") as f2:
-            models = json.load(f2)
+        # Fan-out limits: proceed once `quorum` models answered, or once the deadline (seconds)
+        # passed and at least one model answered (0 = off, wait for every model)
+        self.stage_quorum = {
+            "brainstorm": int(os.getenv("BRAINSTORM_QUORUM", "0")),
+            "ranking": int(os.getenv("RANKING_QUORUM", "0")),
+        }
+        self.stage_deadlines = {
+            "brainstorm": float(os.getenv("BRAINSTORM_DEADLINE", "0")),
+            "ranking": float(os.getenv("RANKING_DEADLINE", "0")),
+        }
+        # "llm": merge with the final model, "fast": local rank weighted consensus
+        self.final_mode = os.getenv("FINAL_MODE", "llm")
+
+        # Large feature lists can be brainstormed in chunks of `shard_size` features (0 = off, one call
+        # per model). Every chunk resends the files, so only worth it for very long lists.
+        # At most `shard_concurrency` chunk calls run at once across all models.
+        self.shard_size = int(os.getenv("BRAINSTORM_SHARD_SIZE", "0"))
+        self.shard_concurrency = int(os.getenv("BRAINSTORM_SHARD_CONCURRENCY", "8"))
+
+        # Brainstorm results shown to the reviewers: "full" (with breakdown tasks) or "summary" (feature totals)
+        self.review_detail = os.getenv("REVIEW_DETAIL", "full")
+
+    async def combine_results(self, context: PipelineContext):
+        # Ranked results and model results of this request
+        ranked = context.ranking_results
+        models = [dict(entry) for entry in context.brainstorm_results]
 
         # Calculate average ranks and collect reasons per Result
         rank_sums = defaultdict(int)
@@ -59,12 +102,12 @@ class Ai_process:
             m["average_rank"] = avg_rank
             m["reasons"] = model_reasons
 
-        # Save the updated models
-        with open("combined_json_final.json", "w", encoding="utf-8") as f:
-            json.dump(models, f, indent=4)
+        # Keep the updated models for the final stage
+        context.final_results = models
+        context.dump("combined_json_final", models)
 
     # Feature listing
-    async def feature_list(self, user_query:str, file_list = None):
+    async def feature_list(self, user_query:str, file_list = None, use_cache = True, usage = None):
         try:
             print("Understnading the features...")
 
@@ -72,7 +115,9 @@ class Ai_process:
                                 user_prompt = user_query,
                                 file_list = file_list,
                                 output_structure = FeatureList_Structure, 
-                                model=self.openai_featurelist_model)
+                                model=self.openai_featurelist_model,
+                                use_cache=use_cache,
+                                usage=usage)
             print("Got the features...")
 
             return {"status": 0,"message": "Feature list generated", "data": res}
@@ -80,7 +125,7 @@ class Ai_process:
             return{"status": -1, "message": str(e)}
 
     # Project type for DB operation
-    async def predict_project_type(self, user_query:str, file_list = None):
+    async def predict_project_type(self, user_query:str, file_list = None, use_cache = True, usage = None):
         try:
             print("Understnading the type of project...")
 
@@ -88,7 +133,9 @@ class Ai_process:
                                 user_prompt = user_query,
                                 file_list = file_list,
                                 output_structure = ProjectType, 
-                                model=self.openai_metadata_model)
+                                model=self.openai_metadata_model,
+                                use_cache=use_cache,
+                                usage=usage)
             print("Got the type of project...")
 
             return {"response": res}
@@ -97,154 +144,235 @@ class Ai_process:
 
     # Brainstorm
     async def brainstorm_stage(self, user_query:str, 
+                               context: PipelineContext,
                                file_list = None, 
                                previos_estimations = None, 
                                openai_model_list = None, 
                                gemini_model_list = None,
-                               feature_list = None):
+                               feature_list = None,
+                               baseline = None):
         
         print("Processing the brainstorm stage...")
 
-        brainstorm_instruction = BRAINSTORM_SYSTEM_INSTRUCTION
-
-        # Format previous estimations for prompt (if present)
-        if previos_estimations:
-            # If it's a dict, list, or table, pretty-print as Markdown
-            prev_text = (
-                f"\nThese are some similar project estimations for your guidance:\n\n"
-                f"```\n{previos_estimations if isinstance(previos_estimations, str) else pprint.pformat(previos_estimations)}\n```"
-            )
-            brainstorm_instruction += prev_text
-            
-        # Format feature list for prompt (if present)
-        if feature_list:
-            # If it's a list, join as human-readable Markdown list
-            if isinstance(feature_list, (list, tuple)):
-                feature_text = "\n".join(f"- {f}" for f in feature_list)
-            else:
-                feature_text = str(feature_list)
-            brainstorm_instruction += (
-                f"\n\n ## Following are the features of the project." 
-                f"Calculate the estimation for each of these features:-\n\n{feature_text}\n"
-            )
-
-        # Create tasks for all OpenAI models
-        openai_tasks = [
-            openai_call(brainstorm_instruction, user_query,file_list, EstimationResponse, model=model)
-            for model in openai_model_list
+        models = (openai_model_list or []) + (gemini_model_list or [])
+
+        # Big feature lists: each model estimates the chunks side by side, so the
+        # wall clock follows the chunk size and no single output grows too large
+        shards = [feature_list]
+        if self.shard_size > 0 and isinstance(feature_list, (list, tuple)) and len(feature_list) > self.shard_size:
+            shards = [feature_list[i:i + self.shard_size] for i in range(0, len(feature_list), self.shard_size)]
+            context.metadata["brainstorm_shards"] = len(shards)
+            print(f"Brainstorming {len(feature_list)} features in {len(shards)} chunks...")
+        prompts = [
+            self.brainstorm_instruction(user_query, context, models, previos_estimations, shard, baseline)
+            for shard in shards
         ]
+        semaphore = asyncio.Semaphore(max(1, self.shard_concurrency))
+
+        async def estimate(call, model):
+            async def one(prompt):
+                async with semaphore:
+                    return await call(prompt["system"], user_query, file_list, EstimationResponse, model=model,
+                                      use_cache=context.use_cache, static_prompt=prompt["static"],
+                                      usage=context.usage_recorder("brainstorm"))
+
+            if len(prompts) == 1:
+                return await one(prompts[0])
+            # A failed chunk fails the model, the other chunks are not waited for
+            tasks = [asyncio.create_task(one(prompt)) for prompt in prompts]
+            try:
+                parts = await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            return merge_feature_parts(parts, shards)
+
+        # One call per model, labelled with its position so the final order stays stable
+        model_calls = [("openai", model, openai_call) for model in (openai_model_list or [])]
+        model_calls += [("gemini", model, gemini_call) for model in (gemini_model_list or [])]
+        fan_out = FanOut(
+            [
+                functools.partial(estimate, call, model)
+                for provider, model, call in model_calls
+            ],
+            quorum=context.quorum if context.quorum is not None else self.stage_quorum["brainstorm"],
+            deadline=context.stage_deadline or self.stage_deadlines["brainstorm"],
+        )
 
-        # Create tasks for all Gemini models
-        gemini_tasks = [
-            gemini_call(brainstorm_instruction, user_query,file_list, EstimationResponse, model=model)
-            for model in gemini_model_list
+        # Report every model as soon as it finishes
+        finished = {}
+        async for index, result, latency in fan_out:
+            provider, model, _ = model_calls[index]
+            finished[index] = (model, result)
+            if isinstance(result, Exception):
+                self.record_error(context, "brainstorm", model, result)
+            yield self.brainstorm_event(provider, model, result, latency)
+
+        # Models cut off by the quorum / deadline
+        for index in fan_out.skipped:
+            provider, model, _ = model_calls[index]
+            yield {"provider": provider, "model": model, "skipped": True}
+        self.record_skipped(context, "brainstorm", [model_calls[index][1] for index in fan_out.skipped])
+
+        # Create a lableing in json with the response and model name (failed models are dropped)
+        combined_json = [
+            {"model": model, "response": result}
+            for model, result in (finished[index] for index in sorted(finished))
+            if not isinstance(result, Exception)
         ]
 
-        # Run all tasks in parallel
-        results = await asyncio.gather(*(openai_tasks + gemini_tasks), return_exceptions=True)
-
-        # Split the results based on list sizes
-        openai_results = results[:len(openai_tasks)]
-        gemini_results = results[len(openai_tasks):]
-
-        # Filter out exceptions
-        def is_not_exception(res):
-            return not isinstance(res, Exception)
-
-        # Create a lableing in json with the response and model name
-        openai_results = [{"model": model, "response": result} for model, result in zip(openai_model_list, openai_results) if is_not_exception(result)]
-        gemini_results = [{"model": model, "response": result} for model, result in zip(gemini_model_list, gemini_results) if is_not_exception(result)]
-
-        # combine the results
-        combined_json = openai_results + gemini_results
+        if not combined_json:
+            raise Exception("None of the selected models returned an estimate")
 
         # Add "serial": "a", "b", ... to each item
         for i, entry in enumerate(combined_json):
             entry["Result"] = f"{chr(ord('A') + i)}"
 
-        # Save the combined JSON to a file
-        with open("combined_json.json", "w") as f:
-            json.dump(combined_json, f, indent=2)
+        # Keep the combined results for the next stages
+        context.brainstorm_results = combined_json
+        context.dump("combined_json", combined_json)
 
         print("Finished the brainstorm stage...")
+
+    # Brainstorm prompts for one feature list (or chunk of it), kept inside the stage token budget
+    def brainstorm_instruction(self, user_query, context, models, previos_estimations = None, feature_list = None, baseline = None):
+        builder = PromptBuilder("brainstorm", models=models, reserved_text=user_query)
+        builder.add("instruction", BRAINSTORM_SYSTEM_INSTRUCTION, priority=100, required=True, target="static")
+
+        # Format previous estimations for prompt (if present)
+        if previos_estimations:
+            builder.add("historical_estimates", format_estimates(previos_estimations), priority=10,
+                        header="\nThese are some similar project estimations for your guidance:\n\n",
+                        compact=lambda _: compact_estimates(previos_estimations, feature_list))
+
+        # Format feature list for prompt (if present)
+        if feature_list:
+            # If it's a list, join as human-readable Markdown list
+            if isinstance(feature_list, (list, tuple)):
+                feature_text = "\n".join(f"- {f}" for f in feature_list)
+            else:
+                feature_text = str(feature_list)
+            builder.add("features", f"{feature_text}\n", priority=90, required=True,
+                        header=("\n\n ## Following are the features of the project."
+                                "Calculate the estimation for each of these features:-\n\n"))
+
+        # Nearest-neighbour baseline from historical feature rows, as a prior (only the rows of these features)
+        if baseline and isinstance(feature_list, (list, tuple)):
+            wanted = set(feature_list)
+            baseline = {**baseline, "features": [f for f in baseline.get("features", []) if f.get("name") in wanted]}
+        if baseline and baseline.get("features"):
+            builder.add("baseline", format_baseline(baseline), priority=20,
+                        header=("\n\nA quick baseline taken from the closest historical features. "
+                                "Use it as a prior only and adjust wherever this project differs:\n\n"))
+
+        return builder.build(context)
+
+    # Keep the provider errors of a stage instead of dropping them silently
+    def record_error(self, context, stage, model, error):
+        print(f"{model} failed in {stage} stage: {error!r}")
+        context.metadata.setdefault("errors", {}).setdefault(stage, {})[model] = str(error)
+
+    # Keep track of the models a stage went ahead without
+    def record_skipped(self, context, stage, models):
+        if models:
+            print(f"Skipped in {stage} stage: {', '.join(models)}")
+        context.metadata.setdefault("skipped_models", {})[stage] = models
+
+    # Progress summary of one brainstorm model
+    def brainstorm_event(self, provider, model, result, latency):
+        event = {"provider": provider, "model": model, "latency": round(latency, 2)}
+        if isinstance(result, Exception):
+            event["error"] = str(result)
+            return event
+
+        features = (result or {}).get("features", [])
+        event["features"] = len(features)
+        event["total_optimistic"] = sum(f.get("optimistic", 0) for f in features)
+        event["total_most_likely"] = sum(f.get("most_likely", 0) for f in features)
+        event["total_pessimistic"] = sum(f.get("pessimistic", 0) for f in features)
+        return event
     
     # Ranking
-    async def ranking_stage(self, file_list = None, 
+    async def ranking_stage(self, context: PipelineContext,
+                            file_list = None, 
                             previos_estimations = None,
                             openai_model_list = None, 
                             gemini_model_list = None):
         print("Processing the ranking stage...")
 
-        # Read the combined JSON file
-        with open("combined_json.json", "r") as f:
-            combined_json = json.load(f)
+        # Brainstorm results of this request
+        combined_json = context.brainstorm_results
 
-        # Prepare review results as a list of dicts for YAML
+        # Prepare review results as a list of dicts
         review_list = []
         for entry in combined_json:
             review_list.append({"Result": entry['Result'], "Response": entry['response']})
 
-        # Convert to YAML
-        review_results_yaml = yaml.safe_dump(review_list, sort_keys=False, allow_unicode=True)
+        # Compact table per result (feature totals only in summary mode)
+        models = (openai_model_list or []) + (gemini_model_list or [])
+        review_results, review_compact = encode_stage_results("ranking", review_list, models, context,
+                                                              summary=self.review_detail == "summary")
 
-        # Build YAML review prompt
-        review_user_prompt = (
-            "### Responses to Review:-\n"
-            f"{review_results_yaml}"
-        )
+        # Prompts kept inside the stage token budget
+        builder = PromptBuilder("ranking", models=models)
+        builder.add("instruction", REVIEW_SYSTEM_INSTRUCTION, priority=100, required=True, target="static")
 
         # If previos estimation add it with the system instruction
         if previos_estimations:
-            review_system_prompt = (
-                f"{REVIEW_SYSTEM_INSTRUCTION}\n\n"
-                "These are some Similar project estimations take some guidance on review:-\n"
-                f"{previos_estimations}\n"
-            )
-        else:
-            review_system_prompt = REVIEW_SYSTEM_INSTRUCTION
-
-        # Create tasks for all OpenAI models
-        openai_tasks = [
-            openai_call(review_system_prompt, review_user_prompt, file_list, RankingResponse, model=model)
-            for model in openai_model_list
-        ]
-
-        # Create tasks for all Gemini models
-        gemini_tasks = [
-            gemini_call(review_system_prompt, review_user_prompt, file_list, RankingResponse, model=model)
-            for model in gemini_model_list
-        ]
-
-        # Run all tasks in parallel
-        results = await asyncio.gather(*(openai_tasks + gemini_tasks), return_exceptions=True)
-
-        # Filter out exceptions
-        def is_not_exception(res):
-            return not isinstance(res, Exception)
+            builder.add("historical_estimates", f"{format_estimates(previos_estimations)}\n", priority=10,
+                        header="\n\nThese are some Similar project estimations take some guidance on review:-\n",
+                        compact=lambda _: compact_estimates(previos_estimations) + "\n")
+
+        # Review prompt (without breakdowns if it does not fit)
+        builder.add("brainstorm_results", review_results, priority=50, target="user",
+                    header="### Responses to Review:-\n", compact=review_compact)
+
+        prompts = builder.build(context)
+        review_system_prompt = prompts["system"]
+        review_user_prompt = prompts["user"]
+
+        # One call per reviewer model
+        model_calls = [(model, openai_call) for model in (openai_model_list or [])]
+        model_calls += [(model, gemini_call) for model in (gemini_model_list or [])]
+        fan_out = FanOut(
+            [
+                functools.partial(call, review_system_prompt, review_user_prompt, file_list, RankingResponse, model=model,
+                                  use_cache=context.use_cache, static_prompt=prompts["static"], usage=context.usage_recorder("ranking"))
+                for model, call in model_calls
+            ],
+            quorum=context.quorum if context.quorum is not None else self.stage_quorum["ranking"],
+            deadline=context.stage_deadline or self.stage_deadlines["ranking"],
+        )
 
-        openai_results = [result for result in results[:len(openai_tasks)] if is_not_exception(result)]
-        gemini_results = [result for result in results[len(openai_tasks):] if is_not_exception(result)]
+        # Run all calls in parallel (failed reviewers are dropped)
+        finished = {}
+        async for index, result, latency in fan_out:
+            if isinstance(result, Exception):
+                self.record_error(context, "ranking", model_calls[index][0], result)
+            else:
+                finished[index] = result
+        self.record_skipped(context, "ranking", [model_calls[index][0] for index in fan_out.skipped])
 
-        combined_ranked_json = openai_results + gemini_results
+        combined_ranked_json = [finished[index] for index in sorted(finished)]
 
-        # Save the combined JSON to a file
-        with open("combined_ranked_json.json", "w") as f:
-            json.dump(combined_ranked_json, f, indent=2)
+        # Keep the ranked results for the next stages
+        context.ranking_results = combined_ranked_json
+        context.dump("combined_ranked_json", combined_ranked_json)
 
         # Buld the final combined json
-        await self.combine_results()
+        await self.combine_results(context)
 
         print("Finished the ranking stage...")
     
     # Final
     async def final_stage(self, user_query:str , 
+                          context: PipelineContext,
                           file_list = None, 
                           previos_estimations = None):
         print("Processing the final stage...")
 
-        # Read the combined final JSON file
-        with open("combined_json_final.json", "r") as f:
-            combined_json_final = json.load(f)
+        # Combined final results of this request
+        combined_json_final = context.final_results
 
         # Remove "model" from each entry
         entries_no_model = []
@@ -253,31 +381,44 @@ class Ai_process:
             entry_copy.pop("model", None)
             entries_no_model.append(entry_copy)
 
-         # Convert to YAML
-        yaml_str = yaml.safe_dump(entries_no_model, sort_keys=False, allow_unicode=True)
-
+        # Compact table per result, with its average rank and reviews
+        results_text, results_compact = encode_stage_results("final", entries_no_model, [self.openai_final_model], context)
         
+        # Prompt kept inside the stage token budget
+        builder = PromptBuilder("final", models=[self.openai_final_model], reserved_text=user_query)
+        builder.add("instruction", FINAL_SYSTEM_INSTRUCTION, priority=100, required=True, target="static")
+
         # If previos estimation add it with the system instruction
         if previos_estimations:
-            final_prompt = (
-                f"{FINAL_SYSTEM_INSTRUCTION}\n\n"
-                "These are some Similar project estimations take some guidance:-\n"
-                f"{previos_estimations}\n"
-                "Following are the estimated results:-\n"
-                f"{yaml_str}"
-            )
-        else:
-            final_prompt = (
-                f"{FINAL_SYSTEM_INSTRUCTION}\n\n"
-                "Following are the estimated results:-\n"
-                f"{yaml_str}"
-            )
+            builder.add("historical_estimates", f"{format_estimates(previos_estimations)}\n", priority=10,
+                        header="\n\nThese are some Similar project estimations take some guidance:-\n",
+                        compact=lambda _: compact_estimates(previos_estimations) + "\n")
+
+        builder.add("estimated_results", results_text, priority=50,
+                    header=("\n\n" if not previos_estimations else "") + "Following are the estimated results:-\n",
+                    compact=results_compact)
+
+        final_prompts = builder.build(context)
             
-        res = await openai_call(final_prompt, user_query,file_list, EstimationResponse, model=self.openai_final_model)
+        res = await openai_call(final_prompts["system"], user_query,file_list, EstimationResponse, model=self.openai_final_model,
+                                use_cache=context.use_cache, static_prompt=final_prompts["static"], usage=context.usage_recorder("final"))
         print("Finished the final stage...")
 
         return {"response": res}
 
+    # Fast alternative to the final stage: align the features of the ranked results
+    # by name and take rank weighted trimmed means of their hours, no LLM call
+    async def consensus_stage(self, context: PipelineContext):
+        print("Processing the consensus stage...")
+
+        response, support = build_consensus(context.final_results)
+        res = EstimationResponse.model_validate(response).model_dump()
+        context.metadata["consensus"] = support
+        context.dump("consensus", {"response": res, "support": support})
+        print("Finished the consensus stage...")
+
+        return {"response": res}
+
     # Extract Metadata for db insert
     async def extract_metadata(self, markdown_text):
         print("Processing the metadata extraction stage...")
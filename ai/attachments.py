@@ -0,0 +1,188 @@
+import asyncio
+import base64
+import hashlib
+import io
+import mmap
+import os
+import threading
+import uuid
+
+# "inline" sends the base64 payload with every call, "upload" pushes each file
+# to the provider's file store once and sends only the reference afterwards
+LLM_FILE_MODE = os.getenv("LLM_FILE_MODE", "inline")
+
+
+# One uploaded file, encoded at most once and shared read-only by every model call.
+# The bytes either live in memory (`data`) or in a spooled file on disk (`path`),
+# which is memory-mapped on first access.
+class PreparedFile:
+
+    def __init__(self, name, mime, data = None, path = None, sha256 = None, size = None, owned = False):
+        self.name = name
+        self.mime = mime
+        self.path = path
+        self.owned = owned          # delete `path` on close
+        self.remote_refs = {}       # provider -> file reference in that provider's store
+        self._data = data
+        self._handle = None
+        self._mmap = None
+        self._data_url = None
+        self._parts = {}            # provider -> provider specific part object
+        self._lock = threading.RLock()
+        self.sha256 = sha256 or hashlib.sha256(self.data).hexdigest()
+        self.size = size if size is not None else len(self.data)
+
+    # Raw bytes (read-only memory map for spooled files)
+    @property
+    def data(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._handle = open(self.path, "rb")
+                    if os.fstat(self._handle.fileno()).st_size:
+                        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+                        self._data = self._mmap
+                    else:
+                        self._data = b""
+        return self._data
+
+    # Binary stream of the content, for streaming uploads
+    def open(self):
+        if self.path:
+            return open(self.path, "rb")
+        return io.BytesIO(self._data)
+
+    # Unmap and (if spooled by us) delete the backing file
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            if self.path:
+                self._data = None
+            self._data_url = None
+            self._parts = {}
+        if self.owned and self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Base64 data URL, built once
+    @property
+    def data_url(self):
+        if self._data_url is None:
+            with self._lock:
+                if self._data_url is None:
+                    b64_string = base64.b64encode(self.data).decode("utf-8")
+                    self._data_url = f"data:application/pdf;base64,{b64_string}"
+        return self._data_url
+
+    # Provider specific part, built once by `factory`
+    def part(self, provider, factory):
+        part = self._parts.get(provider)
+        if part is None:
+            with self._lock:
+                part = self._parts.get(provider)
+                if part is None:
+                    part = factory(self)
+                    self._parts[provider] = part
+        return part
+
+    # Dict style access so older callers using file_obj['data'] keep working
+    def __getitem__(self, key):
+        if key not in ("name", "mime", "data"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+# All files of one request
+class PreparedAttachments:
+
+    def __init__(self, files = None, mode = None):
+        self.files = list(files or [])
+        self.mode = mode or LLM_FILE_MODE
+        self._upload_locks = {}     # provider -> asyncio.Lock
+        self._stores = {}           # provider -> store the files were pushed to
+
+    # Build from the [{"name", "mime", "data"}] dicts collected by the server
+    @classmethod
+    def from_uploads(cls, file_list, mode = None):
+        if isinstance(file_list, PreparedAttachments):
+            return file_list
+        files = [
+            file_obj if isinstance(file_obj, PreparedFile)
+            else PreparedFile(file_obj["name"], file_obj.get("mime"), file_obj["data"])
+            for file_obj in (file_list or [])
+        ]
+        return cls(files, mode=mode)
+
+    @property
+    def digests(self):
+        return [f.sha256 for f in self.files]
+
+    @property
+    def upload(self):
+        return self.mode == "upload"
+
+    # Map the spooled files up front, off the event loop. The base64 data URLs
+    # are only built by the first call that sends the files inline (OpenAI).
+    async def prepare(self):
+        if self.files:
+            await asyncio.to_thread(lambda: [f.data for f in self.files])
+        return self
+
+    # Data URLs of the files not pushed to `provider`'s store, built once, off the event loop
+    async def encode_inline(self, provider):
+        pending = [f for f in self.files if provider not in f.remote_refs and f._data_url is None]
+        if pending:
+            await asyncio.to_thread(lambda: [f.data_url for f in pending])
+
+    # Push every file (or only `files`) to `store` once; concurrent callers wait for the first upload
+    async def ensure_uploaded(self, provider, store, files = None):
+        lock = self._upload_locks.setdefault(provider, asyncio.Lock())
+        async with lock:
+            for f in self.files if files is None else files:
+                if provider not in f.remote_refs:
+                    f.remote_refs[provider] = await store.upload(f)
+            self._stores[provider] = store
+
+    # Remove the uploaded copies from the provider stores and close the local files
+    async def release(self):
+        for provider, store in self._stores.items():
+            for f in self.files:
+                ref = f.remote_refs.pop(provider, None)
+                if ref is not None:
+                    try:
+                        await store.delete(ref)
+                    except Exception as e:
+                        print(f"Failed to delete {f.name} from {provider}: {e}")
+        self._stores = {}
+        for f in self.files:
+            f.close()
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __bool__(self):
+        return bool(self.files)
+
+
+# In-process stand-in for a provider file store (tests and local runs)
+class LocalFileStore:
+
+    def __init__(self):
+        self.files = {}
+        self.uploads = 0
+
+    async def upload(self, prepared_file):
+        ref = f"local://{uuid.uuid4().hex}/{prepared_file.sha256}"
+        self.files[ref] = bytes(prepared_file.data)
+        self.uploads += 1
+        return ref
+
+    async def delete(self, ref):
+        self.files.pop(ref, None)
@@ -0,0 +1,159 @@
+import difflib
+import os
+import re
+from collections import defaultdict
+
+# Consensus settings
+CONSENSUS_MATCH_THRESHOLD = float(os.getenv("CONSENSUS_MATCH_THRESHOLD", "0.55"))  # name similarity to align two items
+CONSENSUS_MIN_SUPPORT = float(os.getenv("CONSENSUS_MIN_SUPPORT", "0.5"))          # share of the total weight to keep an item
+CONSENSUS_TRIM = float(os.getenv("CONSENSUS_TRIM", "0.2"))                        # weight trimmed from each tail
+
+HOURS = ("optimistic", "most_likely", "pessimistic")
+STOP_WORDS = {"and", "the", "for", "with", "of", "to", "a", "an", "in", "on", "module", "feature", "features"}
+
+
+def _tokens(name):
+    return {word for word in re.findall(r"[a-z0-9]+", str(name).lower()) if word not in STOP_WORDS}
+
+
+# Name similarity in [0, 1]: the better of character and word overlap
+def name_similarity(a, b):
+    a_norm = " ".join(sorted(_tokens(a)))
+    b_norm = " ".join(sorted(_tokens(b)))
+    if not a_norm or not b_norm:
+        return 0.0
+    ratio = difflib.SequenceMatcher(None, a_norm, b_norm).ratio()
+    a_tokens, b_tokens = set(a_norm.split()), set(b_norm.split())
+    jaccard = len(a_tokens & b_tokens) / len(a_tokens | b_tokens)
+    return max(ratio, jaccard)
+
+
+def weighted_median(values, weights):
+    pairs = sorted(zip(values, weights))
+    half = sum(weight for _, weight in pairs) / 2
+    seen = 0.0
+    for i, (value, weight) in enumerate(pairs):
+        seen += weight
+        # Exactly half the weight below: midway to the next value
+        if abs(seen - half) < 1e-9 and i + 1 < len(pairs):
+            return (value + pairs[i + 1][0]) / 2
+        if seen >= half:
+            return value
+    return pairs[-1][0]
+
+
+# Weighted mean after dropping `trim` of the total weight from each end. With
+# few values one wild estimate would still leak in, so those use the weighted median.
+def trimmed_mean(values, weights, trim = CONSENSUS_TRIM):
+    pairs = sorted(zip(values, weights))
+    total = sum(weight for _, weight in pairs)
+    if not pairs or total <= 0:
+        return 0.0
+    if len(pairs) < 5:
+        return weighted_median(values, weights)
+
+    low_cut, high_cut = total * trim, total * (1 - trim)
+    kept_sum = kept_weight = 0.0
+    seen = 0.0
+    for value, weight in pairs:
+        # Part of this value's weight that lies inside [low_cut, high_cut]
+        inside = max(0.0, min(seen + weight, high_cut) - max(seen, low_cut))
+        kept_sum += value * inside
+        kept_weight += inside
+        seen += weight
+    return kept_sum / kept_weight if kept_weight else sum(value * weight for value, weight in pairs) / total
+
+
+# Group the items (features or breakdown tasks) of several lists by name.
+# `lists` is [(weight, source, items)], best first; the first list seeds the
+# groups and every later item joins the most similar free group or starts one.
+def align(lists, key = "name", threshold = CONSENSUS_MATCH_THRESHOLD):
+    groups = []
+    for weight, source, items in lists:
+        pairs = []
+        for i, item in enumerate(items):
+            for g, group in enumerate(groups):
+                similarity = name_similarity(item.get(key), group["name"])
+                if similarity >= threshold:
+                    pairs.append((similarity, i, g))
+
+        # One to one, most similar pairs first
+        used_items, used_groups = set(), set()
+        for similarity, i, g in sorted(pairs, reverse=True):
+            if i in used_items or g in used_groups:
+                continue
+            used_items.add(i)
+            used_groups.add(g)
+            groups[g]["members"].append((weight, source, items[i]))
+
+        for i, item in enumerate(items):
+            if i not in used_items:
+                groups.append({"name": item.get(key), "members": [(weight, source, item)]})
+    return groups
+
+
+def _hours(members):
+    weights = [weight for weight, _, _ in members]
+    values = [int(round(trimmed_mean([member[field] for _, _, member in members], weights))) for field in HOURS]
+    optimistic, most_likely, pessimistic = sorted(values)
+    return {"optimistic": optimistic, "most_likely": most_likely, "pessimistic": pessimistic}
+
+
+def _weighted_choice(members, field):
+    votes = defaultdict(float)
+    for weight, _, member in members:
+        votes[member.get(field)] += weight
+    return max(votes.items(), key=lambda vote: vote[1])[0]
+
+
+# Rank weighted consensus EstimationResponse (as a dict) from ranked brainstorm
+# entries ({"Result", "model", "response", "average_rank"}). Returns the
+# estimate and, per feature, which results supported it.
+def build_consensus(entries, min_support = CONSENSUS_MIN_SUPPORT):
+    weighted = []
+    for entry in entries:
+        response = entry.get("response") or {}
+        if not response.get("features"):
+            continue
+        rank = entry.get("average_rank")
+        # Rank 1 is the best; unranked results get the weight of the worst rank
+        weighted.append((rank, entry.get("Result") or entry.get("model"), response["features"]))
+    if not weighted:
+        raise ValueError("No brainstorm results to build a consensus from")
+
+    worst = max([rank for rank, _, _ in weighted if rank is not None], default=1)
+    lists = sorted(((1 / (rank if rank is not None else worst), source, features)
+                    for rank, source, features in weighted), key=lambda item: -item[0])
+    total_weight = sum(weight for weight, _, _ in lists)
+    anchor = lists[0][1]
+
+    features = []
+    support = []
+    for group in align(lists):
+        members = group["members"]
+        group_weight = sum(weight for weight, _, _ in members)
+        sources = [source for _, source, _ in members]
+        # Keep what most of the (weighted) models agree on, and everything the best one proposed
+        if group_weight / total_weight < min_support and anchor not in sources:
+            continue
+
+        # Same alignment one level down, for the breakdown tasks
+        # (results without a breakdown do not vote on the tasks)
+        breakdown = []
+        task_lists = [(weight, source, member["breakdown"]) for weight, source, member in members if member.get("breakdown")]
+        breakdown_weight = sum(weight for weight, _, _ in task_lists)
+        for task_group in align(task_lists, key="task"):
+            task_weight = sum(weight for weight, _, _ in task_group["members"])
+            if task_weight / breakdown_weight < min_support:
+                continue
+            breakdown.append({"task": task_group["name"], **_hours(task_group["members"])})
+
+        features.append({
+            "name": group["name"],
+            "breakdown": breakdown,
+            "type": _weighted_choice(members, "type"),
+            **_hours(members),
+        })
+        support.append({"feature": group["name"], "results": sources, "support": round(group_weight / total_weight, 3)})
+
+    return {"features": features}, support
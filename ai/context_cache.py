@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Provider side context caching settings
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") == "1"
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "900"))                  # seconds a cached content lives
+GEMINI_CACHE_MIN_BYTES = int(os.getenv("GEMINI_CACHE_MIN_BYTES", "65536"))    # smaller attachments are not worth a cache
+GEMINI_CACHE_MARGIN = 60    # stop using a cached content this many seconds before it expires
+
+
+# Prompts are laid out as [files][instructions][request context][user prompt].
+# The files never change within a request and the instructions never change for
+# a stage, so every later call of a model (other chunks, other stages) shares
+# the long file prefix and requests without files share the instructions.
+# `static_prompt` is the constant instruction part; without it the whole
+# system prompt is (e.g. the constant phase 2 instructions).
+def prompt_layout(system_prompt, static_prompt = None):
+    if static_prompt is None:
+        return system_prompt or "", None
+    return static_prompt, system_prompt or None
+
+
+# Routing key for OpenAI prompt caching: calls with the same prefix (the files,
+# else the instructions) land on the same cache
+def prompt_cache_key(prefix, file_digests):
+    if file_digests:
+        digest = hashlib.sha256("\0".join(file_digests).encode("utf-8"))
+    else:
+        digest = hashlib.sha256(prefix.encode("utf-8"))
+    return "estimator-" + digest.hexdigest()[:40]
+
+
+# Gemini cached contents holding the files of one request for one model. Created
+# on first use, shared by the later calls and stages of that model, deleted on
+# shutdown (or left to expire). Files Gemini refuses to cache (e.g. too few
+# tokens) are remembered so they are not tried again.
+class GeminiContextCache:
+
+    def __init__(self, ttl = GEMINI_CACHE_TTL, min_bytes = GEMINI_CACHE_MIN_BYTES, enabled = CONTEXT_CACHE_ENABLED):
+        self.ttl = ttl
+        self.min_bytes = min_bytes
+        self.enabled = enabled
+        self.entries = {}       # key -> (cached content name or None, usable until)
+        self.inflight = {}      # key -> task creating it
+        self.counters = {"created": 0, "reused": 0, "failed": 0, "expired": 0}
+
+    @staticmethod
+    def key(model, file_digests):
+        return hashlib.sha256(f"{model}\0{','.join(file_digests or [])}".encode("utf-8")).hexdigest()
+
+    def worth_caching(self, attachments):
+        return self.enabled and sum(f.size for f in attachments) >= self.min_bytes
+
+    # Name of the cached content for these files, None when they cannot be cached.
+    # `create(ttl)` makes the cached content and returns its name.
+    async def get(self, key, create):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            if entry[0] is not None:
+                self.counters["reused"] += 1
+            return entry[0]
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._create(key, create))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _create(self, key, create):
+        try:
+            name = await create(f"{self.ttl}s")
+            self.counters["created"] += 1
+            self.entries[key] = (name, time.time() + self.ttl - GEMINI_CACHE_MARGIN)
+        except Exception as e:
+            print(f"Gemini context cache not created: {e!r}")
+            self.counters["failed"] += 1
+            name = None
+            self.entries[key] = (None, time.time() + self.ttl)
+        return name
+
+    # The cached content is gone (expired / deleted): forget it
+    def invalidate(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.counters["expired"] += 1
+
+    # Cached contents still alive, for cleanup on shutdown
+    def drain(self):
+        names = [name for name, until in self.entries.values() if name is not None and until > time.time()]
+        self.entries = {}
+        return names
+
+    def stats(self):
+        live = sum(1 for name, until in self.entries.values() if name is not None and until > time.time())
+        return {**self.counters, "live": live, "enabled": self.enabled}
+
+
+# Input / cached / output tokens per provider and model, over all calls of this worker
+class ContextCacheStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0})
+
+    def record(self, provider, model, input_tokens, cached_tokens, output_tokens):
+        with self.lock:
+            counters = self.models[f"{provider}:{model}"]
+            counters["calls"] += 1
+            counters["input_tokens"] += input_tokens
+            counters["cached_tokens"] += cached_tokens
+            counters["output_tokens"] += output_tokens
+
+    def stats(self):
+        with self.lock:
+            return {
+                model: {**counters, "cached_ratio": round(counters["cached_tokens"] / counters["input_tokens"], 3)
+                        if counters["input_tokens"] else 0.0}
+                for model, counters in self.models.items()
+            }
+
+
+def cached_ratio(input_tokens, cached_tokens):
+    return round(cached_tokens / input_tokens, 3) if input_tokens else 0.0
+
+
+gemini_context_cache = GeminiContextCache()
+context_cache_stats = ContextCacheStats()
@@ -1,7 +1,175 @@
-#from docling.document_converter import DocumentConverter
+import asyncio
+import hashlib
+import math
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
-async def exract_markdown(file_path: str) -> str:
-    #converter = DocumentConverter()
-    #doc = converter.convert(file_path).document
-    #return doc.export_to_markdown()
-    return file_path
\ No newline at end of file
+# Extraction settings
+DOCLING_WORKERS = int(os.getenv("DOCLING_WORKERS", "2"))
+MARKDOWN_CACHE_DIR = os.getenv("MARKDOWN_CACHE_DIR", "cache/markdown")
+# Bump when the markdown output changes so old cache entries are not reused
+EXTRACTOR_VERSION = "1"
+
+_executor = None
+_inflight = {}      # sha256 -> future of an extraction already running in this worker
+
+
+def _executor_pool():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=DOCLING_WORKERS)
+    return _executor
+
+
+def shutdown_extractors():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ---- Runs in the process pool ----
+
+def _cell(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, float):
+        value = round(value, 2)
+    text = re.sub(r"\s*\n\s*", " / ", str(value).strip())
+    return text.replace("|", "\\|")
+
+
+def _table(rows):
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + "---|" * width]
+    lines += ["| " + " | ".join(row) + " |" for row in rows[1:]]
+    return "\n".join(lines)
+
+
+# Every sheet as one markdown table, empty rows / columns removed
+def _spreadsheet_to_markdown(file_path, reader):
+    import pandas as pd
+
+    if reader == "csv":
+        sheets = {"Sheet1": pd.read_csv(file_path, header=None, dtype=object)}
+    else:
+        sheets = pd.read_excel(file_path, sheet_name=None, header=None)
+
+    parts = []
+    for name, df in sheets.items():
+        df = df.dropna(how="all").dropna(axis=1, how="all")
+        if df.empty:
+            continue
+        rows = [[_cell(value) for value in row] for row in df.itertuples(index=False)]
+        rows = [row for row in rows if any(row)]
+        parts.append(f"## {name}\n\n{_table(rows)}")
+    return "\n\n".join(parts)
+
+
+# Page text; runs of lines with aligned columns (2+ spaces apart) become tables
+def _pdf_to_markdown(file_path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("pypdf is not installed, PDF files cannot be read")
+
+    parts = []
+    for number, page in enumerate(PdfReader(file_path).pages, start=1):
+        text = page.extract_text(extraction_mode="layout") or ""
+        blocks = []
+        table = []
+        for line in text.splitlines():
+            cells = [cell for cell in re.split(r"\s{2,}", line.strip()) if cell]
+            if len(cells) >= 2:
+                table.append([_cell(cell) for cell in cells])
+                continue
+            if table:
+                blocks.append(_table(table) if len(table) > 1 else " ".join(table[0]))
+                table = []
+            if cells:
+                blocks.append(cells[0])
+        if table:
+            blocks.append(_table(table) if len(table) > 1 else " ".join(table[0]))
+        if blocks:
+            parts.append(f"## Page {number}\n\n" + "\n".join(blocks))
+    return "\n\n".join(parts)
+
+
+def _convert(file_path):
+    with open(file_path, "rb") as f:
+        head = f.read(8)
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if head.startswith(b"%PDF") or extension == ".pdf":
+        return _pdf_to_markdown(file_path)
+    if head.startswith(b"PK") or extension in (".xlsx", ".xlsm"):
+        return _spreadsheet_to_markdown(file_path, "excel")
+    if extension == ".xls":
+        return _spreadsheet_to_markdown(file_path, "excel")
+    if extension == ".csv":
+        return _spreadsheet_to_markdown(file_path, "csv")
+    if extension in (".md", ".txt"):
+        with open(file_path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+    raise ValueError(f"Unsupported file type '{extension or 'unknown'}', expected xlsx, csv or pdf")
+
+
+# ---- Async entry point ----
+
+def _cache_path(sha256):
+    return os.path.join(MARKDOWN_CACHE_DIR, f"{sha256}.v{EXTRACTOR_VERSION}.md")
+
+
+def _read_cache(sha256):
+    path = _cache_path(sha256)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def _write_cache(sha256, markdown):
+    os.makedirs(MARKDOWN_CACHE_DIR, exist_ok=True)
+    path = _cache_path(sha256)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(markdown)
+    os.replace(tmp, path)
+
+
+async def _extract(file_path, sha256):
+    markdown = await asyncio.to_thread(_read_cache, sha256)
+    if markdown is not None:
+        return markdown
+
+    loop = asyncio.get_running_loop()
+    markdown = await loop.run_in_executor(_executor_pool(), _convert, file_path)
+    if not markdown.strip():
+        raise ValueError("No content could be extracted from the file")
+    await asyncio.to_thread(_write_cache, sha256, markdown)
+    return markdown
+
+
+# Markdown of an estimate file (xlsx / csv / pdf), cached by the file's SHA-256
+async def exract_markdown(file_path: str, sha256: str = None) -> str:
+    if sha256 is None:
+        sha256 = await asyncio.to_thread(_file_sha256, file_path)
+
+    # The same file being extracted concurrently shares one conversion
+    if sha256 not in _inflight:
+        future = asyncio.ensure_future(_extract(file_path, sha256))
+        _inflight[sha256] = future
+        future.add_done_callback(lambda _: _inflight.pop(sha256, None))
+    return await asyncio.shield(_inflight[sha256])
@@ -0,0 +1,73 @@
+import asyncio
+import enum
+import hashlib
+import json
+import os
+import typing
+from pydantic import BaseModel
+from ai.prompt_builder import count_tokens, CHARS_PER_TOKEN
+
+# Local stand-in for both providers (LLM_PROVIDER=fake): no network, canned
+# structured output, and a prefix cache that behaves like the real ones so
+# the prompt layout and the cached-token reporting can be checked offline
+FAKE_MIN_CACHED_TOKENS = int(os.getenv("FAKE_MIN_CACHED_TOKENS", "1024"))   # shorter prefixes are never cached
+FAKE_CACHE_BLOCK = int(os.getenv("FAKE_CACHE_BLOCK", "128"))                # cached tokens come in blocks
+FAKE_INPUT_MS_PER_1K = float(os.getenv("FAKE_INPUT_MS_PER_1K", "2"))        # simulated latency per 1k uncached tokens
+FAKE_BYTES_PER_FILE_TOKEN = 16                                              # rough tokens of an attached file
+
+
+# Smallest valid value of a type, for canned responses
+def _placeholder(annotation):
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union:
+        return _placeholder(next(arg for arg in typing.get_args(annotation) if arg is not type(None)))
+    if origin in (list, tuple, set):
+        return []
+    if origin is dict:
+        return {}
+    if isinstance(annotation, type):
+        if issubclass(annotation, BaseModel):
+            return {name: _placeholder(field.annotation) for name, field in annotation.model_fields.items()}
+        if issubclass(annotation, enum.Enum):
+            return next(iter(annotation)).value
+        if issubclass(annotation, bool):
+            return False
+        if issubclass(annotation, (int, float)):
+            return 0
+    return ""
+
+
+class FakeProvider:
+
+    def __init__(self, responder = None):
+        self.responder = responder      # optional (model, segments, output_structure) -> dict
+        self.prefixes = set()           # hashes of every prefix seen, per model
+
+    # `segments` is the prompt in send order: [("text", str) | ("file", PreparedFile)].
+    # Returns (result, usage) with the cached tokens of the longest prefix seen before.
+    async def call(self, model, segments, output_structure):
+        digest = hashlib.sha256(model.encode("utf-8"))
+        total = cached = 0
+        for kind, value in segments:
+            if kind == "file":
+                digest.update(value.sha256.encode("utf-8"))
+                total += -(-value.size // FAKE_BYTES_PER_FILE_TOKEN)
+            else:
+                digest.update(hashlib.sha256(value.encode("utf-8")).digest())
+                total += count_tokens(value)
+            key = digest.hexdigest()
+            if key in self.prefixes:
+                cached = total
+            self.prefixes.add(key)
+        cached = cached // FAKE_CACHE_BLOCK * FAKE_CACHE_BLOCK if cached >= FAKE_MIN_CACHED_TOKENS else 0
+
+        await asyncio.sleep((total - cached) / 1000 * FAKE_INPUT_MS_PER_1K / 1000)
+        if self.responder is not None:
+            result = self.responder(model, segments, output_structure)
+        else:
+            result = _placeholder(output_structure)
+        output_tokens = -(-len(json.dumps(result)) // CHARS_PER_TOKEN)
+        return result, {"input_tokens": total, "cached_tokens": cached, "output_tokens": output_tokens}
+
+
+fake_provider = FakeProvider()
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+
+# Run several model calls concurrently and hand back each result as it arrives.
+# Stops early once `quorum` calls have succeeded, or once `deadline` seconds have
+# passed and at least one call has succeeded (with no success yet it keeps waiting,
+# up to the per call timeouts); the calls still running are cancelled and listed in `skipped`.
+class FanOut:
+
+    def __init__(self, calls, quorum = None, deadline = None):
+        self.calls = calls          # list of zero-argument coroutine factories
+        self.quorum = quorum or None
+        self.deadline = deadline or None
+        self.skipped = []           # indexes of the calls that were cancelled
+        self.timed_out = False
+
+    async def _timed(self, index, call):
+        started = time.perf_counter()
+        try:
+            result = await call()
+        except Exception as e:
+            result = e
+        return index, result, time.perf_counter() - started
+
+    # Yields (index, result_or_exception, latency_seconds)
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.deadline if self.deadline else None
+        tasks = {
+            asyncio.create_task(self._timed(index, call)): index
+            for index, call in enumerate(self.calls)
+        }
+        pending = set(tasks)
+        succeeded = 0
+        try:
+            while pending:
+                if self.quorum and succeeded >= self.quorum:
+                    break
+
+                # The deadline only cuts off the stragglers, never the only answers
+                timeout = None
+                if deadline_at is not None and succeeded:
+                    timeout = deadline_at - loop.time()
+                    if timeout <= 0:
+                        self.timed_out = True
+                        break
+
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.timed_out = True
+                    break
+
+                for task in done:
+                    index, result, latency = task.result()
+                    if not isinstance(result, Exception):
+                        succeeded += 1
+                    yield index, result, latency
+        finally:
+            # Cancel the stragglers
+            for task in pending:
+                task.cancel()
+            self.skipped = sorted(tasks[task] for task in pending)
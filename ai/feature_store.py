@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from ai.consensus import name_similarity, CONSENSUS_MATCH_THRESHOLD
+
+# Per-feature estimate store settings
+FEATURE_STORE_PATH = os.getenv("FEATURE_STORE_PATH", "cache/feature_estimates.sqlite3")
+FEATURE_STORE_TTL = float(os.getenv("FEATURE_STORE_TTL", str(30 * 24 * 3600)))   # seconds
+FEATURE_STORE_VERSION = "1"     # bump when the brainstorm prompt / schema changes
+
+
+def normalize_feature(text):
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+
+# Reviewed feature list from the form: a JSON array, or one feature per line / field
+def parse_feature_list(values):
+    features = []
+    for value in values or []:
+        value = str(value or "").strip()
+        if value.startswith("["):
+            try:
+                features.extend(str(item) for item in json.loads(value))
+                continue
+            except json.JSONDecodeError:
+                pass
+        features.extend(re.sub(r"^\s*(?:[-*]|\d+[.)])\s+", "", line) for line in value.splitlines())
+    return [feature.strip() for feature in features if feature.strip()]
+
+
+# Everything a feature estimate depends on besides the feature itself
+def context_hash(user_query, file_digests):
+    parts = {"version": FEATURE_STORE_VERSION, "details": normalize_feature(user_query), "files": sorted(file_digests or [])}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Pair requested feature names with the features a model returned (one to one,
+# exact names first, then the most similar). Returns ({feature: estimate}, extras).
+def match_features(features, estimated, threshold = CONSENSUS_MATCH_THRESHOLD):
+    matched = {}
+    used = set()
+    by_name = {}
+    for i, item in enumerate(estimated):
+        by_name.setdefault(normalize_feature(item.get("name")), i)
+    for feature in features:
+        i = by_name.get(normalize_feature(feature))
+        if i is not None and i not in used:
+            matched[feature] = estimated[i]
+            used.add(i)
+
+    pairs = sorted(
+        ((name_similarity(feature, item.get("name")), f, i)
+         for f, feature in enumerate(features) if feature not in matched
+         for i, item in enumerate(estimated) if i not in used),
+        reverse=True,
+    )
+    for similarity, f, i in pairs:
+        if similarity < threshold:
+            break
+        if features[f] in matched or i in used:
+            continue
+        matched[features[f]] = estimated[i]
+        used.add(i)
+    return matched, [item for i, item in enumerate(estimated) if i not in used]
+
+
+# Brainstorm estimates per (feature text, context hash, model), so an edited
+# feature list only sends the new or changed features back to the models
+class FeatureEstimateStore:
+
+    def __init__(self, path = FEATURE_STORE_PATH, ttl = FEATURE_STORE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self.db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS feature_estimates ("
+                "key TEXT PRIMARY KEY, model TEXT, feature TEXT, estimate TEXT, created_at REAL)"
+            )
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def key(feature, context, model):
+        return hashlib.sha256(f"{context}\0{model}\0{normalize_feature(feature)}".encode("utf-8")).hexdigest()
+
+    def _get_many(self, context, model, features):
+        keys = {self.key(feature, context, model): feature for feature in features}
+        found = {}
+        with self.lock:
+            db = self._connect()
+            key_list = list(keys)
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = db.execute(
+                    f"SELECT key, estimate FROM feature_estimates WHERE created_at > ? AND key IN ({','.join('?' * len(chunk))})",
+                    [time.time() - self.ttl, *chunk],
+                ).fetchall()
+                found.update({keys[key]: json.loads(estimate) for key, estimate in rows})
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def _set_many(self, context, model, estimates):
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO feature_estimates (key, model, feature, estimate, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(self.key(feature, context, model), model, feature, json.dumps(estimate), now)
+                 for feature, estimate in estimates.items()],
+            )
+            db.execute("DELETE FROM feature_estimates WHERE created_at <= ?", (now - self.ttl,))
+            db.commit()
+
+    # {feature: stored estimate} of one model
+    async def get_many(self, context, model, features):
+        return await asyncio.to_thread(self._get_many, context, model, features)
+
+    async def set_many(self, context, model, estimates):
+        if estimates:
+            await asyncio.to_thread(self._set_many, context, model, estimates)
+
+    def stats(self):
+        with self.lock:
+            rows = self._connect().execute("SELECT model, COUNT(*) FROM feature_estimates GROUP BY model").fetchall()
+            return {"hits": self.hits, "misses": self.misses, "entries": dict(rows)}
+
+
+feature_store = FeatureEstimateStore()
@@ -0,0 +1,371 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from ai.attachments import PreparedAttachments, PreparedFile
+from ai.pipeline_context import PipelineContext
+
+# Job queue settings
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "cache/jobs.sqlite3")
+JOB_FILES_DIR = os.getenv("JOB_FILES_DIR", "cache/jobs")
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))                  # jobs one worker pool runs at once
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))            # seconds between claims when idle
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "2"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "30"))               # no heartbeat for this long = worker lost
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_WATCH_GRACE = float(os.getenv("JOB_WATCH_GRACE", "15"))               # seconds without a watcher = nobody waiting
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))     # finished jobs are kept this long
+
+FINISHED = ("completed", "failed", "cancelled")
+
+
+# Estimation jobs and their progress events in SQLite, so any API process can
+# queue, watch and cancel a job and any worker process can run it. Events are
+# numbered per job; a client that lost its stream asks for the ones after the
+# last number it saw.
+class JobQueue:
+
+    def __init__(self, path = JOB_QUEUE_PATH, files_dir = JOB_FILES_DIR):
+        self.path = path
+        self.files_dir = files_dir
+        self.db_lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " params TEXT NOT NULL,"
+                " files TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL,"
+                " worker TEXT,"
+                " heartbeat_at REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " watched_at REAL NOT NULL,"
+                " last_seq INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT,"
+                " error TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                " job_id TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " event TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (job_id, seq))"
+            )
+            self._db = db
+        return self._db
+
+    # Run `fn(db)` inside one write transaction
+    def _write(self, fn):
+        with self.db_lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(db)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return result
+
+    def _append(self, db, job_id, event):
+        seq = db.execute("UPDATE jobs SET last_seq = last_seq + 1 WHERE id = ? RETURNING last_seq", (job_id,)).fetchone()[0]
+        db.execute("INSERT INTO job_events (job_id, seq, event, created_at) VALUES (?, ?, ?, ?)",
+                   (job_id, seq, json.dumps(event), time.time()))
+        return seq
+
+    # Keep the spooled uploads in the job folder and queue the job
+    def create(self, params, uploads = (), cancel_requested = False):
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.files_dir, job_id)
+        files = []
+        for i, upload in enumerate(uploads):
+            os.makedirs(job_dir, exist_ok=True)
+            path = os.path.join(job_dir, f"{i}{os.path.splitext(upload.name or '')[1]}")
+            upload.owned = False    # the job folder owns the file from here on
+            upload.close()
+            shutil.move(upload.path, path)
+            files.append({"name": upload.name, "mime": upload.mime, "path": path,
+                          "sha256": upload.sha256, "size": upload.size})
+
+        now = time.time()
+
+        def insert(db):
+            db.execute(
+                "INSERT INTO jobs (id, status, params, files, created_at, cancel_requested, watched_at) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(params), json.dumps(files), now, int(cancel_requested), now),
+            )
+            self._append(db, job_id, {"status": "queued", "percent": 0, "message": "Waiting for a worker..."})
+
+        self._write(insert)
+        self._prune()
+        return job_id
+
+    # Next queued job for `worker` (jobs of lost workers go back to the queue first)
+    def claim(self, worker):
+        now = time.time()
+        released = []
+
+        def take(db):
+            stale = db.execute(
+                "SELECT id, attempts FROM jobs WHERE status = 'running' AND heartbeat_at < ?", (now - JOB_STALE_AFTER,)
+            ).fetchall()
+            for job_id, attempts in stale:
+                if attempts >= JOB_MAX_ATTEMPTS:
+                    message = f"Job failed: its worker was lost {attempts} times"
+                    db.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?", (now, message, job_id))
+                    self._append(db, job_id, {"status": "error", "message": message})
+                    released.append(job_id)
+                else:
+                    db.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ?", (job_id,))
+                    self._append(db, job_id, {"status": "queued", "percent": 0, "message": "Worker lost, job queued again..."})
+
+            while True:
+                row = db.execute(
+                    "SELECT id, params, files, cancel_requested, watched_at FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, params, files, cancel_requested, watched_at = row
+                # Nobody is waiting for it any more
+                if cancel_requested and watched_at < now - JOB_WATCH_GRACE:
+                    db.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ?", (now, job_id))
+                    self._append(db, job_id, {"status": "cancelled", "message": "Job cancelled"})
+                    released.append(job_id)
+                    continue
+                db.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now, now, job_id),
+                )
+                return {"id": job_id, "params": json.loads(params), "files": json.loads(files)}
+
+        job = self._write(take)
+        for job_id in released:
+            self._remove_files(job_id)
+        return job
+
+    def append_event(self, job_id, event):
+        return self._write(lambda db: self._append(db, job_id, event))
+
+    # Worker is alive; True when the job should be cancelled (requested and nobody watching)
+    def heartbeat(self, job_id, worker):
+        now = time.time()
+
+        def beat(db):
+            db.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ?", (now, job_id, worker))
+            row = db.execute("SELECT cancel_requested, watched_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return bool(row and row[0] and row[1] < now - JOB_WATCH_GRACE)
+
+        return self._write(beat)
+
+    def finish(self, job_id, status, event, result = None, error = None):
+        def done(db):
+            db.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE id = ?",
+                (status, time.time(), json.dumps(result) if result is not None else None, error, job_id),
+            )
+            self._append(db, job_id, event)
+
+        self._write(done)
+        self._remove_files(job_id)
+
+    # Put a job back in the queue (worker shutting down), the attempt does not count
+    def release(self, job_id):
+        def back(db):
+            db.execute("UPDATE jobs SET status = 'queued', worker = NULL, attempts = MAX(attempts - 1, 0) WHERE id = ? AND status = 'running'",
+                       (job_id,))
+            self._append(db, job_id, {"status": "queued", "percent": 0, "message": "Worker restarting, job queued again..."})
+
+        self._write(back)
+
+    # Somebody is waiting for this job (stream open or polling)
+    def touch(self, job_id):
+        self._write(lambda db: db.execute("UPDATE jobs SET watched_at = ? WHERE id = ?", (time.time(), job_id)))
+
+    # The job stops once nobody watches it any more
+    def request_cancel(self, job_id):
+        def request(db):
+            return db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status NOT IN (?, ?, ?)",
+                              (job_id, *FINISHED)).rowcount
+
+        return bool(self._write(request))
+
+    def get(self, job_id):
+        with self.db_lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT id, status, params, files, created_at, started_at, finished_at, attempts, cancel_requested, last_seq, result, error "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            last_event = db.execute("SELECT event FROM job_events WHERE job_id = ? AND seq = ?", (job_id, row[9])).fetchone()
+        params = json.loads(row[2])
+        return {
+            "job_id": row[0],
+            "status": row[1],
+            "models": {"openai": params.get("openai_models"), "gemini": params.get("gemini_models")},
+            "files": [f["name"] for f in json.loads(row[3])],
+            "created_at": row[4],
+            "started_at": row[5],
+            "finished_at": row[6],
+            "attempts": row[7],
+            "cancel_requested": bool(row[8]),
+            "last_seq": row[9],
+            "last_event": json.loads(last_event[0]) if last_event else None,
+            "result": json.loads(row[10]) if row[10] else None,
+            "error": row[11],
+        }
+
+    # (status, [(seq, event)]) of the events after `after`
+    def events(self, job_id, after = 0, limit = 500):
+        with self.db_lock:
+            db = self._connect()
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None, []
+            rows = db.execute(
+                "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?", (job_id, after, limit)
+            ).fetchall()
+        return row[0], [(seq, json.loads(event)) for seq, event in rows]
+
+    def _remove_files(self, job_id):
+        shutil.rmtree(os.path.join(self.files_dir, job_id), ignore_errors=True)
+
+    # Forget jobs finished a long time ago
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+
+        def prune(db):
+            ids = [row[0] for row in db.execute("SELECT id FROM jobs WHERE status IN (?, ?, ?) AND finished_at < ?", (*FINISHED, cutoff))]
+            for job_id in ids:
+                db.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            return ids
+
+        for job_id in self._write(prune):
+            self._remove_files(job_id)
+
+
+# Runs queued jobs through the estimation pipeline, `concurrency` at a time.
+# Runs inside the API processes or on its own (job_worker.py).
+class JobWorker:
+
+    def __init__(self, queue, pipeline, concurrency = JOB_CONCURRENCY, name = None):
+        self.queue = queue
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks = []
+        self.running = {}   # job_id -> pipeline task
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._loop(f"{self.name}:{i}")) for i in range(self.concurrency)]
+
+    # Stop claiming; running jobs go back to the queue for another worker
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _loop(self, worker):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim, worker)
+            except Exception as e:
+                print(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            await self.run(job, worker)
+
+    async def run(self, job, worker):
+        job_id = job["id"]
+        params = job["params"]
+        print(f"Job {job_id} started on {worker}...")
+
+        files = [PreparedFile(f["name"], f.get("mime"), path=f["path"], sha256=f["sha256"], size=f["size"])
+                 for f in job["files"]]
+        file_list = PreparedAttachments.from_uploads(files, mode=params.get("file_mode"))
+        context = PipelineContext(request_id=job_id, use_cache=params.get("use_cache", True),
+                                  quorum=params.get("quorum"), stage_deadline=params.get("stage_deadline"))
+        outcome = {}
+
+        async def run_pipeline():
+            async for event in self.pipeline.run(
+                details=params.get("details"),
+                file_list=file_list,
+                openai_models=params.get("openai_models"),
+                gemini_models=params.get("gemini_models"),
+                use_cache=params.get("use_cache", True),
+                quorum=params.get("quorum"),
+                stage_deadline=params.get("stage_deadline"),
+                final_mode=params.get("final_mode"),
+                context=context,
+                features=params.get("features"),
+            ):
+                # The last event is stored with the final job status
+                if event.get("status") in ("complete", "error"):
+                    outcome["event"] = event
+                    return
+                await asyncio.to_thread(self.queue.append_event, job_id, event)
+
+        task = asyncio.create_task(run_pipeline())
+        self.running[job_id] = task
+        try:
+            while not task.done():
+                await asyncio.wait([task], timeout=JOB_HEARTBEAT_INTERVAL)
+                if not task.done() and await asyncio.to_thread(self.queue.heartbeat, job_id, worker):
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    await asyncio.to_thread(self.queue.finish, job_id, "cancelled",
+                                            {"status": "cancelled", "message": "Job cancelled"})
+                    print(f"Job {job_id} cancelled, nobody was waiting for it...")
+                    return
+
+            error = task.exception()
+            event = outcome.get("event")
+            if error is not None:
+                event = {"status": "error", "message": str(error) or error.__class__.__name__}
+            elif event is None:
+                event = {"status": "error", "message": "Estimation ended without a result"}
+
+            if event["status"] == "complete":
+                await asyncio.to_thread(self.queue.finish, job_id, "completed", event, result=event.get("data"))
+            else:
+                await asyncio.to_thread(self.queue.finish, job_id, "failed", event, error=event.get("message"))
+            print(f"Job {job_id} {event['status']}...")
+        except asyncio.CancelledError:
+            # Worker shutting down: another worker picks the job up again
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await asyncio.to_thread(self.queue.release, job_id)
+            raise
+        finally:
+            self.running.pop(job_id, None)
+            await file_list.release()
+
+
+# Shared instance used by the API and the workers
+job_queue = JobQueue()
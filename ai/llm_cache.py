@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cache settings
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "cache/llm_cache.sqlite3")
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "256"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))   # seconds
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+# Two tier (memory LRU + SQLite) cache of LLM responses keyed by their full input
+class LLMCache:
+
+    def __init__(self, path = LLM_CACHE_PATH, memory_items = LLM_CACHE_MEMORY_ITEMS,
+                 ttl = LLM_CACHE_TTL, max_bytes = LLM_CACHE_MAX_BYTES, enabled = LLM_CACHE_ENABLED):
+        self.path = path
+        self.memory_items = memory_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+        self.memory = OrderedDict()     # key -> (expires_at, json payload)
+        self.lock = threading.Lock()      # memory tier + counters
+        self.db_lock = threading.Lock()   # sqlite connection
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._db = None
+
+    # Content addressed key over everything that changes the answer
+    def make_key(self, provider, model, system_prompt, user_prompt, file_digests, output_structure):
+        digest = hashlib.sha256()
+        schema = output_structure.model_json_schema() if output_structure is not None else None
+        parts = {
+            "provider": provider,
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "files": list(file_digests or []),
+            "schema": schema,
+        }
+        digest.update(json.dumps(parts, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    async def get(self, key):
+        if not self.enabled:
+            return None
+
+        # 1. Memory tier
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at > time.time():
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return json.loads(payload)
+                del self.memory[key]
+
+        # 2. Disk tier
+        entry = await asyncio.to_thread(self._disk_get, key)
+        if entry is None:
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+
+        expires_at, payload = entry
+        with self.lock:
+            self.counters["disk_hits"] += 1
+            self._remember(key, expires_at, payload)
+        return json.loads(payload)
+
+    async def set(self, key, value):
+        if not self.enabled or value is None:
+            return
+        # Stored as JSON so callers never share (and mutate) the cached object
+        payload = json.dumps(value)
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self.counters["writes"] += 1
+            self._remember(key, expires_at, payload)
+        await asyncio.to_thread(self._disk_set, key, expires_at, payload)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            memory_entries = len(self.memory)
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        return {
+            **counters,
+            "hit_ratio": (hits / lookups) if lookups else 0.0,
+            "memory_entries": memory_entries,
+            "enabled": self.enabled,
+        }
+
+    # Add to the memory tier and drop the least recently used entries
+    def _remember(self, key, expires_at, payload):
+        self.memory[key] = (expires_at, payload)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _connect(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _disk_get(self, key):
+        with self.db_lock:
+            db = self._connect()
+            row = db.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at <= time.time():
+                db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+        return expires_at, value
+
+    def _disk_set(self, key, expires_at, payload):
+        now = time.time()
+        with self.db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), expires_at, now),
+            )
+            removed = self._evict(db, now)
+            db.commit()
+        with self.lock:
+            self.counters["evictions"] += removed
+
+    # Drop expired rows, then the least recently used ones until under the size limit
+    def _evict(self, db, now):
+        removed = db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,)).rowcount
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > self.max_bytes:
+            rows = db.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at").fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            db.executemany("DELETE FROM llm_cache WHERE key = ?", stale)
+            removed += len(stale)
+        return removed
+
+
+# Shared instance used by the model calls
+llm_cache = LLMCache()
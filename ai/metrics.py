@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+
+# Prometheus metrics settings. Every process (gunicorn workers, job_worker.py)
+# adds its counts to one SQLite file, so /metrics on any worker shows the totals.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PATH = os.getenv("METRICS_PATH", "cache/metrics.sqlite3")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))    # seconds between writes of a process
+METRICS_PREFIX = "estimator_"
+
+# Latency buckets (seconds) of the histograms
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+# Estimated USD per 1M tokens: (input, cached input, output). MODEL_PRICES (JSON,
+# same shape) adds or overrides models; unknown models count tokens but no cost.
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-5": (1.25, 0.125, 10.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5.1": (1.25, 0.125, 10.00),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-2.5-flash": (0.30, 0.03, 2.50),
+    "gemini-flash-latest": (0.30, 0.03, 2.50),
+    "gemini-2.5-pro": (1.25, 0.125, 10.00),
+    "gemini-3-pro-preview": (2.00, 0.20, 12.00),
+}
+MODEL_PRICES.update({model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES", "{}")).items()})
+
+# name -> (type, help, buckets)
+METRICS = {
+    "stage_duration_seconds": ("histogram", "Duration of the /submit stages", DURATION_BUCKETS),
+    "stage_errors_total": ("counter", "Failed /submit stages", None),
+    "stage_tokens_total": ("counter", "LLM tokens used by the /submit stages", None),
+    "stage_cost_usd_total": ("counter", "Estimated LLM cost of the /submit stages in USD", None),
+    "estimations_total": ("counter", "Finished estimations by outcome", None),
+    "llm_call_duration_seconds": ("histogram", "Duration of the LLM calls", DURATION_BUCKETS),
+    "llm_tokens_total": ("counter", "LLM tokens by provider, model and kind (input, cached, output)", None),
+    "llm_cost_usd_total": ("counter", "Estimated LLM cost in USD", None),
+    "llm_cached_responses_total": ("counter", "LLM calls answered from the response cache", None),
+    "llm_errors_total": ("counter", "Failed LLM call attempts", None),
+}
+
+
+# Estimated USD of one call; cached input tokens are billed at the cached price
+def estimate_cost(model, input_tokens, cached_tokens, output_tokens):
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return 0.0
+    return ((input_tokens - cached_tokens) * price[0] + cached_tokens * price[1] + output_tokens * price[2]) / 1_000_000
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}" if labels else ""
+
+
+# Every bucket (ascending, then +Inf), _sum and _count of each label set of a
+# histogram. Only the buckets an observation fell into are stored, the others are 0.
+def _histogram_samples(name, buckets, samples):
+    values = defaultdict(dict)    # labels without le -> series / bound -> value
+    for series, labels, value in samples:
+        le = dict(labels).get("le")
+        key = tuple(tuple(label) for label in labels if label[0] != "le")
+        values[key][le if series == f"{name}_bucket" else series] = value
+
+    result = []
+    for key in sorted(values):
+        found = values[key]
+        for le in [str(le) for le in buckets] + ["+Inf"]:
+            labels = sorted([*key, ("le", le)])
+            result.append((f"{name}_bucket", labels, found.get(le, 0)))
+        for series in (f"{name}_sum", f"{name}_count"):
+            result.append((series, list(key), found.get(series, 0)))
+    return result
+
+
+# Counters and histograms kept in memory per process and added to the shared
+# SQLite totals every few seconds (and before every scrape)
+class Metrics:
+
+    def __init__(self, path = METRICS_PATH, flush_interval = METRICS_FLUSH_INTERVAL, enabled = METRICS_ENABLED):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.lock = threading.Lock()        # pending deltas only, never held during disk I/O
+        self.db_lock = threading.Lock()     # sqlite connection
+        self.pending = defaultdict(float)   # (series, labels json) -> delta
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metrics ("
+                "series TEXT, labels TEXT, value REAL, PRIMARY KEY (series, labels))"
+            )
+            self.db.commit()
+        return self.db
+
+    def _add(self, series, labels, value):
+        key = (series, json.dumps(sorted(labels.items())))
+        with self.lock:
+            self.pending[key] += value
+
+    def inc(self, name, value = 1, **labels):
+        if self.enabled and value:
+            self._add(name, labels, value)
+
+    # Cumulative buckets, sum and count, as Prometheus expects them
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = METRICS[name][2]
+        with self.lock:
+            for le in buckets:
+                if value <= le:
+                    self.pending[(f"{name}_bucket", json.dumps(sorted({**labels, "le": str(le)}.items())))] += 1
+            self.pending[(f"{name}_bucket", json.dumps(sorted({**labels, "le": "+Inf"}.items())))] += 1
+            self.pending[(f"{name}_sum", json.dumps(sorted(labels.items())))] += value
+            self.pending[(f"{name}_count", json.dumps(sorted(labels.items())))] += 1
+
+    # Tokens, cost and latency of one LLM call (not for cached responses)
+    def record_llm_call(self, provider, model, tokens, latency):
+        labels = {"provider": provider, "model": model}
+        self.observe("llm_call_duration_seconds", latency, **labels)
+        self.inc("llm_tokens_total", tokens["input_tokens"], kind="input", **labels)
+        self.inc("llm_tokens_total", tokens["cached_tokens"], kind="cached", **labels)
+        self.inc("llm_tokens_total", tokens["output_tokens"], kind="output", **labels)
+        self.inc("llm_cost_usd_total", estimate_cost(model, tokens["input_tokens"], tokens["cached_tokens"],
+                                                     tokens["output_tokens"]), **labels)
+
+    # Write the pending deltas of this process to the shared totals. Only the swap
+    # of the pending deltas holds `lock`, so recording never waits for the disk.
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(float)
+        if not pending:
+            return
+        try:
+            with self.db_lock:
+                db = self._connect()
+                with db:
+                    db.executemany(
+                        "INSERT INTO metrics (series, labels, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (series, labels) DO UPDATE SET value = value + excluded.value",
+                        [(series, labels, value) for (series, labels), value in pending.items()],
+                    )
+        except sqlite3.Error as e:
+            # Keep the counts for the next flush
+            print(f"Metrics flush failed: {e!r}")
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending[key] += value
+
+    def _read(self):
+        self.flush()
+        with self.db_lock:
+            return self._connect().execute("SELECT series, labels, value FROM metrics ORDER BY series, labels").fetchall()
+
+    # Totals of all processes in the Prometheus text format
+    async def render(self):
+        rows = await asyncio.to_thread(self._read)
+        by_name = defaultdict(list)
+        for series, labels, value in rows:
+            name = series
+            for suffix in ("_bucket", "_sum", "_count"):
+                if series.endswith(suffix) and series[:-len(suffix)] in METRICS:
+                    name = series[:-len(suffix)]
+            by_name[name].append((series, json.loads(labels), value))
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+            samples = by_name.get(name, [])
+            if kind == "histogram":
+                samples = _histogram_samples(name, buckets, samples)
+            for series, labels, value in samples:
+                lines.append(f"{METRICS_PREFIX}{series}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    # Flush every few seconds until cancelled (one task per process)
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await asyncio.to_thread(self.flush)
+        finally:
+            self.flush()
+
+
+metrics = Metrics()
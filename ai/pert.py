@@ -0,0 +1,266 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Simulation settings
+PERT_SAMPLES = int(os.getenv("PERT_SAMPLES", "100000"))
+PERT_MAX_SAMPLES = int(os.getenv("PERT_MAX_SAMPLES", "1000000"))
+PERT_SEED = int(os.getenv("PERT_SEED", "0"))         # fixed seed: the same estimate always gives the same range
+PERT_CACHE_ITEMS = int(os.getenv("PERT_CACHE_ITEMS", "64"))
+PERCENTILES = (50, 80, 95)
+OVERHEADS = ("qa", "uat", "devops", "critical")
+
+# Beta-PERT sampling by inverse CDF lookup. The shape of a beta-PERT only depends on
+# where the mode sits between min and max, so the mode position is rounded to one
+# of SHAPE_LEVELS values and each shape gets a table of QUANTILE_LEVELS quantiles.
+# A draw is then one random index into a table: much cheaper than numpy's beta().
+# The 12 bit indexes are cut five at a time out of raw 64 bit random words.
+SHAPE_LEVELS = 101
+QUANTILE_BITS = 12
+QUANTILE_LEVELS = 1 << QUANTILE_BITS
+INDEXES_PER_WORD = 64 // QUANTILE_BITS
+TASK_CHUNK = 4          # tasks drawn at once (keeps the temporary arrays in cache)
+
+
+def _quantile_tables(grid = 8192):
+    x = (np.arange(grid) + 0.5) / grid
+    position = np.linspace(0, 1, SHAPE_LEVELS)
+    alpha = 1 + 4 * position
+    beta = 1 + 4 * (1 - position)
+    log_pdf = (alpha[:, None] - 1) * np.log(x) + (beta[:, None] - 1) * np.log1p(-x)
+    pdf = np.exp(log_pdf - log_pdf.max(axis=1, keepdims=True))
+    cdf = np.cumsum(pdf, axis=1)
+    cdf /= cdf[:, -1:]
+    probabilities = (np.arange(QUANTILE_LEVELS) + 0.5) / QUANTILE_LEVELS
+    edges = np.concatenate([[0.0], x + 0.5 / grid])
+    tables = [np.interp(probabilities, np.concatenate([[0.0], row]), edges) for row in cdf]
+    return np.asarray(tables, dtype=np.float32).ravel()
+
+
+# One row of quantiles per shape, flattened for np.take
+_tables = _quantile_tables()
+_shifts = np.arange(INDEXES_PER_WORD, dtype=np.uint64) * np.uint64(QUANTILE_BITS)
+
+
+# Random table indexes of the `chunk`-th TASK_CHUNK tasks, shaped (TASK_CHUNK, samples).
+# Every chunk has its own stream, so the draws of a task do not depend on how many
+# tasks are simulated along with it.
+def _chunk_indexes(seed, chunk, samples):
+    count = TASK_CHUNK * samples
+    words = np.random.PCG64([seed, chunk]).random_raw(-(-count // INDEXES_PER_WORD))
+    indexes = words[None, :] >> _shifts[:, None]
+    indexes &= np.uint64(QUANTILE_LEVELS - 1)
+    return indexes.view(np.int64).ravel()[:count].reshape(TASK_CHUNK, samples)
+
+
+# Leaf tasks of an estimate: the breakdown items of a feature when it has them,
+# otherwise the feature itself. Returns (low, mode, high, group) arrays.
+def estimate_tasks(estimate):
+    features = estimate.get("features", []) if isinstance(estimate, dict) else estimate.features
+    low, mode, high, groups = [], [], [], []
+    for feature in features:
+        feature = feature if isinstance(feature, dict) else feature.model_dump(mode="json")
+        group = str(feature.get("type") or "Backend")
+        for task in feature.get("breakdown") or [feature]:
+            values = sorted([task["optimistic"], task["most_likely"], task["pessimistic"]])
+            # Out of order values (e.g. optimistic > pessimistic) are put back in order
+            most_likely = min(max(task["most_likely"], values[0]), values[2])
+            low.append(values[0])
+            mode.append(most_likely)
+            high.append(values[2])
+            groups.append(group)
+    return (np.asarray(low, dtype=np.float64), np.asarray(mode, dtype=np.float64),
+            np.asarray(high, dtype=np.float64), np.asarray(groups))
+
+
+# Development hours per sample of several estimates: yields (total, {group: values})
+# for each, in order. The i-th ranged task of every estimate uses the same random
+# indexes (common random numbers: scenarios differ by their tasks, not by noise),
+# so the indexes are drawn once for all estimates.
+def simulate_many(task_sets, samples = PERT_SAMPLES, seed = PERT_SEED):
+    plans = []
+    for low, mode, high, groups in task_sets:
+        spread = high - low
+        position = np.divide(mode - low, spread, out=np.zeros_like(spread), where=spread > 0)
+        # Only tasks with a range need random draws
+        ranged = np.flatnonzero(spread > 0)
+        offsets = (np.rint(position[ranged] * (SHAPE_LEVELS - 1)).astype(np.int64) * QUANTILE_LEVELS)[:, None]
+        names = sorted(set(groups.tolist()))
+        # One row per group, so a single product sums the draws of every group
+        weights = np.zeros((len(names), len(ranged)), dtype=np.float32)
+        for row, name in enumerate(names):
+            members = groups[ranged] == name
+            weights[row, members] = spread[ranged][members]
+        plans.append((offsets, weights, np.zeros((len(names), samples), dtype=np.float32)))
+
+    rows = max((len(offsets) for offsets, _, _ in plans), default=0)
+    for start in range(0, rows, TASK_CHUNK):
+        indexes = _chunk_indexes(seed, start // TASK_CHUNK, samples)
+        users = [plan for plan in plans if len(plan[0]) > start]
+        for i, (offsets, weights, sums) in enumerate(users):
+            chunk = slice(start, start + TASK_CHUNK)
+            size = len(offsets[chunk])
+            if i == len(users) - 1:
+                # Last user of the chunk: shift the indexes in place
+                index = indexes[:size]
+                index += offsets[chunk]
+            else:
+                index = indexes[:size] + offsets[chunk]
+            sums += weights[:, chunk] @ np.take(_tables, index)
+
+    for (low, mode, high, groups), (_, _, sums) in zip(task_sets, plans):
+        names = sorted(set(groups.tolist()))
+        by_group = {name: np.add(sums[row], low[groups == name].sum(), dtype=np.float64) for row, name in enumerate(names)}
+        total = np.zeros(samples, dtype=np.float64)
+        for values in by_group.values():
+            total += values
+        yield total, by_group
+
+
+# Development hours per sample of one estimate: the total and one array per group
+def simulate(low, mode, high, groups, samples = PERT_SAMPLES, seed = PERT_SEED):
+    return next(simulate_many([(low, mode, high, groups)], samples, seed))
+
+
+# Percentiles (linear interpolation, as np.percentile) and mean of the samples.
+# Partitions `values` in place: the samples are not used afterwards.
+def _stats(values):
+    mean = float(values.mean())
+    position = np.asarray(PERCENTILES) / 100 * (len(values) - 1)
+    below = np.floor(position).astype(np.int64)
+    above = np.minimum(below + 1, len(values) - 1)
+    values.partition(np.unique(np.concatenate([below, above])))
+    points = values[below] + (values[above] - values[below]) * (position - below)
+    stats = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, points)}
+    stats["mean"] = round(mean, 2)
+    return stats
+
+
+def _tasks_key(low, mode, high, groups, samples, seed):
+    digest = hashlib.sha256()
+    for array in (low, mode, high):
+        digest.update(array.tobytes())
+    digest.update("\0".join(groups.tolist()).encode("utf-8"))
+    digest.update(f"{samples}:{seed}".encode())
+    return digest.hexdigest()
+
+
+# Simulation statistics of estimates, cached by their leaf tasks
+class PertEngine:
+
+    def __init__(self, cache_items = PERT_CACHE_ITEMS):
+        self.cache_items = cache_items
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Stats of every task set in `task_sets`; the ones not cached are simulated together
+    def development_stats_many(self, task_sets, samples, seed):
+        keys = [_tasks_key(*tasks, samples, seed) for tasks in task_sets]
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    found[key] = self.cache[key]
+
+        missing = {key: tasks for key, tasks in zip(keys, task_sets) if key not in found and len(tasks[0])}
+        for key, (total, by_group) in zip(missing, simulate_many(list(missing.values()), samples, seed)):
+            found[key] = {"development": _stats(total), "rollups": {name: _stats(values) for name, values in by_group.items()}}
+        for key, (low, mode, high, groups) in zip(keys, task_sets):
+            if key not in found:
+                found[key] = {"development": _stats(np.zeros(1)), "rollups": {}}
+            found[key].setdefault("pert", float(((low + 4 * mode + high) / 6).sum()))
+
+        with self.lock:
+            for key in keys:
+                self.cache[key] = found[key]
+            while len(self.cache) > self.cache_items:
+                self.cache.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def development_stats(self, low, mode, high, groups, samples, seed):
+        return self.development_stats_many([(low, mode, high, groups)], samples, seed)[0]
+
+    # One scenario: the classic PERT summary plus P50/P80/P95 with the overheads applied.
+    # Overheads are percentages of the development hours, so every percentile of the
+    # total is the development percentile times the same factor. `stats` skips the
+    # lookup when the development stats were already computed (in a batch).
+    def scenario(self, tasks, percentages, samples = PERT_SAMPLES, seed = PERT_SEED, name = None, stats = None):
+        stats = stats or self.development_stats(*tasks, samples, seed)
+        shares = {overhead: percentages.get(overhead, 0) / 100 for overhead in OVERHEADS}
+        factor = 1 + sum(shares.values())
+        pert = stats["pert"]
+
+        def with_overheads(development):
+            return {
+                key: {"development": value, **{o: round(value * s, 2) for o, s in shares.items()},
+                      "total": round(value * factor, 2)}
+                for key, value in development.items()
+            }
+
+        return {
+            "name": name,
+            "percentages": {overhead: percentages.get(overhead, 0) for overhead in OVERHEADS},
+            "pert": pert,
+            **{overhead: pert * share for overhead, share in shares.items()},
+            "total": pert * factor,
+            "percentiles": with_overheads(stats["development"]),
+            "rollups": {group: with_overheads(values) for group, values in stats["rollups"].items()},
+        }
+
+
+# Three-point totals as a single task (when no full estimate is sent)
+def totals_tasks(optimistic, most_likely, pessimistic, group = "Total"):
+    estimate = {"features": [{"type": group, "optimistic": optimistic, "most_likely": most_likely,
+                              "pessimistic": pessimistic, "breakdown": []}]}
+    return estimate_tasks(estimate)
+
+
+pert_engine = PertEngine()
+
+
+# Summary of a Summary_calculation request, with one entry per scenario
+def calculate_summary(data):
+    started = time.perf_counter()
+    samples = max(1000, min(data.samples or PERT_SAMPLES, PERT_MAX_SAMPLES))
+    seed = PERT_SEED if data.seed is None else data.seed
+
+    if data.estimate is not None:
+        tasks = estimate_tasks(data.estimate)
+    else:
+        tasks = totals_tasks(data.total_optimistic, data.total_most_likely, data.total_pessimistic)
+    percentages = {overhead: getattr(data, f"{overhead}_percentage") for overhead in OVERHEADS}
+
+    items = []
+    for i, scenario in enumerate(data.scenarios or []):
+        scenario_tasks = estimate_tasks(scenario.estimate) if scenario.estimate is not None else tasks
+        scenario_percentages = {
+            overhead: getattr(scenario, f"{overhead}_percentage") if getattr(scenario, f"{overhead}_percentage") is not None
+            else percentages[overhead]
+            for overhead in OVERHEADS
+        }
+        items.append((scenario_tasks, scenario_percentages, scenario.name or f"Scenario {i + 1}"))
+
+    # The base estimate and every scenario are simulated in one pass
+    stats = pert_engine.development_stats_many([tasks] + [item[0] for item in items], samples, seed)
+    summary = pert_engine.scenario(tasks, percentages, samples, seed, stats=stats[0])
+    scenarios = [pert_engine.scenario(scenario_tasks, scenario_percentages, samples, seed, name=name, stats=scenario_stats)
+                 for (scenario_tasks, scenario_percentages, name), scenario_stats in zip(items, stats[1:])]
+
+    return {
+        # Same keys as the plain PERT summary
+        "qa": summary["qa"],
+        "uat": summary["uat"],
+        "devops": summary["devops"],
+        "critical": summary["critical"],
+        "total": summary["total"],
+        "pert": summary["pert"],
+        "percentiles": summary["percentiles"],
+        "rollups": summary["rollups"],
+        "scenarios": scenarios,
+        "samples": samples,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import time
+from ai.pipeline_context import PipelineContext
+from ai.stage_graph import Stage, StageGraph, StageError
+from ai.feature_store import feature_store, context_hash, match_features
+from ai.metrics import metrics
+
+# Seconds brainstorming waits for the historical estimates / baseline once the features are ready
+BRAINSTORM_CONTEXT_WAIT = float(os.getenv("BRAINSTORM_CONTEXT_WAIT", "10"))
+
+
+# Brainstorm results for a reviewed feature list: each model's fresh estimates of
+# `to_estimate` plus its stored estimates of the other features, in the order of
+# `feature_list`. Features a model added on its own are dropped, the reviewed list
+# is the scope. Returns the results and the fresh estimates to store, {model: {feature: estimate}}.
+def merge_stored_estimates(models, results, stored, feature_list, to_estimate):
+    if not to_estimate:
+        merged = [{"model": model, "response": {"features": [stored[model][feature] for feature in feature_list]}}
+                  for model in models]
+        for i, entry in enumerate(merged):
+            entry["Result"] = f"{chr(ord('A') + i)}"
+        return merged, {}
+
+    merged = []
+    fresh = {}
+    for entry in results:
+        model = entry["model"]
+        response = entry["response"] or {}
+        fresh[model], _ = match_features(to_estimate, response.get("features", []))
+        features = [fresh[model].get(feature) or stored[model].get(feature) for feature in feature_list]
+        merged.append({**entry, "response": {**response, "features": [feature for feature in features if feature]}})
+    return merged, fresh
+
+
+# The /submit estimation as a graph of stages:
+#   files -> features -> baseline          (features: the reviewed list when one is given)
+#   files -> project_type -> retrieval
+#   brainstorm <- files, features (+ retrieval and baseline if they are ready in time)
+#   ranking <- brainstorm, retrieval
+#   final <- ranking, retrieval
+class EstimationPipeline:
+
+    def __init__(self, ai_process, vector_db, baseline_estimator):
+        self.ai_process = ai_process
+        self.vector_db = vector_db
+        self.baseline_estimator = baseline_estimator
+
+    # Progress / result events (dicts) of one estimation
+    async def run(self, details, file_list, openai_models = None, gemini_models = None, use_cache = True,
+                  quorum = None, stage_deadline = None, final_mode = None, context = None, features = None):
+        ai_process = self.ai_process
+        context = context or PipelineContext(use_cache=use_cache, quorum=quorum, stage_deadline=stage_deadline)
+        reviewed_features = [str(feature).strip() for feature in features or [] if str(feature).strip()]
+
+        started = time.perf_counter()
+        yield {"status": "progress", "percent": 5, "message": "Validating request..."}
+        context.metadata.setdefault("stages", {})["validation"] = {"duration": round(time.perf_counter() - started, 3)}
+        if not openai_models and not gemini_models:
+            self.report_metrics(context, "invalid", "validation")
+            yield {"status": "error", "message": "Select at least one model"}
+            return
+
+        async def prepare_files(emit):
+            # Encode every file once, shared by all models and stages
+            await file_list.prepare()
+            if not details and not file_list:
+                raise StageError("files", "No input provided")
+            return file_list
+
+        async def extract_features(emit, files):
+            # A reviewed feature list (from /list_features) skips the extraction
+            if reviewed_features:
+                return reviewed_features
+            res = await ai_process.feature_list(user_query=details, file_list=files, use_cache=use_cache,
+                                                usage=context.usage_recorder("features"))
+            if res.get("status") == -1:
+                raise StageError("features", res.get("message"))
+            return res.get("data", {}).get("features", [])
+
+        async def detect_project_type(emit, files):
+            res = await ai_process.predict_project_type(user_query=details, file_list=files, use_cache=use_cache,
+                                                        usage=context.usage_recorder("project_type"))
+            if res.get("status") == -1:
+                raise StageError("project_type", res.get("message"))
+            return res.get("response", {})
+
+        # Instant baseline from historical feature rows (no LLM), also a prior for brainstorming
+        async def estimate_baseline(emit, features):
+            res = await self.baseline_estimator.estimate(features)
+            if res.get("status") != 0:
+                print(f"No baseline: {res.get('message')}")
+                return None
+            baseline = res["data"]["response"]
+            context.metadata["baseline"] = res["data"]
+            total_hours = sum(feature["most_likely"] for feature in baseline["features"])
+            emit({"status": "progress", "percent": 38, "message": f"Baseline from past estimates: ~{total_hours}h",
+                  "stage": "baseline", "data": res["data"]})
+            return baseline
+
+        async def retrieve_estimates(emit, project_type):
+            res = await self.vector_db.query_estimates(
+                query=project_type.get("project_summary"),
+                search_string=project_type.get("technologies_used"),
+                use_cache=use_cache,
+            )
+            if res.get("status") == -1:
+                raise StageError("retrieval", res.get("message"))
+            return res.get("data", {}).get("documents", [])
+
+        models = list(openai_models or []) + list(gemini_models or [])
+
+        # Stored per-feature estimates of a reviewed list: {model: {feature: estimate}}
+        async def stored_estimates(files, feature_list):
+            if not reviewed_features:
+                return None, {}
+            context_key = context_hash(details, files.digests)
+            if not use_cache:
+                return context_key, {model: {} for model in models}
+            found = await asyncio.gather(*(feature_store.get_many(context_key, model, feature_list) for model in models))
+            return context_key, dict(zip(models, found))
+
+        async def brainstorm(emit, files, features, retrieval, baseline):
+            context_key, stored = await stored_estimates(files, features)
+            # Only the features some model has no stored estimate for go to the models
+            to_estimate = [feature for feature in features if any(feature not in stored[model] for model in models)] if stored else features
+            if stored:
+                reused = len(features) - len(to_estimate)
+                context.metadata["feature_reuse"] = {"reused": reused, "estimated": to_estimate}
+                emit({"status": "progress", "percent": 62, "stage": "brainstorm",
+                      "message": f"Reusing stored estimates for {reused} of {len(features)} features"})
+
+            context.brainstorm_results = []
+            # Without a reviewed list the models always brainstorm, even when no feature was extracted
+            if to_estimate or not reviewed_features:
+                # One event per model, as soon as it answers
+                total_models = len(models)
+                done_models = 0
+                async for model_event in ai_process.brainstorm_stage(
+                    user_query=details,
+                    context=context,
+                    file_list=files,
+                    previos_estimations=retrieval,
+                    openai_model_list=openai_models,
+                    gemini_model_list=gemini_models,
+                    feature_list=to_estimate,
+                    baseline=baseline
+                ):
+                    done_models += 1
+                    if model_event.get("skipped"):
+                        message = f"{model_event['model']} skipped (quorum / deadline reached)"
+                    elif "error" in model_event:
+                        message = f"{model_event['model']} failed after {model_event['latency']}s"
+                    else:
+                        message = f"{model_event['model']} estimated {model_event['total_most_likely']}h in {model_event['latency']}s"
+                    emit({"status": "progress", "percent": 65 + int(7 * done_models / total_models),
+                          "message": message, "stage": "brainstorm", "data": model_event})
+            if stored:
+                # Fresh estimates of the changed features are stored, the unchanged ones merged back in
+                context.brainstorm_results, fresh = merge_stored_estimates(models, context.brainstorm_results, stored,
+                                                                           features, to_estimate)
+                for model, estimates in fresh.items():
+                    await feature_store.set_many(context_key, model, estimates)
+                if to_estimate:
+                    context.dump("combined_json", context.brainstorm_results)
+
+        async def rank(emit, files, brainstorm, retrieval):
+            await ai_process.ranking_stage(
+                context=context,
+                file_list=files,
+                previos_estimations=retrieval,
+                openai_model_list=openai_models,
+                gemini_model_list=gemini_models
+            )
+
+        # "fast" merges the ranked results locally instead of one more LLM round trip
+        fast = (final_mode or ai_process.final_mode) == "fast"
+
+        async def finalize(emit, files, ranking, retrieval):
+            if fast:
+                return await ai_process.consensus_stage(context=context)
+            return await ai_process.final_stage(
+                user_query=details,
+                context=context,
+                file_list=files,
+                previos_estimations=retrieval
+            )
+
+        graph = StageGraph([
+            Stage("files", prepare_files, percent=(10, 15), start_message="Collecting files..."),
+            Stage("features", extract_features, needs=["files"], percent=(18, 28),
+                  start_message="Using the reviewed feature list..." if reviewed_features else "Extracting features...",
+                  done_message="Features extracted"),
+            Stage("project_type", detect_project_type, needs=["files"], percent=(18, 32),
+                  start_message="Detecting project type...", done_message="Project type detected"),
+            Stage("baseline", estimate_baseline, needs=["features"]),
+            Stage("retrieval", retrieve_estimates, needs=["project_type"], percent=(45, 55),
+                  start_message="Searching historical database...", done_message="Historical context added"),
+            Stage("brainstorm", brainstorm, needs=["files", "features"], wants=["retrieval", "baseline"],
+                  wants_timeout=BRAINSTORM_CONTEXT_WAIT, percent=(65, 72),
+                  start_message="Brainstorming AI-based solutions...", done_message="Brainstorming completed"),
+            Stage("ranking", rank, needs=["files", "brainstorm", "retrieval"], percent=(80, 87),
+                  start_message="Ranking best approaches...", done_message="Ranking completed"),
+            Stage("final", finalize, needs=["files", "ranking", "retrieval"], percent=(94, 97),
+                  start_message="Building consensus estimate..." if fast else "Generating final report..."),
+        ], context=context)
+
+        # Stage latencies and the outcome go to /metrics however the run ends
+        try:
+            async for event in graph:
+                yield event
+        except StageError as e:
+            self.report_metrics(context, "error", e.stage)
+            yield {"status": "error", "message": str(e), "stage": e.stage}
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away / job cancelled
+            self.report_metrics(context, "cancelled")
+            raise
+
+        context.metadata["timings"] = {
+            "total": round(time.perf_counter() - started, 3),
+            "stages": {name: timing["duration"] for name, timing in context.metadata["stages"].items() if "duration" in timing},
+        }
+        self.report_metrics(context, "complete")
+        yield {
+            "status": "complete",
+            "percent": 100,
+            "message": "Completed Successfully",
+            "data": {"response": graph.results["final"].get("response"), "metadata": context.metadata},
+        }
+
+    # Stage latencies, the failed stage and the outcome of one run for /metrics
+    @staticmethod
+    def report_metrics(context, outcome, failed_stage = None):
+        for name, timing in context.metadata.get("stages", {}).items():
+            if "duration" in timing:
+                metrics.observe("stage_duration_seconds", timing["duration"], stage=name)
+        if failed_stage:
+            metrics.inc("stage_errors_total", stage=failed_stage)
+        metrics.inc("estimations_total", outcome=outcome)
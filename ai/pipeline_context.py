@@ -0,0 +1,52 @@
+import json
+import os
+import uuid
+from ai.metrics import metrics
+
+# Folder for optional per-request debug dumps of every stage (disabled when empty)
+PIPELINE_DEBUG_DIR = os.getenv("PIPELINE_DEBUG_DIR", "")
+
+
+# Per-request state passed between the pipeline stages
+class PipelineContext:
+
+    def __init__(self, request_id = None, debug_dir = None, use_cache = True, quorum = None, stage_deadline = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.debug_dir = PIPELINE_DEBUG_DIR if debug_dir is None else debug_dir
+        self.use_cache = use_cache    # False skips LLM cache lookups for this request
+
+        # Per request overrides of the fan-out quorum / deadline (None = server defaults)
+        self.quorum = quorum
+        self.stage_deadline = stage_deadline
+
+        # Stage results
+        self.brainstorm_results = []   # [{"model", "response", "Result"}]
+        self.ranking_results = []      # [{"ranks": [...]}] one per reviewer model
+        self.final_results = []        # brainstorm results with average_rank + reasons
+
+        # Anything extra the stages want to report back
+        self.metadata = {}
+
+    # Callback the model calls of a stage report their token usage to (one entry per
+    # call, plus the token / cost totals of the stage here and in /metrics)
+    def usage_recorder(self, stage):
+        def record(call):
+            self.metadata.setdefault("llm_calls", []).append({"stage": stage, **call})
+            totals = self.metadata.setdefault("usage", {}).setdefault(
+                stage, {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost_usd": 0.0})
+            totals["calls"] += 1
+            for kind in ("input", "cached", "output"):
+                totals[f"{kind}_tokens"] += call[f"{kind}_tokens"]
+                metrics.inc("stage_tokens_total", call[f"{kind}_tokens"], stage=stage, kind=kind)
+            totals["cost_usd"] = round(totals["cost_usd"] + call["cost_usd"], 6)
+            metrics.inc("stage_cost_usd_total", call["cost_usd"], stage=stage)
+        return record
+
+    # Save a stage result to disk (only when debugging is enabled)
+    def dump(self, name, data):
+        if not self.debug_dir:
+            return
+        folder = os.path.join(self.debug_dir, self.request_id)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
@@ -0,0 +1,312 @@
+import os
+import pprint
+import re
+import time
+import yaml
+
+# Exact tokenizer for the OpenAI models (in requirements.txt). Gemini models, and
+# OpenAI ones when tiktoken or its encoding files are unavailable, use ~4 characters per token.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budget per stage for the assembled text prompt (uploaded files not included)
+PROMPT_TOKEN_BUDGETS = {
+    "brainstorm": int(os.getenv("PROMPT_BUDGET_BRAINSTORM", "60000")),
+    "ranking": int(os.getenv("PROMPT_BUDGET_RANKING", "80000")),
+    "final": int(os.getenv("PROMPT_BUDGET_FINAL", "80000")),
+}
+
+# How brainstorm results are written into the ranking / final prompts:
+# "table" (one row per feature / breakdown task) or "yaml" (the full nested dump)
+RESULTS_ENCODING = os.getenv("RESULTS_ENCODING", "table")
+# Also measure the yaml dump, to log the tokens saved (one extra dump per stage, for measuring only)
+RESULTS_ENCODING_COMPARE = os.getenv("RESULTS_ENCODING_COMPARE", "0") == "1"
+
+# libyaml when available (same output as yaml.safe_dump, several times faster)
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Below this many tokens a truncated section is not worth keeping
+MIN_TRUNCATED_TOKENS = 200
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARK = "\n...[truncated]"
+
+_encodings = {}
+
+
+def _encoding(model):
+    if tiktoken is None or not model or not model.startswith(("gpt-", "o1", "o3", "o4")):
+        return None
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # The encoding files are downloaded on first use, e.g. no network
+            print(f"No tokenizer for {model}, estimating tokens from characters: {e!r}")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+# Tokens of `text` for one model
+def count_tokens(text, model = None):
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+# Tokens of `text` for the most demanding of `models`
+def count_tokens_for(text, models = None):
+    return max([count_tokens(text, model) for model in (models or [None])])
+
+
+# Cut `text` down to about `max_tokens` tokens
+def truncate_to_tokens(text, max_tokens, models = None):
+    if count_tokens_for(text, models) <= max_tokens:
+        return text
+    keep = max(0, max_tokens - count_tokens_for(TRUNCATION_MARK, models))
+    cut = text[:keep * CHARS_PER_TOKEN]
+    while cut and count_tokens_for(cut, models) > keep:
+        cut = cut[:int(len(cut) * 0.9)]
+    return cut + TRUNCATION_MARK
+
+
+# Keep only the feature / hour rows of historical estimates, most relevant first
+def compact_estimates(documents, feature_list = None, max_rows = 40):
+    if isinstance(documents, str):
+        documents = [documents]
+    words = set(re.findall(r"[a-z]{3,}", " ".join(feature_list or []).lower()))
+
+    compacted = []
+    for i, document in enumerate(documents or []):
+        lines = str(document).splitlines()
+        title = next((line.strip() for line in lines if line.strip()), f"Estimate {i + 1}")
+
+        # Table header rows (line before a |---| separator) and rows carrying numbers
+        headers = []
+        rows = []
+        for j, line in enumerate(lines):
+            stripped = line.strip()
+            if not stripped.startswith("|"):
+                continue
+            if re.fullmatch(r"\|[\s:|-]+\|?", stripped):
+                if j > 0 and lines[j - 1].strip() not in headers:
+                    headers.append(lines[j - 1].strip())
+                continue
+            if re.search(r"\d", stripped):
+                score = len(words & set(re.findall(r"[a-z]{3,}", stripped.lower())))
+                rows.append((score, j, stripped))
+
+        # Most relevant rows, back in document order
+        best = sorted(rows, key=lambda row: (-row[0], row[1]))[:max_rows]
+        kept = [row[2] for row in sorted(best, key=lambda row: row[1])]
+        compacted.append("\n".join([f"### {title.lstrip('# ')}"] + headers[:1] + kept))
+    return "\n\n".join(compacted)
+
+
+# Drop the nested breakdown items from brainstorm results, keeping feature totals
+def summarize_results(entries):
+    summary = []
+    for entry in entries:
+        entry = dict(entry)
+        response = entry.get("response") or entry.get("Response")
+        if isinstance(response, dict):
+            response = {
+                **response,
+                "features": [
+                    {key: value for key, value in feature.items() if key != "breakdown"}
+                    for feature in response.get("features", [])
+                ],
+            }
+            entry["response" if "response" in entry else "Response"] = response
+        summary.append(entry)
+    return summary
+
+
+def _yaml(items):
+    return yaml.dump(items, Dumper=_YAML_DUMPER, sort_keys=False, allow_unicode=True)
+
+
+def _cell(value):
+    return str(getattr(value, "value", value) if value is not None else "").replace("|", "/").replace("\n", " ").strip()
+
+
+# Brainstorm results as one markdown table per result: a row per feature with its
+# three hour columns, followed by its breakdown tasks ("> " rows), and a total row.
+# `summary` keeps the feature rows only (with the number of breakdown tasks).
+def encode_results(entries, summary = False):
+    if summary:
+        legend = "Hours: O = optimistic, M = most likely, P = pessimistic. Tasks = number of breakdown tasks (not shown)."
+        header = ["| Feature | Type | Tasks | O | M | P |", "|---|---|---|---|---|---|"]
+    else:
+        legend = ("Hours: O = optimistic, M = most likely, P = pessimistic. "
+                  "Rows starting with '>' are the breakdown tasks of the feature above.")
+        header = ["| Feature | Type | O | M | P |", "|---|---|---|---|---|"]
+
+    blocks = [legend]
+    for entry in entries:
+        response = entry.get("response") or entry.get("Response") or {}
+        title = f"### Result {entry.get('Result')}"
+        if entry.get("average_rank") is not None:
+            title += f" (average rank {entry['average_rank']:g})"
+        lines = [title]
+        if entry.get("reasons"):
+            lines.append("Reviews: " + " / ".join(_cell(reason) for reason in entry["reasons"]))
+        lines += header
+
+        totals = [0, 0, 0]
+        for feature in response.get("features", []):
+            hours = [feature.get("optimistic", 0), feature.get("most_likely", 0), feature.get("pessimistic", 0)]
+            totals = [total + value for total, value in zip(totals, hours)]
+            breakdown = feature.get("breakdown") or []
+            name, kind = _cell(feature.get("name")), _cell(feature.get("type"))
+            if summary:
+                lines.append(f"| {name} | {kind} | {len(breakdown)} | {hours[0]} | {hours[1]} | {hours[2]} |")
+                continue
+            lines.append(f"| {name} | {kind} | {hours[0]} | {hours[1]} | {hours[2]} |")
+            for task in breakdown:
+                lines.append(f"| > {_cell(task.get('task'))} | | {task.get('optimistic', 0)} | "
+                             f"{task.get('most_likely', 0)} | {task.get('pessimistic', 0)} |")
+        padding = " |" if summary else ""
+        lines.append(f"| Total | |{padding} {totals[0]} | {totals[1]} | {totals[2]} |")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks) + "\n"
+
+
+# Brainstorm results for the `stage` prompt plus the compact fallback used when the
+# prompt is over budget. With RESULTS_ENCODING_COMPARE=1 the tokens are also logged against the yaml dump.
+def encode_stage_results(stage, entries, models = None, context = None, summary = False, encoding = None):
+    encoding = encoding or RESULTS_ENCODING
+    started = time.perf_counter()
+    if encoding == "yaml":
+        text = _yaml(summarize_results(entries) if summary else entries)
+        compact = lambda _: _yaml(summarize_results(entries))
+    else:
+        text = encode_results(entries, summary=summary)
+        compact = lambda _: encode_results(entries, summary=True)
+    report = {
+        "encoding": encoding,
+        "summary": summary,
+        "tokens": count_tokens_for(text, models),
+        "encode_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+    if RESULTS_ENCODING_COMPARE and encoding != "yaml":
+        started = time.perf_counter()
+        legacy = _yaml(entries)
+        report["yaml_encode_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        report["yaml_tokens"] = count_tokens_for(legacy, models)
+        print(f"Results for {stage} stage: {report['yaml_tokens']} tokens as yaml -> {report['tokens']} as "
+              f"{'summary ' if summary else ''}table ({report['yaml_encode_ms']}ms -> {report['encode_ms']}ms)")
+    else:
+        print(f"Results for {stage} stage: {report['tokens']} tokens as {encoding}")
+
+    if context is not None:
+        context.metadata.setdefault("results_encoding", {})[stage] = report
+    return text, compact
+
+
+# Historical estimates as one block of text
+def format_estimates(previos_estimations):
+    if isinstance(previos_estimations, str):
+        return previos_estimations
+    if isinstance(previos_estimations, (list, tuple)):
+        return "\n\n---\n\n".join(str(document) for document in previos_estimations)
+    return pprint.pformat(previos_estimations)
+
+
+# Baseline estimate (EstimationResponse dict) as a short table
+def format_baseline(response):
+    lines = ["| Feature | Type | Optimistic | Most likely | Pessimistic |", "|---|---|---|---|---|"]
+    for feature in (response or {}).get("features", []):
+        lines.append(f"| {feature['name']} | {feature['type']} | {feature['optimistic']} | "
+                     f"{feature['most_likely']} | {feature['pessimistic']} |")
+    return "\n".join(lines)
+
+
+# Assembles prompts from sections and keeps them inside the stage token budget.
+# When over budget, sections are reduced from the lowest priority up: first
+# compacted (if they know how), then truncated, then dropped. Required sections
+# are never touched. Every reduction is recorded.
+class PromptBuilder:
+
+    def __init__(self, stage, models = None, budget = None, reserved_text = ""):
+        self.stage = stage
+        self.models = [model for model in (models or []) if model] or [None]
+        self.budget = budget if budget is not None else PROMPT_TOKEN_BUDGETS.get(stage, 0)
+        self.reserved = count_tokens_for(reserved_text, self.models)   # e.g. the user prompt
+        self.sections = []
+        self.actions = []
+
+    def add(self, name, body, priority = 0, required = False, header = "", compact = None, target = "system"):
+        self.sections.append({
+            "name": name,
+            "target": target,       # which prompt the section goes to: "static" (constant instructions,
+                                    # sent first so providers can cache them), "system" or "user"
+            "header": header,
+            "body": body or "",
+            "priority": priority,
+            "required": required,
+            "compact": compact,
+        })
+        return self
+
+    def _tokens(self, section):
+        return count_tokens_for(section["header"] + section["body"], self.models)
+
+    def _record(self, section, action, before):
+        self.actions.append({
+            "section": section["name"],
+            "action": action,
+            "tokens_before": before,
+            "tokens_after": self._tokens(section) if action != "dropped" else 0,
+        })
+
+    def build(self, context = None):
+        sizes = {id(section): self._tokens(section) for section in self.sections}
+        total = self.reserved + sum(sizes.values())
+
+        if self.budget:
+            for section in sorted((s for s in self.sections if not s["required"]), key=lambda s: s["priority"]):
+                if total <= self.budget:
+                    break
+                before = sizes[id(section)]
+
+                # 1. Compact / summarize
+                if section["compact"] is not None:
+                    section["body"] = section["compact"](section["body"])
+                    sizes[id(section)] = self._tokens(section)
+                    total += sizes[id(section)] - before
+                    self._record(section, "compacted", before)
+                    if total <= self.budget:
+                        break
+
+                # 2. Truncate to the room that is left, or drop
+                current = sizes[id(section)]
+                room = self.budget - (total - current) - count_tokens_for(section["header"], self.models)
+                if room >= MIN_TRUNCATED_TOKENS:
+                    section["body"] = truncate_to_tokens(section["body"], room, self.models)
+                    self._record(section, "truncated", current)
+                else:
+                    section["body"] = None
+                    self._record(section, "dropped", current)
+                sizes[id(section)] = self._tokens(section) if section["body"] is not None else 0
+                total += sizes[id(section)] - current
+
+        prompts = {"static": "", "system": "", "user": ""}
+        for section in self.sections:
+            if section["body"] is not None:
+                prompts[section["target"]] += section["header"] + section["body"]
+
+        report = {"budget": self.budget, "tokens": total, "actions": self.actions}
+        if self.actions:
+            print(f"Prompt for {self.stage} stage reduced to {total} tokens: {self.actions}")
+        if context is not None:
+            context.metadata.setdefault("prompt_budget", {})[self.stage] = report
+        return prompts
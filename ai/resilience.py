@@ -0,0 +1,206 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+import httpx
+import openai
+from google.genai import errors as genai_errors
+from ai.metrics import metrics
+
+# Retry settings
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))      # seconds
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))       # seconds, also caps Retry-After
+
+# Circuit breaker settings
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))     # seconds before a trial call
+
+# Status codes worth another try
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Seconds to wait from a Retry-After / retry-after-ms header (None if absent)
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# (status code, response) of a provider HTTP error, (None, None) for anything else
+def _error_status(error):
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code, error.response
+    if isinstance(error, genai_errors.APIError):
+        return error.code, error.response
+    return None, None
+
+
+# (retryable, retry_after_seconds) for an error raised by a provider call
+def classify_error(error):
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException,
+                          httpx.TransportError, asyncio.TimeoutError)):
+        return True, None
+
+    status, response = _error_status(error)
+    if status is None or status not in RETRYABLE_STATUS_CODES:
+        return False, None
+    headers = getattr(response, "headers", None)
+    return True, parse_retry_after(headers)
+
+
+# Whether an error says something about the model's health: timeouts, 429s and
+# server errors do, a rejected request (400 context length, 413, 422...) does not
+def is_model_failure(error):
+    retryable, _ = classify_error(error)
+    if retryable:
+        return True
+    status, _ = _error_status(error)
+    return status is not None and status >= 500
+
+
+# Exponential backoff with full jitter
+def backoff_delay(attempt, base = LLM_BACKOFF_BASE, cap = LLM_BACKOFF_MAX):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+# Per model breaker: opens after repeated failures so the model is skipped fast,
+# lets a single trial call through after the cooldown and closes again on success
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold = BREAKER_FAILURE_THRESHOLD, cooldown = BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.total_failures = 0
+        self.total_successes = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.trial_running = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_running = False
+            self.total_successes += 1
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self.trial_running = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+
+    # A call was cancelled before it finished (e.g. by a stage deadline)
+    def abandon(self):
+        with self.lock:
+            self.trial_running = False
+
+    def snapshot(self):
+        with self.lock:
+            retry_in = None
+            if self.state == "open":
+                retry_in = max(0.0, self.cooldown - (time.time() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "total_failures": self.total_failures,
+                "total_successes": self.total_successes,
+                "rejected": self.rejected,
+                "retry_in": retry_in,
+            }
+
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+        return breakers[name]
+
+
+# State of every breaker, for monitoring
+def breaker_states():
+    with _breakers_lock:
+        current = list(breakers.items())
+    return {name: breaker.snapshot() for name, breaker in current}
+
+
+# Run `call` (a zero-argument coroutine factory) with classified retries behind the breaker of `name`
+async def resilient_call(name, call, max_attempts = LLM_MAX_ATTEMPTS):
+    breaker = get_breaker(name)
+    provider, _, model = name.partition(":")
+    if not breaker.allow():
+        metrics.inc("llm_errors_total", provider=provider, model=model, error="CircuitOpenError")
+        raise CircuitOpenError(f"Circuit open for {name}, skipping the call")
+
+    try:
+        for attempt in range(max_attempts):
+            try:
+                result = await call()
+            except Exception as e:
+                metrics.inc("llm_errors_total", provider=provider, model=model, error=e.__class__.__name__)
+                retryable, retry_after = classify_error(e)
+                if not retryable or attempt == max_attempts - 1:
+                    # Only failures of the model open its circuit, not bad requests
+                    if is_model_failure(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.abandon()
+                    raise
+                delay = min(retry_after, LLM_BACKOFF_MAX) if retry_after is not None else backoff_delay(attempt)
+                print(f"{name} failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+    except asyncio.CancelledError:
+        # Cancelled by a stage deadline / quorum, says nothing about the model's health
+        breaker.abandon()
+        raise
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+
+class StageError(Exception):
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+# One node of the pipeline. `run(emit, **inputs)` gets the outputs of the stages
+# named in `needs` (always) and `wants` (when they are ready in time, else None).
+class Stage:
+
+    def __init__(self, name, run, needs = (), wants = (), wants_timeout = 0, percent = None,
+                 start_message = None, done_message = None):
+        self.name = name
+        self.run = run
+        self.needs = tuple(needs)
+        self.wants = tuple(wants)
+        self.wants_timeout = wants_timeout    # seconds to wait for `wants` once `needs` are ready
+        self.percent = percent                # (on start, on done) progress
+        self.start_message = start_message
+        self.done_message = done_message      # str or callable(output) -> str
+
+
+# Runs a set of stages as a dependency graph: every stage starts as soon as its
+# inputs resolve. Iterating yields the progress events of all stages in the
+# order they happen; a failing stage cancels the rest and raises StageError.
+class StageGraph:
+
+    def __init__(self, stages, context = None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.context = context
+        self.results = {}
+        for stage in stages:
+            for name in stage.needs + stage.wants:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {name}")
+
+    def _timing(self, name, **values):
+        if self.context is not None:
+            self.context.metadata.setdefault("stages", {}).setdefault(name, {}).update(values)
+
+    async def _run_stage(self, stage, futures, emit, started_at):
+        # Required inputs
+        if stage.needs:
+            await asyncio.gather(*(futures[name] for name in stage.needs))
+        inputs = {name: futures[name].result() for name in stage.needs}
+
+        # Optional inputs, for a little while longer
+        pending = [futures[name] for name in stage.wants if not futures[name].done()]
+        if pending and stage.wants_timeout:
+            await asyncio.wait(pending, timeout=stage.wants_timeout)
+        late = []
+        for name in stage.wants:
+            future = futures[name]
+            if future.done() and not future.cancelled() and future.exception() is None:
+                inputs[name] = future.result()
+            else:
+                inputs[name] = None
+                late.append(name)
+
+        began = time.perf_counter()
+        self._timing(stage.name, start=round(began - started_at, 3), waited_for=list(stage.needs), missing=late)
+        if stage.start_message:
+            emit({"status": "progress", "percent": stage.percent[0] if stage.percent else None,
+                  "message": stage.start_message, "stage": stage.name})
+
+        output = await stage.run(emit, **inputs)
+
+        finished = time.perf_counter()
+        self._timing(stage.name, end=round(finished - started_at, 3), duration=round(finished - began, 3))
+        if stage.done_message:
+            message = stage.done_message(output) if callable(stage.done_message) else stage.done_message
+            emit({"status": "progress", "percent": stage.percent[1] if stage.percent else None,
+                  "message": message, "stage": stage.name})
+        return output
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        started_at = time.perf_counter()
+        futures = {name: loop.create_future() for name in self.stages}
+        highest = 0
+
+        def emit(event):
+            queue.put_nowait(event)
+
+        async def runner(stage):
+            try:
+                output = await self._run_stage(stage, futures, emit, started_at)
+                futures[stage.name].set_result(output)
+            except asyncio.CancelledError:
+                futures[stage.name].cancel()
+                raise
+            except BaseException as e:
+                futures[stage.name].set_exception(e)
+                futures[stage.name].exception()     # marked as retrieved, it is re-raised below
+            queue.put_nowait(None)                  # one stage finished
+
+        tasks = [asyncio.create_task(runner(stage)) for stage in self.stages.values()]
+        remaining = len(tasks)
+        try:
+            while remaining:
+                event = await queue.get()
+                if event is None:
+                    remaining -= 1
+                    failed = next((name for name, future in futures.items()
+                                   if future.done() and not future.cancelled() and future.exception() is not None), None)
+                    if failed is not None:
+                        error = futures[failed].exception()
+                        if isinstance(error, StageError):
+                            raise error
+                        raise StageError(failed, str(error) or error.__class__.__name__) from error
+                    continue
+                # Stages run side by side: never move the progress bar backwards
+                if event.get("percent") is not None:
+                    highest = max(highest, event["percent"])
+                    event["percent"] = highest
+                yield event
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.results = {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from ai.attachments import PreparedFile
+
+# Upload limits (bytes)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Where uploads are spooled (system temp folder when empty)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+
+# Room for the multipart boundaries and form fields on top of the file bytes
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+# Cheap check on the Content-Length header, before the body is read
+def request_too_large(content_length, max_request_bytes = UPLOAD_MAX_REQUEST_BYTES):
+    try:
+        return int(content_length) > max_request_bytes + MULTIPART_OVERHEAD_BYTES
+    except (TypeError, ValueError):
+        return False
+
+
+def _write_chunk(tmp, digest, chunk):
+    digest.update(chunk)
+    tmp.write(chunk)
+
+
+# Copy each UploadFile in chunks to its own temp file, hashing on the way,
+# and return disk backed PreparedFiles (deleted again when they are closed)
+async def spool_uploads(files, max_file_bytes = UPLOAD_MAX_FILE_BYTES, max_request_bytes = UPLOAD_MAX_REQUEST_BYTES):
+    spooled = []
+    paths = []
+    total = 0
+    try:
+        for f in files or []:
+            if f.size is not None and f.size > max_file_bytes:
+                raise UploadTooLarge(f"File '{f.filename}' is larger than the {max_file_bytes} byte limit")
+
+            suffix = os.path.splitext(f.filename or "")[1]
+            digest = hashlib.sha256()
+            size = 0
+            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=UPLOAD_SPOOL_DIR) as tmp:
+                paths.append(tmp.name)
+                while True:
+                    chunk = await f.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    total += len(chunk)
+                    if size > max_file_bytes:
+                        raise UploadTooLarge(f"File '{f.filename}' is larger than the {max_file_bytes} byte limit")
+                    if total > max_request_bytes:
+                        raise UploadTooLarge(f"Uploads are larger than the {max_request_bytes} byte request limit")
+                    await asyncio.to_thread(_write_chunk, tmp, digest, chunk)
+
+            spooled.append(PreparedFile(f.filename, f.content_type, path=tmp.name,
+                                        sha256=digest.hexdigest(), size=size, owned=True))
+        return spooled
+    except BaseException:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
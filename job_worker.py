@@ -0,0 +1,42 @@
+# job_worker.py
+# Runs queued /jobs estimations outside the API processes (set JOB_WORKERS_IN_API=0 on the API)
+import asyncio
+import signal
+from ai.ai_process import Ai_process
+from ai.pipeline import EstimationPipeline
+from ai.ai_models import warmup_clients, close_clients
+from ai.docling import shutdown_extractors
+from ai.job_queue import JobWorker, job_queue
+from ai.metrics import metrics
+from vectordb.functions import EstimateVectorDB
+from vectordb.baseline import BaselineEstimator
+
+
+async def main():
+    ai_process = Ai_process()
+    estimate_vector_db = EstimateVectorDB()
+    baseline_estimator = BaselineEstimator(estimate_vector_db)
+    estimation_pipeline = EstimationPipeline(ai_process, estimate_vector_db, baseline_estimator)
+
+    await warmup_clients()
+    worker = JobWorker(job_queue, estimation_pipeline)
+    worker.start()
+    # Job metrics land in the same totals the API's /metrics reports
+    metrics_flusher = asyncio.create_task(metrics.run())
+    print(f"Job worker {worker.name} running {worker.concurrency} jobs at a time...")
+
+    # Stop on Ctrl+C / docker stop; running jobs are queued again for the next worker
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    await worker.stop()
+    metrics_flusher.cancel()
+    await asyncio.gather(metrics_flusher, return_exceptions=True)
+    await close_clients()
+    shutdown_extractors()
+
+if __name__ == "__main__":
+    asyncio.run(main())
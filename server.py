@@ -1,19 +1,57 @@
-import json
-import tempfile
 import os
+import json
+import time
 import asyncio
+from contextlib import asynccontextmanager
 from typing import Optional
-from fastapi import FastAPI, UploadFile, File, Form, Query
+from fastapi import FastAPI, UploadFile, File, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from ai.ai_process import Ai_process
-from ai.docling import exract_markdown
+from ai.pipeline import EstimationPipeline
+from ai.pipeline_context import PipelineContext
+from ai.ai_models import warmup_clients, close_clients
+from ai.attachments import PreparedAttachments
+from ai.uploads import spool_uploads, request_too_large, UploadTooLarge
+from ai.llm_cache import llm_cache
+from ai.resilience import breaker_states
+from ai.docling import exract_markdown, shutdown_extractors
+from ai.pert import calculate_summary as calculate_pert_summary
+from ai.job_queue import JobWorker, job_queue, FINISHED
+from ai.feature_store import feature_store, parse_feature_list
+from ai.context_cache import gemini_context_cache, context_cache_stats
+from ai.metrics import metrics
 from vectordb.functions import EstimateVectorDB
+from vectordb.ingestion import IngestionJobs
+from vectordb.embeddings import embedding_cache
+from vectordb.retrieval_cache import retrieval_cache
+from vectordb.baseline import BaselineEstimator
 
 # Pydantic Structure
 from structure import Summary_calculation
 
-app = FastAPI(title="AI Estimator", version="0.0.1")
+# Run queued /jobs in the API processes too (0 = only the separate job_worker.py runs them)
+JOB_WORKERS_IN_API = os.getenv("JOB_WORKERS_IN_API", "1") == "1"
+JOB_STREAM_POLL = float(os.getenv("JOB_STREAM_POLL", "0.5"))        # seconds between event reads of a stream
+JOB_WATCH_INTERVAL = float(os.getenv("JOB_WATCH_INTERVAL", "5"))    # seconds between "still watching" writes
+
+# Warm the LLM connection pools on startup and close them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warmup_clients()
+    if JOB_WORKERS_IN_API:
+        job_worker.start()
+    # Adds this worker's counts to the totals shared by all workers
+    metrics_flusher = asyncio.create_task(metrics.run())
+    yield
+    await job_worker.stop()
+    metrics_flusher.cancel()
+    await asyncio.gather(metrics_flusher, return_exceptions=True)
+    await close_clients()
+    shutdown_extractors()
+
+app = FastAPI(title="AI Estimator", version="0.0.1", lifespan=lifespan)
 
 # Enable CORS for local development
 app.add_middleware(
@@ -24,9 +62,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Reject oversized uploads from the Content-Length header, before the body is read
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    if request.method == "POST" and request_too_large(request.headers.get("content-length")):
+        return JSONResponse(status_code=413, content={"status": -1, "message": "Request body is too large"})
+    return await call_next(request)
+
 # Create an instance of the Ai_process class
 ai_process = Ai_process()
 estimate_vector_db = EstimateVectorDB()
+ingestion_jobs = IngestionJobs(estimate_vector_db, ai_process, exract_markdown)
+baseline_estimator = BaselineEstimator(estimate_vector_db)
+estimation_pipeline = EstimationPipeline(ai_process, estimate_vector_db, baseline_estimator)
+job_worker = JobWorker(job_queue, estimation_pipeline)
 
 @app.get("/")
 async def root():
@@ -66,150 +115,170 @@ async def submit_input(
     files: Optional[list[UploadFile]] = File(None),
     openai_models: Optional[list[str]] = Form(None),
     gemini_models: Optional[list[str]] = Form(None),
+    use_cache: bool = Form(True),
+    file_mode: Optional[str] = Form(None),
+    quorum: Optional[int] = Form(None),
+    stage_deadline: Optional[float] = Form(None),
+    final_mode: Optional[str] = Form(None),
+    features: Optional[list[str]] = Form(None),
 ):
-    async def event_generator():
-        try:
-            # ========================
-            # PHASE 0 — VALIDATION
-            # ========================
-            yield json.dumps({"status": "progress","percent":5,"message":"Validating request..."}) + "\n"
-
-            if not openai_models and not gemini_models:
-                yield json.dumps({"status":"error","message":"Select at least one model"}) + "\n"
-                return
-
-            # ========================
-            # PHASE 1 — File Read
-            # ========================
-            yield json.dumps({"status":"progress","percent":10,"message":"Collecting files..."}) + "\n"
-            
-            file_list = []
-            if files:
-                for f in files:
-                    content = await f.read()
-                    file_list.append({
-                        "name": f.filename,
-                        "mime": f.content_type,
-                        "data": content
-                    })
-
-            if not details and not file_list:
-                yield json.dumps({"status":"error","message":"No input provided"}) + "\n"
-                return
-
-            # ========================
-            # PHASE 2 — PARALLEL TASKS
-            # Feature Extraction + Project Type Prediction
-            # ========================
-            yield json.dumps({"status":"progress","percent":18,"message":"Extracting features & detecting project type..."}) + "\n"
-
-            features_task = ai_process.feature_list(user_query=details, file_list=file_list)
-            project_type_task = ai_process.predict_project_type(user_query=details, file_list=file_list)
-
-            # ⚡ Both run concurrently
-            features_res, project_type_res = await asyncio.gather(features_task, project_type_task)
-
-            if features_res.get("status") == -1:
-                yield json.dumps({"status": "error","message": features_res.get("message")}) + "\n"
-                return
-
-            if project_type_res.get("status") == -1:
-                yield json.dumps({"status": "error","message": project_type_res.get("message")}) + "\n"
-                return
-
-            feature_list = features_res.get("data", {}).get("features", [])
-            yield json.dumps({"status":"progress","percent":28,"message":"Features extracted"}) + "\n"
-            yield json.dumps({"status":"progress","percent":32,"message":"Project type detected"}) + "\n"
-
-            # ========================
-            # PHASE 3 — Fetch Similar Past Estimates
-            # ========================
-            yield json.dumps({"status":"progress","percent":45,"message":"Searching historical database..."} ) + "\n"
-
-            prev_estimates_res = await estimate_vector_db.query_estimates(
-                query=project_type_res.get("response", {}).get("project_summary"),
-                search_string=project_type_res.get("response", {}).get("technologies_used")
-            )
-
-            if prev_estimates_res.get("status") == -1:
-                yield json.dumps({"status":"error","message":prev_estimates_res.get("message")}) + "\n"
-                return
-
-            previos_estimations = prev_estimates_res.get("data", {}).get("documents", [])
-            yield json.dumps({"status":"progress","percent":55,"message":"Historical context added"}) + "\n"
-
-            # ========================
-            # PHASE 4 — Brainstorm Stage
-            # ========================
-            yield json.dumps({"status":"progress","percent":65,"message":"Brainstorming AI-based solutions..."}) + "\n"
-
-            await ai_process.brainstorm_stage(
-                user_query=details,
-                file_list=file_list,
-                previos_estimations=previos_estimations,
-                openai_model_list=openai_models,
-                gemini_model_list=gemini_models,
-                feature_list=feature_list
-            )
-
-            yield json.dumps({"status":"progress","percent":72,"message":"Brainstorming completed"}) + "\n"
-
-            # ========================
-            # PHASE 5 — Ranking Final Solutions
-            # ========================
-            yield json.dumps({"status":"progress","percent":80,"message":"Ranking best approaches..."}) + "\n"
-
-            await ai_process.ranking_stage(
-                file_list=file_list,
-                previos_estimations=previos_estimations,
-                openai_model_list=openai_models,
-                gemini_model_list=gemini_models
-            )
-
-            yield json.dumps({"status":"progress","percent":87,"message":"Ranking completed"}) + "\n"
-
-            # ========================
-            # PHASE 6 — Final Stage
-            # ========================
-            yield json.dumps({"status":"progress","percent":94,"message":"Generating final report..."}) + "\n"
-
-            res = await ai_process.final_stage(
-                user_query=details,
-                file_list=file_list,
-                previos_estimations=previos_estimations
-            )
-
-            # ========================
-            # COMPLETE
-            # ========================
-            yield json.dumps({
-                "status":"complete",
-                "percent":100,
-                "message":"Completed Successfully",
-                "data":{"response":res.get("response")}
-            }) + "\n"
+    # Spool the uploads to disk in chunks before streaming starts (size limits enforced here)
+    started = time.perf_counter()
+    try:
+        uploads = await spool_uploads(files)
+    except UploadTooLarge as e:
+        metrics.inc("stage_errors_total", stage="upload")
+        return JSONResponse(status_code=413, content={"status": -1, "message": str(e)})
 
-        except Exception as e:
-            yield json.dumps({"status":"error","message":str(e)}) + "\n"
+    # Shared by all models and stages, released once the response is done
+    file_list = PreparedAttachments.from_uploads(uploads, mode=file_mode)
+    context = PipelineContext(use_cache=use_cache, quorum=quorum, stage_deadline=stage_deadline)
+    context.metadata["stages"] = {"upload": {"duration": round(time.perf_counter() - started, 3)}}
 
-    return StreamingResponse(event_generator(), media_type="application/x-ndjson")
+    async def event_generator():
+        # Stages run as a dependency graph, each one as soon as its inputs are ready
+        async for event in estimation_pipeline.run(
+            details=details,
+            file_list=file_list,
+            openai_models=openai_models,
+            gemini_models=gemini_models,
+            use_cache=use_cache,
+            quorum=quorum,
+            stage_deadline=stage_deadline,
+            final_mode=final_mode,
+            features=parse_feature_list(features),
+            context=context,
+        ):
+            yield json.dumps(event) + "\n"
+
+    # Drop the spooled files and any copies pushed to the provider file stores
+    return StreamingResponse(event_generator(), media_type="application/x-ndjson",
+                             background=BackgroundTask(file_list.release))
+
+
+# Queue an estimation (same fields as /submit); it keeps running if the client goes away.
+# cancel_when_unwatched=true cancels it once nobody follows its progress any more.
+@app.post("/jobs")
+async def create_job(
+    details: Optional[str] = Form(None),
+    files: Optional[list[UploadFile]] = File(None),
+    openai_models: Optional[list[str]] = Form(None),
+    gemini_models: Optional[list[str]] = Form(None),
+    use_cache: bool = Form(True),
+    file_mode: Optional[str] = Form(None),
+    quorum: Optional[int] = Form(None),
+    stage_deadline: Optional[float] = Form(None),
+    final_mode: Optional[str] = Form(None),
+    features: Optional[list[str]] = Form(None),
+    cancel_when_unwatched: bool = Form(False),
+):
+    if not openai_models and not gemini_models:
+        return {"status": -1, "message": "Select at least one model"}
+    try:
+        uploads = await spool_uploads(files)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"status": -1, "message": str(e)})
+
+    params = {
+        "details": details,
+        "openai_models": openai_models,
+        "gemini_models": gemini_models,
+        "use_cache": use_cache,
+        "file_mode": file_mode,
+        "quorum": quorum,
+        "stage_deadline": stage_deadline,
+        "final_mode": final_mode,
+        "features": parse_feature_list(features),
+    }
+    try:
+        job_id = await asyncio.to_thread(job_queue.create, params, uploads, cancel_when_unwatched)
+    finally:
+        for upload in uploads:
+            upload.close()
+    return {"status": 0, "message": "Job queued", "data": {"job_id": job_id, "events": f"/jobs/{job_id}/events"}}
+
+
+# Job state, last progress event and (once completed) the estimate
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    state = await asyncio.to_thread(job_queue.get, job_id)
+    if state is None:
+        return JSONResponse(status_code=404, content={"status": -1, "message": "Job not found"})
+    if state["status"] not in FINISHED:
+        await asyncio.to_thread(job_queue.touch, job_id)
+    return {"status": 0, "message": "Job fetched sucessfully", "data": state}
+
+
+# Progress events as NDJSON (or SSE with format=sse / Accept: text/event-stream).
+# Every event has a seq; reconnect with after=<last seq> or the Last-Event-ID header to resume.
+@app.get("/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str,
+                     after: int = Query(0, description="Only events after this seq"),
+                     format: Optional[str] = Query(None, description="ndjson or sse")):
+    sse = format == "sse" or (format is None and "text/event-stream" in request.headers.get("accept", ""))
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        after = max(after, int(last_event_id))
+
+    status, _ = await asyncio.to_thread(job_queue.events, job_id, after, 0)
+    if status is None:
+        return JSONResponse(status_code=404, content={"status": -1, "message": "Job not found"})
+
+    async def event_generator():
+        seen = after
+        watched_at = 0
+        while True:
+            # Let the worker know somebody is still waiting
+            now = asyncio.get_running_loop().time()
+            if now - watched_at >= JOB_WATCH_INTERVAL:
+                await asyncio.to_thread(job_queue.touch, job_id)
+                watched_at = now
+
+            status, events = await asyncio.to_thread(job_queue.events, job_id, seen)
+            for seq, event in events:
+                seen = seq
+                if sse:
+                    yield f"id: {seq}\ndata: {json.dumps(event)}\n\n"
+                else:
+                    yield json.dumps({**event, "seq": seq}) + "\n"
+            if not events:
+                if status in FINISHED:
+                    return
+                await asyncio.sleep(JOB_STREAM_POLL)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+
+# Ask to cancel a job; it stops as soon as nobody follows its progress
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    if not await asyncio.to_thread(job_queue.request_cancel, job_id):
+        return {"status": -1, "message": "Job not found or already finished"}
+    return {"status": 0, "message": "Cancellation requested", "data": {"job_id": job_id}}
 
 
 # Add Additional estiamte or save the gebeated estimate
 @app.post("/add_estimate")
-async def add_estimate(files: Optional[list[UploadFile]] = File(None), filename: Optional[str] = Form(None)):
+async def add_estimate(files: Optional[list[UploadFile]] = File(None), filename: Optional[str] = Form(None), bulk: bool = Form(False)):
     results = []
     if not files:
         return {"error": "No files provided."}
-    for f in files:
-        # Save to temp file
-        content = await f.read()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(f.filename)[1]) as tmp:
-            tmp.write(content)
-            tmp_path = tmp.name
+
+    # Spool to temp files in chunks (size limits enforced here)
+    try:
+        uploads = await spool_uploads(files)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"status": -1, "message": str(e)})
+
+    # Bulk mode: ingest in the background and poll /ingest_jobs/{job_id}
+    if bulk:
+        job_id = ingestion_jobs.create_job(uploads, title=filename)
+        return {"status": 0, "message": "Ingestion job started", "data": {"job_id": job_id, "total": len(uploads)}}
+
+    for f, upload in zip(files, uploads):
         try:
             # Run through docling
-            markdown = await exract_markdown(tmp_path)
+            markdown = await exract_markdown(upload.path, sha256=upload.sha256)
 
             # LLM call to fetch metadatass
             metadata_res = await ai_process.extract_metadata(markdown)
@@ -231,21 +300,67 @@ async def add_estimate(files: Optional[list[UploadFile]] = File(None), filename:
             results.append({"filename": f.filename, "error": str(e)})
         finally:
             # Delete temp file
-            os.remove(tmp_path)
+            upload.close()
     return {"status": 0, "message": "Estimate added successfully", "data": results}
 
 
-# Get stores estimates
+# Bulk ingestion job progress
+@app.get("/ingest_jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    state = ingestion_jobs.get(job_id)
+    if state is None:
+        return {"status": -1, "message": "Job not found"}
+    return {"status": 0, "message": "Job fetched sucessfully", "data": state}
+
+# Retry the failed / unfinished files of a bulk ingestion job
+@app.post("/ingest_jobs/{job_id}/resume")
+async def resume_ingest_job(job_id: str):
+    state = ingestion_jobs.resume(job_id)
+    if state is None:
+        return {"status": -1, "message": "Job not found"}
+    if not state["resumed"]:
+        return {"status": -1, "message": "Job is already running"}
+    return {"status": 0, "message": "Job resumed", "data": {"job_id": job_id}}
+
+
+# Get stores estimates (paginated; include=metadatas skips the document bodies)
 @app.get("/get_estimates")
-async def get_estimates(limit: int = Query(10, description="Max number of estimates to return")):
+async def get_estimates(limit: int = Query(10, description="Max number of estimates to return"),
+                        offset: int = Query(0, description="Number of estimates to skip (next_offset of the previous page)"),
+                        include: str = Query("documents,metadatas", description="Comma separated fields: documents, metadatas"),
+                        with_total: Optional[bool] = Query(None, description="Count all estimates (default: first page only)")):
     try:
-        estiamte_list = await estimate_vector_db.get_list_of_estimates(limit=limit)
+        fields = [field.strip() for field in include.split(",") if field.strip()]
+        estiamte_list = await estimate_vector_db.get_list_of_estimates(limit=limit, offset=offset, include=fields,
+                                                                       with_total=with_total)
         if estiamte_list.get("status") != 0:
             raise Exception(estiamte_list.get("message"))
         return{"status": 0, "message": "All list fetched sucessfully", "data": estiamte_list.get("data")}
     except Exception as e:
         return{"status": -1, "message": str(e)}
 
+# Get one estimate with its document
+@app.get("/get_estimate/{id}")
+async def get_estimate(id: str):
+    try:
+        estimate = await estimate_vector_db.get_estimate(id=id)
+        if estimate.get("status") != 0:
+            raise Exception(estimate.get("message"))
+        return estimate
+    except Exception as e:
+        return{"status": -1, "message": str(e)}
+
+# Export every estimate as NDJSON, one per line
+@app.get("/export_estimates")
+async def export_estimates(include: str = Query("documents,metadatas", description="Comma separated fields: documents, metadatas")):
+    fields = [field.strip() for field in include.split(",") if field.strip()]
+
+    async def export_generator():
+        async for estimate in estimate_vector_db.iter_estimates(include=fields):
+            yield json.dumps(estimate) + "\n"
+
+    return StreamingResponse(export_generator(), media_type="application/x-ndjson")
+
 # devete estimate
 @app.delete("/delete_estimate/{id}")
 async def delete_estimate(id: str):
@@ -263,40 +378,13 @@ async def delete_estimate(id: str):
 @app.post("/calculate_summary")
 async def calculate_summary( data: Summary_calculation ):
     try:
-
-        # Extract the values
-        optimestics = data.total_optimistic
-        pessimistics = data.total_pessimistic
-        most_likely = data.total_most_likely
-
-        # Run the summary calculation
-        pert = (optimestics+4*most_likely+pessimistics)/6
-
-        # QA
-        qa = pert*data.qa_percentage/100
-
-        # UAT
-        uat = pert*data.uat_percentage/100
-
-        # DevOps
-        devops = pert*data.devops_percentage/100
-
-        # Critical
-        critical = pert*data.critical_percentage/100
-
-        # Total summary
-        total = qa+uat+devops+critical+pert
+        # Classic PERT plus a beta-PERT Monte Carlo (P50/P80/P95, Frontend/Backend rollups)
+        summary = await asyncio.to_thread(calculate_pert_summary, data)
 
         playlaod = {
             "status": 0,
             "message": "Summary calculated successfully",
-            "data": {
-                "qa": qa,
-                "uat": uat,
-                "devops": devops,
-                "critical": critical,
-                "total": total
-            }
+            "data": summary
         }
 
         return playlaod
@@ -306,24 +394,48 @@ async def calculate_summary( data: Summary_calculation ):
 
 # List features
 @app.post("/list_features")
-async def list_features( details: Optional[str] = Form(None), files: Optional[list[UploadFile]] = File(None),):
+async def list_features( details: Optional[str] = Form(None), files: Optional[list[UploadFile]] = File(None), use_cache: bool = Form(True)):
+    file_list = PreparedAttachments()
     try:
-        # 1. Collect files
-        file_list = []
-        if files:
-            for f in files:
-                content = await f.read()
-                file_list.append({
-                    "name": f.filename,
-                    "mime": f.content_type,
-                    "data": content 
-                })
+        # 1. Collect files (spooled to disk in chunks)
+        file_list = await PreparedAttachments.from_uploads(await spool_uploads(files)).prepare()
+
         # List the features out
-        features_res = await ai_process.feature_list(user_query=details, file_list=file_list)
+        features_res = await ai_process.feature_list(user_query=details, file_list=file_list, use_cache=use_cache)
         if features_res.get("status") == -1:
             return
         
         feature_list = features_res.get("data", {}).get("features", [])
         return {"status": 0,"message": "Feature list generated", "data": feature_list}
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"status": -1, "message": str(e)})
     except Exception as e:
-        return{"status": -1, "message": str(e)}
\ No newline at end of file
+        return{"status": -1, "message": str(e)}
+    finally:
+        await file_list.release()
+
+
+# LLM response cache counters
+@app.get("/cache_stats")
+async def cache_stats():
+    data = {
+        **llm_cache.stats(),
+        "embeddings": embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "features": feature_store.stats(),
+        # Provider side caching: Gemini cached contents and cached input tokens per model
+        "context": {"gemini_caches": gemini_context_cache.stats(), "tokens": context_cache_stats.stats()},
+    }
+    return {"status": 0, "message": "Cache stats fetched sucessfully", "data": data}
+
+
+# Prometheus metrics (stage / LLM latency, tokens, cost, errors) summed over all workers
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Circuit breaker state per model
+@app.get("/circuit_breakers")
+async def circuit_breakers():
+    return {"status": 0, "message": "Breaker states fetched sucessfully", "data": breaker_states()}
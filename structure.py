@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from enum import Enum
 
 
@@ -61,15 +61,29 @@ class Metadatastructure(BaseModel):
     summary : str
 
 
+# One what-if of the summary calculation (unset fields fall back to the request's)
+class Summary_scenario(BaseModel):
+    name: Optional[str] = None
+    estimate: Optional[EstimationResponse] = None
+    qa_percentage: Optional[int] = None
+    uat_percentage: Optional[int] = None
+    devops_percentage: Optional[int] = None
+    critical_percentage: Optional[int] = None
+
 # Summary calculation structure
 class Summary_calculation(BaseModel):
-    total_optimistic: int
-    total_most_likely: int
-    total_pessimistic: int
+    total_optimistic: int = 0
+    total_most_likely: int = 0
+    total_pessimistic: int = 0
     qa_percentage: int
     uat_percentage: int
     devops_percentage: int
     critical_percentage: int
+    # Full estimate for the Monte Carlo simulation (the totals above are used when missing)
+    estimate: Optional[EstimationResponse] = None
+    scenarios: List[Summary_scenario] = []
+    samples: Optional[int] = None
+    seed: Optional[int] = None
 
 
 # Feature list structure
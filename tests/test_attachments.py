@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import ai.attachments
+from ai.attachments import LocalFileStore, PreparedAttachments, PreparedFile
+
+MODELS = ["gpt-5", "gpt-5-mini", "gpt-4.1"]
+STAGES = 3
+
+
+def attachments(mode = "inline", count = 2):
+    return PreparedAttachments([PreparedFile(f"doc{i}.pdf", "application/pdf", f"file {i}".encode() * 100)
+                                for i in range(count)], mode=mode)
+
+
+def count_encodings(monkeypatch):
+    calls = []
+    encode = base64.b64encode
+
+    def b64encode(data):
+        calls.append(len(data))
+        return encode(data)
+    monkeypatch.setattr(ai.attachments.base64, "b64encode", b64encode)
+    return calls
+
+
+# Every model of every stage sends the same data URL, encoded once per file
+def test_inline_files_are_encoded_once(monkeypatch):
+    calls = count_encodings(monkeypatch)
+    files = attachments()
+
+    async def call():
+        await files.encode_inline("openai")
+        return [f.data_url for f in files]
+
+    async def run():
+        await files.prepare()
+        urls = []
+        for _ in range(STAGES):
+            urls += await asyncio.gather(*(call() for _ in MODELS))
+        return urls
+
+    urls = asyncio.run(run())
+    assert len(calls) == len(files)
+    assert all(url == urls[0] for url in urls)
+    assert urls[0][0].startswith("data:application/pdf;base64,")
+
+
+# Concurrent calls upload each file once and reuse the stored ids afterwards
+def test_uploaded_files_are_pushed_once(monkeypatch):
+    calls = count_encodings(monkeypatch)
+    files = attachments(mode="upload")
+    store = LocalFileStore()
+
+    async def call():
+        await files.ensure_uploaded("openai", store)
+        return [f.remote_refs["openai"] for f in files]
+
+    async def run():
+        refs = []
+        for _ in range(STAGES):
+            refs += await asyncio.gather(*(call() for _ in MODELS))
+        return refs
+
+    refs = asyncio.run(run())
+    assert store.uploads == len(files)
+    assert all(ref == refs[0] for ref in refs)
+    assert sorted(refs[0]) == sorted(store.files)
+    assert calls == []
+
+
+# Files pushed to the store (large ones) are not encoded inline as well
+def test_uploaded_subset_is_not_encoded(monkeypatch):
+    calls = count_encodings(monkeypatch)
+    files = attachments(count=3)
+    store = LocalFileStore()
+    large = files.files[:1]
+
+    async def run():
+        for _ in range(STAGES):
+            await files.ensure_uploaded("openai", store, files=large)
+            await files.encode_inline("openai")
+
+    asyncio.run(run())
+    assert store.uploads == 1
+    assert len(calls) == 2
+    assert large[0]._data_url is None
+
+
+# Each provider keeps its own ids; release removes them from the stores
+def test_refs_per_provider_and_release():
+    files = attachments(mode="upload")
+    openai_store, gemini_store = LocalFileStore(), LocalFileStore()
+
+    async def run():
+        await files.ensure_uploaded("openai", openai_store)
+        await files.ensure_uploaded("gemini", gemini_store)
+        await files.ensure_uploaded("openai", openai_store)
+        refs = [dict(f.remote_refs) for f in files]
+        await files.release()
+        return refs
+
+    refs = asyncio.run(run())
+    assert (openai_store.uploads, gemini_store.uploads) == (2, 2)
+    assert all(set(ref) == {"openai", "gemini"} for ref in refs)
+    assert openai_store.files == {} and gemini_store.files == {}
+    assert all(f.remote_refs == {} for f in files)
+
+
+# Provider parts are built once per file and provider
+def test_part_is_built_once():
+    file_obj = PreparedFile("doc.pdf", "application/pdf", b"pdf")
+    built = []
+
+    def factory(f):
+        built.append(f.name)
+        return {"name": f.name}
+
+    parts = [file_obj.part("gemini", factory) for _ in range(len(MODELS) * STAGES)]
+    assert built == ["doc.pdf"]
+    assert all(part is parts[0] for part in parts)
+
+
+# Spooled files are read from disk and encoded once as well
+def test_spooled_file_is_encoded_once(monkeypatch, tmp_path):
+    calls = count_encodings(monkeypatch)
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"spooled" * 1000)
+    files = PreparedAttachments([PreparedFile("doc.pdf", "application/pdf", path=str(path), owned=True)])
+
+    async def run():
+        await files.prepare()
+        for _ in range(STAGES):
+            await asyncio.gather(*(files.encode_inline("openai") for _ in MODELS))
+        url = files.files[0].data_url
+        await files.release()
+        return url
+
+    url = asyncio.run(run())
+    assert calls == [7000]
+    assert base64.b64decode(url.split(",", 1)[1]) == b"spooled" * 1000
+    assert not path.exists()
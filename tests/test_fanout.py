@@ -0,0 +1,54 @@
+import asyncio
+from ai.fanout import FanOut
+
+
+def collect(fan_out):
+    async def run():
+        return [(index, result) async for index, result, latency in fan_out]
+    return asyncio.run(run())
+
+
+def delayed(seconds, value):
+    async def call():
+        await asyncio.sleep(seconds)
+        if isinstance(value, Exception):
+            raise value
+        return value
+    return call
+
+
+# A deadline that passes before any model answered keeps waiting for the first success
+def test_deadline_with_zero_successes_waits_for_first_answer():
+    fan_out = FanOut([delayed(0.15, "slow"), delayed(0.3, "slower")], deadline=0.05)
+    results = collect(fan_out)
+    assert results == [(0, "slow")]
+    assert fan_out.timed_out
+    assert fan_out.skipped == [1]
+
+
+# Failures do not count as answers for the deadline
+def test_deadline_ignores_failed_calls():
+    fan_out = FanOut([delayed(0.01, RuntimeError("down")), delayed(0.15, "ok")], deadline=0.05)
+    results = collect(fan_out)
+    assert [index for index, _ in results] == [0, 1]
+    assert results[1][1] == "ok"
+    assert fan_out.skipped == []
+
+
+def test_deadline_cuts_stragglers_after_a_success():
+    fan_out = FanOut([delayed(0.01, "fast"), delayed(1, "slow")], deadline=0.1)
+    assert collect(fan_out) == [(0, "fast")]
+    assert fan_out.timed_out
+    assert fan_out.skipped == [1]
+
+
+def test_quorum_stops_early():
+    fan_out = FanOut([delayed(0.01, "a"), delayed(0.02, "b"), delayed(1, "c")], quorum=2)
+    assert [index for index, _ in collect(fan_out)] == [0, 1]
+    assert fan_out.skipped == [2]
+
+
+def test_no_limits_waits_for_every_call():
+    fan_out = FanOut([delayed(0.02, "a"), delayed(0.01, "b")])
+    assert sorted(collect(fan_out)) == [(0, "a"), (1, "b")]
+    assert not fan_out.timed_out
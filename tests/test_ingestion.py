@@ -0,0 +1,71 @@
+import asyncio
+import time
+import vectordb.ingestion
+from ai.attachments import PreparedFile
+from vectordb.ingestion import IngestionJobs
+
+
+class VectorDB:
+
+    def __init__(self):
+        self.rows = []
+
+    async def existing_hashes(self, hashes):
+        return set()
+
+    async def add_estimates(self, documents, metadatas):
+        self.rows += documents
+        return {"status": 0, "data": {"ids": [f"id{len(self.rows) - i}" for i in range(len(documents))]}}
+
+
+class AIProcess:
+
+    async def extract_metadata(self, markdown):
+        return {"response": {}}
+
+
+def jobs(tmp_path, worker, release = None):
+    async def extract_markdown(path, sha256 = None):
+        if release is not None:
+            await release.wait()
+        return open(path).read()
+    ingestion = IngestionJobs(VectorDB(), AIProcess(), extract_markdown, jobs_dir=str(tmp_path / "jobs"))
+    ingestion.worker = worker
+    return ingestion
+
+
+def upload(tmp_path, name):
+    path = tmp_path / name
+    path.write_text(f"estimate {name}")
+    return PreparedFile(name, "text/markdown", path=str(path), sha256=name, size=path.stat().st_size, owned=True)
+
+
+# Only one worker gets to run a job; the others can resume it once it stopped
+def test_resume_claims_the_job_once(tmp_path):
+    async def run():
+        release = asyncio.Event()
+        first, second = jobs(tmp_path, "a", release), jobs(tmp_path, "b")
+        job_id = first.create_job([upload(tmp_path, "one.md")])
+        await asyncio.sleep(0)
+        busy = [second.resume(job_id)["resumed"], first.resume(job_id)["resumed"]]
+        release.set()
+        await first.tasks[job_id]
+        again = second.resume(job_id)["resumed"]
+        await second.tasks[job_id]
+        return busy, again, second.get(job_id)
+
+    busy, again, state = asyncio.run(run())
+    assert busy == [False, False]
+    assert again is True
+    assert state["status"] == "completed"
+
+
+# A job whose worker stopped sending heartbeats can be taken over
+def test_stale_job_is_claimed(tmp_path, monkeypatch):
+    lost, other = jobs(tmp_path, "lost"), jobs(tmp_path, "other")
+    assert lost._claim("job")
+    assert not other._claim("job")
+    now = time.time()
+    monkeypatch.setattr(vectordb.ingestion.time, "time", lambda: now + vectordb.ingestion.INGEST_STALE_AFTER + 1)
+    assert other._claim("job")
+    assert not lost._claim("job")
@@ -0,0 +1,62 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from ai.metrics import DURATION_BUCKETS, Metrics
+
+
+def test_observe_does_not_wait_for_a_blocked_flush(tmp_path):
+    path = str(tmp_path / "metrics.sqlite3")
+    metrics = Metrics(path=path)
+    metrics.inc("estimations_total", outcome="complete")
+    metrics.flush()
+
+    # Another process holds the database, so the next flush waits on SQLite
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    metrics.observe("stage_duration_seconds", 1.5, stage="brainstorm")
+    flusher = threading.Thread(target=metrics.flush)
+    flusher.start()
+    time.sleep(0.2)
+    assert flusher.is_alive()
+
+    metrics.observe("stage_duration_seconds", 0.2, stage="ranking")
+    metrics.inc("estimations_total", outcome="complete")
+
+    other.execute("COMMIT")
+    other.close()
+    flusher.join(5)
+    assert not flusher.is_alive()
+
+    text = asyncio.run(metrics.render())
+    assert 'estimator_estimations_total{outcome="complete"} 2' in text
+    assert 'estimator_stage_duration_seconds_count{stage="brainstorm"} 1' in text
+    assert 'estimator_stage_duration_seconds_count{stage="ranking"} 1' in text
+
+
+def test_totals_add_up_across_processes(tmp_path):
+    path = str(tmp_path / "metrics.sqlite3")
+    workers = [Metrics(path=path), Metrics(path=path)]
+    for worker in workers:
+        worker.record_llm_call("openai", "gpt-5", {"input_tokens": 1000, "cached_tokens": 200, "output_tokens": 50}, 0.3)
+        worker.flush()
+
+    text = asyncio.run(workers[0].render())
+    assert 'estimator_llm_tokens_total{kind="input",model="gpt-5",provider="openai"} 2000' in text
+    assert 'estimator_llm_call_duration_seconds_bucket{le="0.5",model="gpt-5",provider="openai"} 2' in text
+    assert 'estimator_llm_call_duration_seconds_bucket{le="0.25",model="gpt-5",provider="openai"} 0' in text
+
+
+# Every bucket of a label set is exposed, empty ones as 0, in ascending order
+def test_histogram_has_every_bucket(tmp_path):
+    metrics = Metrics(path=str(tmp_path / "metrics.sqlite3"))
+    metrics.observe("stage_duration_seconds", 3, stage="final")
+    text = asyncio.run(metrics.render())
+    lines = [line for line in text.splitlines() if line.startswith("estimator_stage_duration_seconds")]
+    bounds = [str(le) for le in DURATION_BUCKETS] + ["+Inf"]
+    assert lines == [
+        *(f'estimator_stage_duration_seconds_bucket{{le="{le}",stage="final"}} {int(le == "+Inf" or float(le) >= 3)}'
+          for le in bounds),
+        'estimator_stage_duration_seconds_sum{stage="final"} 3',
+        'estimator_stage_duration_seconds_count{stage="final"} 1',
+    ]
@@ -0,0 +1,84 @@
+import os
+import random
+import time
+import numpy as np
+import pytest
+from structure import Summary_calculation
+from ai import pert
+
+
+def estimate(features = 60, tasks_per_feature = 4, seed = 1, shift = 0):
+    rnd = random.Random(seed)
+    result = []
+    for i in range(features):
+        breakdown = []
+        for j in range(tasks_per_feature):
+            optimistic = rnd.randint(1, 10)
+            most_likely = optimistic + rnd.randint(0, 10) + shift
+            breakdown.append({"task": f"Task {j}", "optimistic": optimistic, "most_likely": most_likely,
+                              "pessimistic": most_likely + rnd.randint(0, 30)})
+        result.append({"name": f"Feature {i}", "type": rnd.choice(["Frontend", "Backend"]), "breakdown": breakdown,
+                       "optimistic": 0, "most_likely": 0, "pessimistic": 0})
+    return {"features": result}
+
+
+def request(**fields):
+    return Summary_calculation(qa_percentage=10, uat_percentage=5, devops_percentage=5, critical_percentage=10, **fields)
+
+
+# The table sampler matches drawing every task from numpy's beta distribution
+@pytest.mark.parametrize("features", [1, 10])
+def test_simulation_matches_beta_pert(features):
+    low, mode, high, groups = pert.estimate_tasks(estimate(features))
+    total, _ = pert.simulate(low, mode, high, groups, 100000, 0)
+    spread = high - low
+    position = np.divide(mode - low, spread, out=np.zeros_like(spread), where=spread > 0)
+    rng = np.random.default_rng(1)
+    reference = low.sum() + (spread * rng.beta(1 + 4 * position, 1 + 4 * (1 - position), (100000, len(low)))).sum(axis=1)
+    assert np.percentile(total, pert.PERCENTILES) == pytest.approx(np.percentile(reference, pert.PERCENTILES), rel=0.01)
+    assert total.mean() == pytest.approx(((low + 4 * mode + high) / 6).sum(), rel=0.005)
+
+
+# An estimate simulated along with others gets the same samples as on its own
+def test_simulate_many_matches_single_runs():
+    task_sets = [pert.estimate_tasks(estimate(features, seed=features)) for features in (3, 10, 1)]
+    for tasks, (total, by_group) in zip(task_sets, pert.simulate_many(task_sets, 20000, 5)):
+        alone_total, alone_groups = pert.simulate(*tasks, 20000, 5)
+        assert np.array_equal(total, alone_total)
+        assert all(np.array_equal(by_group[name], alone_groups[name]) for name in alone_groups)
+
+
+# Scenarios reuse the random draws of the base estimate: a batch of nine draws as
+# many indexes as one estimate, and gives the same results as separate requests
+def test_summary_batch_draws_once(monkeypatch):
+    chunks = []
+    chunk_indexes = pert._chunk_indexes
+    monkeypatch.setattr(pert, "_chunk_indexes", lambda *args: chunks.append(args) or chunk_indexes(*args))
+    scenarios = [{"name": f"S{i}", "estimate": estimate(shift=i + 1)} for i in range(8)]
+    pert.pert_engine.cache.clear()
+    batch = pert.calculate_summary(request(estimate=estimate(), scenarios=scenarios))
+    assert batch["samples"] == pert.PERT_SAMPLES == 100000
+    assert len(chunks) == -(-240 // pert.TASK_CHUNK)
+
+    pert.pert_engine.cache.clear()
+    single = pert.calculate_summary(request(estimate=scenarios[3]["estimate"]))
+    assert single["percentiles"] == batch["scenarios"][3]["percentiles"]
+    p = batch["percentiles"]
+    assert p["p50"]["total"] < p["p80"]["total"] < p["p95"]["total"]
+
+
+def timed(data):
+    pert.pert_engine.cache.clear()
+    started = time.perf_counter()
+    pert.calculate_summary(data)
+    return time.perf_counter() - started
+
+
+# Wall clock timings depend on the machine: only run with PERT_BENCHMARK=1
+@pytest.mark.skipif(os.getenv("PERT_BENCHMARK") != "1", reason="benchmark, set PERT_BENCHMARK=1")
+def test_summary_speed():
+    single = request(estimate=estimate())
+    batch = request(estimate=estimate(), scenarios=[{"name": f"S{i}", "estimate": estimate(shift=i + 1)} for i in range(8)])
+    timed(single)
+    print(f"single {min(timed(single) for _ in range(3)) * 1000:.0f}ms, "
+          f"batch of 9 {min(timed(batch) for _ in range(3)) * 1000:.0f}ms")
@@ -0,0 +1,41 @@
+from ai.pipeline import merge_stored_estimates
+
+
+def estimate(name, hours):
+    return {"name": name, "optimistic": hours, "most_likely": hours, "pessimistic": hours}
+
+
+FEATURES = ["Login", "Payments", "Reports"]
+
+
+# Fresh estimates replace the changed features, stored ones fill in the rest and
+# features the model added on its own (or estimated twice) are dropped
+def test_merge_keeps_only_the_reviewed_features():
+    stored = {"gpt-5": {"Login": estimate("Login", 5), "Reports": estimate("Reports", 8)}}
+    results = [{"model": "gpt-5", "Result": "A", "response": {"summary": "ok", "features": [
+        estimate("Payments", 20),
+        estimate("Login", 6),
+        estimate("Admin panel", 40),
+        estimate("Payment", 21),
+    ]}}]
+    merged, fresh = merge_stored_estimates(["gpt-5"], results, stored, FEATURES, ["Payments"])
+    assert merged == [{"model": "gpt-5", "Result": "A", "response": {"summary": "ok", "features": [
+        estimate("Login", 5), estimate("Payments", 20), estimate("Reports", 8)]}}]
+    assert fresh == {"gpt-5": {"Payments": estimate("Payments", 20)}}
+
+
+# A removed feature does not come back from the store or from the model
+def test_merge_drops_removed_features():
+    stored = {"gpt-5": {"Login": estimate("Login", 5), "Search": estimate("Search", 9)}}
+    results = [{"model": "gpt-5", "response": {"features": [estimate("Payments", 20), estimate("Search", 9)]}}]
+    merged, _ = merge_stored_estimates(["gpt-5"], results, stored, ["Login", "Payments"], ["Payments"])
+    assert [f["name"] for f in merged[0]["response"]["features"]] == ["Login", "Payments"]
+
+
+# Everything stored: one result per model straight from the store
+def test_merge_fully_stored():
+    stored = {model: {feature: estimate(feature, i) for i, feature in enumerate(FEATURES)} for model in ("a", "b")}
+    merged, fresh = merge_stored_estimates(["a", "b"], [], stored, FEATURES, [])
+    assert [entry["Result"] for entry in merged] == ["A", "B"]
+    assert merged[1]["response"]["features"] == [estimate(feature, i) for i, feature in enumerate(FEATURES)]
+    assert fresh == {}
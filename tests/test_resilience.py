@@ -0,0 +1,177 @@
+import asyncio
+import httpx
+import openai
+import pytest
+import ai.resilience
+from ai.resilience import (CircuitBreaker, CircuitOpenError, backoff_delay, classify_error, is_model_failure,
+                           parse_retry_after, resilient_call)
+
+
+class Clock:
+
+    def __init__(self, now = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ai.resilience.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+    monkeypatch.setattr(ai.resilience.asyncio, "sleep", sleep)
+    monkeypatch.setattr(ai.resilience, "breakers", {})
+    return delays
+
+
+def status_error(code, headers = None):
+    request = httpx.Request("POST", "http://llm.test/v1/responses")
+    response = httpx.Response(code, request=request, headers=headers or {})
+    return openai.APIStatusError(f"status {code}", response=response, body=None)
+
+
+def calls(*outcomes):
+    outcomes = list(outcomes)
+    made = []
+
+    async def call():
+        made.append(len(made))
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return call, made
+
+
+def test_classify_error():
+    assert classify_error(status_error(429, {"retry-after": "7"})) == (True, 7.0)
+    assert classify_error(status_error(503, {"retry-after-ms": "1500"})) == (True, 1.5)
+    assert classify_error(status_error(500)) == (True, None)
+    assert classify_error(status_error(400)) == (False, None)
+    assert classify_error(status_error(404)) == (False, None)
+    assert classify_error(httpx.ReadTimeout("slow")) == (True, None)
+    assert classify_error(asyncio.TimeoutError()) == (True, None)
+    assert classify_error(ValueError("bad json")) == (False, None)
+
+
+def test_model_failures():
+    assert is_model_failure(status_error(429))
+    assert is_model_failure(status_error(501))
+    assert is_model_failure(httpx.ConnectTimeout("down"))
+    assert not is_model_failure(status_error(400))
+    assert not is_model_failure(status_error(413))
+    assert not is_model_failure(ValueError("bad json"))
+
+
+def test_parse_retry_after(clock):
+    assert parse_retry_after(None) is None
+    assert parse_retry_after({"retry-after": "-3"}) == 0.0
+    assert parse_retry_after({"retry-after": "soon"}) is None
+    assert parse_retry_after({"retry-after": "Thu, 01 Jan 1970 00:17:00 GMT"}) == 20.0
+
+
+def test_backoff_delay_bounds():
+    for attempt in range(8):
+        delays = [backoff_delay(attempt, base=1, cap=30) for _ in range(200)]
+        assert all(0 <= delay <= min(30, 2 ** attempt) for delay in delays)
+    assert max(backoff_delay(10, base=1, cap=30) for _ in range(200)) > 15
+
+
+# closed -> open after the threshold -> half open (one trial) after the cooldown -> closed
+def test_breaker_transitions(clock):
+    breaker = CircuitBreaker("openai:test", failure_threshold=3, cooldown=60)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.snapshot()["retry_in"] == 60
+
+    clock.now += 59
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()          # only one trial call at a time
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+    assert breaker.snapshot()["rejected"] == 3
+
+
+# A failed trial opens the breaker again for a whole cooldown
+def test_breaker_failed_trial_reopens(clock):
+    breaker = CircuitBreaker("openai:test", failure_threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+# An abandoned trial lets the next caller try
+def test_breaker_abandoned_trial(clock):
+    breaker = CircuitBreaker("openai:test", failure_threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_resilient_call_retries_with_retry_after(sleeps):
+    call, made = calls(status_error(429, {"retry-after": "2"}), httpx.ReadTimeout("slow"), "ok")
+    assert asyncio.run(resilient_call("openai:gpt-test", call, max_attempts=4)) == "ok"
+    assert len(made) == 3
+    assert sleeps[0] == 2.0
+    assert 0 <= sleeps[1] <= 2
+    assert ai.resilience.get_breaker("openai:gpt-test").state == "closed"
+
+
+def test_resilient_call_does_not_retry_bad_requests(sleeps):
+    breaker = ai.resilience.get_breaker("openai:gpt-test")
+    for _ in range(breaker.failure_threshold + 1):
+        call, made = calls(status_error(400))
+        with pytest.raises(openai.APIStatusError):
+            asyncio.run(resilient_call("openai:gpt-test", call))
+        assert len(made) == 1
+    assert sleeps == []
+    assert breaker.state == "closed"
+    assert breaker.consecutive_failures == 0
+
+
+def test_resilient_call_opens_breaker(clock, sleeps):
+    breaker = ai.resilience.get_breaker("openai:gpt-test")
+    breaker.failure_threshold, breaker.cooldown = 2, 30
+    for _ in range(2):
+        call, made = calls(*[status_error(503)] * 2)
+        with pytest.raises(openai.APIStatusError):
+            asyncio.run(resilient_call("openai:gpt-test", call, max_attempts=2))
+    assert breaker.state == "open"
+
+    call, made = calls("ok")
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(resilient_call("openai:gpt-test", call))
+    assert made == []
+
+    clock.now += 30
+    assert asyncio.run(resilient_call("openai:gpt-test", call)) == "ok"
+    assert breaker.state == "closed"
@@ -0,0 +1,43 @@
+import asyncio
+import uuid
+import chromadb
+import pytest
+from vectordb.functions import EstimateVectorDB
+
+
+# EstimateVectorDB over an in-memory collection of the given space (no persistent client)
+def vector_db(space):
+    db = EstimateVectorDB.__new__(EstimateVectorDB)
+    db.collection = chromadb.EphemeralClient().create_collection(
+        name = f"test_{space}_{uuid.uuid4().hex[:8]}",
+        configuration = {"hnsw": {"space": space}},
+        embedding_function = None,
+    )
+    db.collection.add(ids = ["same", "close"], documents = ["same", "close"],
+                      embeddings = [[1.0, 0.0], [0.6, 0.8]])
+    return db
+
+
+def similarities(db):
+    res = db.collection.query(query_embeddings = [[1.0, 0.0]], n_results = 2, include = ["distances"])
+    return dict(zip(res["ids"][0], (db._similarity(distance) for distance in res["distances"][0])))
+
+
+# Unit vectors with dot products 1.0 and 0.6 score the same in every space
+@pytest.mark.parametrize("space", ["ip", "cosine", "l2"])
+def test_similarity_matches_dot_product(space):
+    scores = similarities(vector_db(space))
+    assert scores["same"] == pytest.approx(1.0, abs = 1e-5)
+    assert scores["close"] == pytest.approx(0.6, abs = 1e-5)
+
+
+# Pages of one, the last one without a next offset; limit 0 is rejected, not "no limit"
+def test_list_of_estimates_limits():
+    db = vector_db("cosine")
+    first = asyncio.run(db.get_list_of_estimates(limit = 1))
+    assert (len(first["data"]["ids"]), first["data"]["total"], first["data"]["next_offset"]) == (1, 2, 1)
+    last = asyncio.run(db.get_list_of_estimates(limit = 1, offset = 1))
+    assert (len(last["data"]["ids"]), last["data"]["next_offset"]) == (1, None)
+    assert len(asyncio.run(db.get_list_of_estimates())["data"]["ids"]) == 2
+    assert asyncio.run(db.get_list_of_estimates(limit = 0))["status"] == -1
+    assert asyncio.run(db.get_list_of_estimates(offset = -1))["status"] == -1
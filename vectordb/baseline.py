@@ -0,0 +1,253 @@
+import asyncio
+import math
+import os
+import re
+import time
+from collections import Counter
+import numpy as np
+from structure import EstimationResponse, Feature
+from vectordb.retrieval_cache import retrieval_cache
+
+# Baseline settings
+BASELINE_NEIGHBOURS = int(os.getenv("BASELINE_NEIGHBOURS", "3"))
+BASELINE_MIN_SIMILARITY = float(os.getenv("BASELINE_MIN_SIMILARITY", "0.2"))
+BASELINE_MAX_NGRAMS = int(os.getenv("BASELINE_MAX_NGRAMS", "8192"))     # vocabulary cap (matrix columns)
+
+FRONTEND_WORDS = r"\b(front ?-?end|ui|ux|design|screens?|pages?|mobile|app)\b"
+BACKEND_WORDS = r"\b(back ?-?end|apis?|server|database|cms|admin|integrations?)\b"
+SKIP_WORDS = ("total", "summary", "pert", "sample")
+
+
+def _cells(line):
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+
+def _number(cell):
+    try:
+        value = float(cell.replace(",", ""))
+    except ValueError:
+        return None
+    return None if math.isnan(value) else value
+
+
+def _is_empty(cell):
+    return not cell or cell.lower() in ("none", "nan")
+
+
+def _guess_type(text, default = None):
+    text = text.lower()
+    if re.search(FRONTEND_WORDS, text):
+        return "Frontend"
+    if re.search(BACKEND_WORDS, text):
+        return "Backend"
+    return default
+
+
+# Feature rows (name, type, optimistic, most_likely, pessimistic) from the
+# markdown tables of one historical estimate
+def parse_feature_rows(markdown, source = None):
+    rows = []
+    columns = None
+    section_type = None
+    for line in str(markdown or "").splitlines():
+        if not line.strip().startswith("|"):
+            columns = None
+            continue
+        cells = _cells(line)
+        if all(re.fullmatch(r":?-+:?", cell) for cell in cells if cell):
+            continue
+
+        # Header row: find the three point columns
+        lowered = [cell.lower() for cell in cells]
+        found = {}
+        for i, cell in enumerate(lowered):
+            if "optimistic" in cell:
+                found["optimistic"] = i
+            elif "pessimistic" in cell:
+                found["pessimistic"] = i
+            elif "most likely" in cell or "most_likely" in cell or "realistic" in cell:
+                found["most_likely"] = i
+        if len(found) == 3:
+            columns = found
+            section_type = None
+            continue
+        if columns is None:
+            continue
+
+        first = min(columns.values())
+        name = " - ".join(cell for cell in cells[:first] if not _is_empty(cell) and _number(cell) is None)
+        if not name or any(word in name.lower() for word in SKIP_WORDS):
+            continue
+        values = [_number(cells[columns[key]]) if columns[key] < len(cells) else None
+                  for key in ("optimistic", "most_likely", "pessimistic")]
+
+        # Rows without hours are section titles like "FRONTEND (NextJS)"
+        if any(value is None for value in values):
+            section_type = _guess_type(name, section_type)
+            continue
+        optimistic, most_likely, pessimistic = sorted(values)
+        rows.append({
+            "name": name,
+            "type": section_type or _guess_type(name, "Backend"),
+            "optimistic": optimistic,
+            "most_likely": most_likely,
+            "pessimistic": pessimistic,
+            "source": source,
+        })
+    return rows
+
+
+def _normalize(text):
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+# Words plus character 3/4-grams inside word boundaries
+def _ngrams(text):
+    grams = []
+    for word in _normalize(text).split():
+        grams.append(f"w:{word}")
+        padded = f" {word} "
+        for n in (3, 4):
+            grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+# TF-IDF over char n-grams, rows L2 normalised (dot product = cosine similarity)
+class NgramVectorizer:
+
+    def __init__(self, max_ngrams = BASELINE_MAX_NGRAMS):
+        self.max_ngrams = max_ngrams
+        self.vocabulary = {}
+        self.idf = None
+
+    def fit(self, texts):
+        counts = [Counter(_ngrams(text)) for text in texts]
+        df = Counter(gram for count in counts for gram in count)
+        kept = [gram for gram, _ in df.most_common(self.max_ngrams)]
+        self.vocabulary = {gram: i for i, gram in enumerate(kept)}
+        n = len(texts)
+        self.idf = np.array([math.log((1 + n) / (1 + df[gram])) + 1 for gram in kept], dtype=np.float32)
+        return self._matrix(counts)
+
+    def transform(self, texts):
+        return self._matrix([Counter(_ngrams(text)) for text in texts])
+
+    def _matrix(self, counts):
+        matrix = np.zeros((len(counts), len(self.vocabulary)), dtype=np.float32)
+        for row, count in enumerate(counts):
+            for gram, tf in count.items():
+                column = self.vocabulary.get(gram)
+                if column is not None:
+                    matrix[row, column] = 1 + math.log(tf)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+# Nearest-neighbour hours for a feature list, from every feature row in the
+# knowledge base. The table is rebuilt when the collection generation changes.
+class BaselineEstimator:
+
+    def __init__(self, vector_db, neighbours = BASELINE_NEIGHBOURS, min_similarity = BASELINE_MIN_SIMILARITY):
+        self.vector_db = vector_db
+        self.neighbours = neighbours
+        self.min_similarity = min_similarity
+        self.generation = None
+        self.rows = []
+        self.hours = np.zeros((0, 3), dtype=np.float32)
+        self.matrix = None
+        self.vectorizer = None
+        self.lock = asyncio.Lock()
+
+    def _build(self):
+        res = self.vector_db.collection.get(include=["documents", "metadatas"])
+        rows = []
+        seen = set()
+        for document, metadata in zip(res["documents"], res["metadatas"]):
+            for row in parse_feature_rows(document, (metadata or {}).get("title")):
+                # The same row repeated (several sheets / files) would outweigh the others
+                key = (_normalize(row["name"]), row["optimistic"], row["most_likely"], row["pessimistic"])
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(row)
+
+        vectorizer = NgramVectorizer()
+        matrix = vectorizer.fit([row["name"] for row in rows]) if rows else None
+        hours = np.array([[row["optimistic"], row["most_likely"], row["pessimistic"]] for row in rows],
+                         dtype=np.float32).reshape(-1, 3)
+        return rows, hours, vectorizer, matrix
+
+    async def _refresh(self):
+        generation = await retrieval_cache.generation(self.vector_db.collection.name)
+        if generation == self.generation:
+            return
+        async with self.lock:
+            if generation == self.generation:
+                return
+            started = time.perf_counter()
+            self.rows, self.hours, self.vectorizer, self.matrix = await asyncio.to_thread(self._build)
+            self.generation = generation
+            print(f"Baseline table built: {len(self.rows)} feature rows in {time.perf_counter() - started:.2f}s")
+
+    # Similarity weighted hours of the closest historical rows, per feature
+    def _estimate(self, features):
+        if self.matrix is None or not len(self.rows):
+            raise ValueError("No historical feature rows to build a baseline from")
+
+        queries = self.vectorizer.transform(features)
+        similarities = queries @ self.matrix.T                          # (features, rows)
+        k = min(self.neighbours, similarities.shape[1])
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+
+        # Features with no close match fall back to the median historical row
+        weights = np.where(top_similarities >= self.min_similarity, top_similarities, 0)
+        matched = weights.sum(axis=1) > 0
+        estimates = np.einsum("fk,fkc->fc", weights, self.hours[top]) / np.where(matched, weights.sum(axis=1), 1)[:, None]
+        estimates[~matched] = np.median(self.hours, axis=0)
+
+        result = []
+        matches = []
+        for i, feature in enumerate(features):
+            optimistic, most_likely, pessimistic = sorted(int(round(value)) for value in estimates[i])
+            types = Counter()
+            for j, weight in zip(top[i], weights[i]):
+                types[self.rows[j]["type"]] += weight
+            feature_type = types.most_common(1)[0][0] if matched[i] else _guess_type(feature, "Backend")
+            result.append(Feature(name=feature, type=feature_type, optimistic=optimistic,
+                                  most_likely=most_likely, pessimistic=pessimistic))
+            matches.append({
+                "feature": feature,
+                "matched": bool(matched[i]),
+                "neighbours": [
+                    {"name": self.rows[j]["name"], "source": self.rows[j]["source"], "similarity": round(float(s), 3)}
+                    for j, s in zip(top[i], top_similarities[i])
+                ],
+            })
+        return EstimationResponse(features=result), matches
+
+    async def estimate(self, features):
+        try:
+            started = time.perf_counter()
+            await self._refresh()
+            features = [str(feature) for feature in features or [] if str(feature).strip()]
+            if not features:
+                return {"status": -1, "message": "No features to estimate"}
+            response, matches = self._estimate(features)
+            return {
+                "status": 0,
+                "message": "Baseline estimate generated",
+                "data": {
+                    "response": response.model_dump(mode="json"),
+                    "matches": matches,
+                    "rows": len(self.rows),
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+                },
+            }
+        except Exception as e:
+            return {"status": -1, "message": str(e)}
+
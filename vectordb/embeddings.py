@@ -0,0 +1,202 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils.embedding_functions import register_embedding_function
+
+# Embedding settings
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "default")        # "default" (Chroma's MiniLM) or "local"
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3")
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "384"))
+
+
+# Chroma's built-in all-MiniLM-L6-v2 (ONNX, downloaded on first use)
+class MiniLMEmbedder:
+
+    def __init__(self):
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+        self.model_id = "onnx-all-MiniLM-L6-v2"
+        self.function = DefaultEmbeddingFunction()
+
+    def embed(self, texts):
+        return [np.asarray(vector, dtype=np.float32) for vector in self.function(texts)]
+
+
+# Fully local and deterministic: signed feature hashing of words and character
+# trigrams, log-scaled and L2 normalised. No model files, no network.
+class HashingEmbedder:
+
+    def __init__(self, dim = LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.model_id = f"local-hashing-v1-{dim}"
+
+    def _features(self, text):
+        text = text.lower()
+        words = re.findall(r"[a-z0-9]+", text)
+        features = [f"w:{word}" for word in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f" {word} "
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def _embed_one(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0] = 1.0
+            return vector
+        return vector / norm
+
+    def embed(self, texts):
+        return [self._embed_one(text) for text in texts]
+
+
+EMBEDDERS = {
+    "default": MiniLMEmbedder,
+    "local": HashingEmbedder,
+}
+
+
+# Embeddings on disk keyed by (model version, content hash), shared by all workers
+class EmbeddingCache:
+
+    def __init__(self, path = EMBEDDING_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self.db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB, created_at REAL)"
+            )
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def key(model_id, text):
+        return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            db = self._connect()
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, model_id, items):
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, model_id, len(vector), np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items],
+            )
+            db.commit()
+
+    def stats(self):
+        with self.lock:
+            rows = self._connect().execute("SELECT model, COUNT(*) FROM embeddings GROUP BY model").fetchall()
+            return {"hits": self.hits, "misses": self.misses, "entries": dict(rows)}
+
+
+embedding_cache = EmbeddingCache()
+
+
+# Chroma embedding function: looks every text up in the cache first and embeds
+# only the misses, in batches, with the configured embedder
+@register_embedding_function
+class CachedEmbeddingFunction(EmbeddingFunction):
+
+    def __init__(self, model = EMBEDDING_MODEL, cache_enabled = EMBEDDING_CACHE_ENABLED,
+                 batch_size = EMBEDDING_BATCH_SIZE, cache = None):
+        if model not in EMBEDDERS:
+            raise ValueError(f"Unknown embedding model '{model}', expected one of {list(EMBEDDERS)}")
+        self.model = model
+        self.embedder = EMBEDDERS[model]()
+        self.cache_enabled = cache_enabled
+        self.batch_size = batch_size
+        self.cache = cache or embedding_cache
+
+    @property
+    def model_id(self):
+        return self.embedder.model_id
+
+    def __call__(self, input):
+        texts = list(input)
+        keys = [self.cache.key(self.model_id, text) for text in texts]
+        found = self.cache.get_many(keys) if self.cache_enabled else {}
+
+        # Embed each distinct missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            vectors = self.embedder.embed([text for _, text in batch])
+            computed = [(key, vector) for (key, _), vector in zip(batch, vectors)]
+            found.update(computed)
+            if self.cache_enabled:
+                self.cache.set_many(self.model_id, computed)
+
+        return [found[key] for key in keys]
+
+    # Store known embeddings (e.g. read back from an older collection)
+    def seed(self, texts, vectors):
+        if self.cache_enabled:
+            self.cache.set_many(self.model_id, [(self.cache.key(self.model_id, text), vector)
+                                                for text, vector in zip(texts, vectors)])
+
+    @staticmethod
+    def name():
+        return "cached_estimator"
+
+    def default_space(self):
+        return "l2"
+
+    def supported_spaces(self):
+        return ["l2", "cosine", "ip"]
+
+    def get_config(self):
+        return {"model": self.model, "batch_size": self.batch_size}
+
+    @staticmethod
+    def build_from_config(config):
+        return CachedEmbeddingFunction(model=config.get("model", EMBEDDING_MODEL),
+                                       batch_size=config.get("batch_size", EMBEDDING_BATCH_SIZE))
+
+    def validate_config(self, config):
+        return None
+
+    def validate_config_update(self, old_config, new_config):
+        if old_config.get("model") != new_config.get("model"):
+            raise ValueError("The embedding model of a collection cannot be changed")
@@ -1,59 +1,224 @@
 import chromadb
 import uuid
+import asyncio
+import os
+import re
+from vectordb.embeddings import CachedEmbeddingFunction, EMBEDDING_MODEL
+from vectordb.retrieval_cache import retrieval_cache
+
+# Retrieval settings
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_MIN_SIMILARITY = float(os.getenv("RETRIEVAL_MIN_SIMILARITY")) if os.getenv("RETRIEVAL_MIN_SIMILARITY") else None
+
+# Collection created before embeddings were cached (Chroma default embedding function)
+LEGACY_COLLECTION = "previous_estiamtes"
 
 
 class EstimateVectorDB():
-    def __init__(self):
+    def __init__(self, embedding_model = EMBEDDING_MODEL):
         self.chroma_client = chromadb.PersistentClient(path = "chromadb")
-        self.collection = self.chroma_client.get_or_create_collection(name = "previous_estiamtes")
+        # One collection per embedding model, vectors of different models never mix
+        self.embedding_function = CachedEmbeddingFunction(model = embedding_model)
+        self.collection = self.chroma_client.get_or_create_collection(
+            name = f"{LEGACY_COLLECTION}_{embedding_model}",
+            embedding_function = self.embedding_function,
+        )
+        self._migrate_legacy()
+
+    # Copy the estimates of the legacy collection into an empty new one. With the same
+    # model the stored vectors are reused (and seed the cache), otherwise the documents
+    # are embedded again. Upserts by id, so workers starting together do not duplicate rows.
+    def _migrate_legacy(self, page_size = 100):
+        if self.collection.count():
+            return
+        try:
+            legacy = self.chroma_client.get_collection(name = LEGACY_COLLECTION)
+        except Exception:
+            return
+        same_model = self.embedding_function.model == "default"
+        offset = 0
+        while True:
+            include = ["documents", "metadatas"] + (["embeddings"] if same_model else [])
+            res = legacy.get(limit = page_size, offset = offset or None, include = include)
+            if not res["ids"]:
+                break
+            if same_model:
+                self.embedding_function.seed(res["documents"], res["embeddings"])
+                self.collection.upsert(ids = res["ids"], documents = res["documents"],
+                                       metadatas = res["metadatas"], embeddings = res["embeddings"])
+            else:
+                self.collection.upsert(ids = res["ids"], documents = res["documents"], metadatas = res["metadatas"])
+            offset += len(res["ids"])
+        if offset:
+            retrieval_cache.bump(self.collection.name)
+            print(f"Copied {offset} estimates from {LEGACY_COLLECTION} into {self.collection.name}")
 
     async def add_estimate(self, document_markdown, json_metadata):
         try:
-            self.collection.add(
-                                ids=[f"{uuid.uuid4()}"],
-                                documents=[document_markdown],
-                                metadatas=[json_metadata]
-                                )
+            await asyncio.to_thread(self.collection.add,
+                                    ids=[f"{uuid.uuid4()}"],
+                                    documents=[document_markdown],
+                                    metadatas=[json_metadata]
+                                    )
+            await retrieval_cache.invalidate(self.collection.name)
             return{"status": 0, "message": "Estimate added successfully"}
         except Exception as e:
             return{"status": -1, "message": str(e)}
         
     
-    async def get_list_of_estimates(self, limit = None):
+    # Many estimates in one write
+    async def add_estimates(self, documents, metadatas):
         try:
-            self.collection.get(limit = limit)
+            ids = [f"{uuid.uuid4()}" for _ in documents]
+            await asyncio.to_thread(self.collection.add, ids=ids, documents=documents, metadatas=metadatas)
+            await retrieval_cache.invalidate(self.collection.name)
+            return{"status": 0, "message": "Estimates added successfully", "data": {"ids": ids}}
+        except Exception as e:
+            return{"status": -1, "message": str(e)}
+
+    # Hashes (of the source files) that are already stored, out of `hashes`
+    async def existing_hashes(self, hashes):
+        if not hashes:
+            return set()
+        res = await asyncio.to_thread(self.collection.get, where={"content_sha256": {"$in": list(hashes)}}, include=["metadatas"])
+        return {metadata.get("content_sha256") for metadata in res["metadatas"]}
+
+    # One page of the collection. `include` picks the fields to load, e.g. ["metadatas"]
+    # to skip the document bodies. The total count costs another round trip, so it is
+    # only read for the first page unless `with_total` says otherwise (else None).
+    async def get_list_of_estimates(self, limit = None, offset = 0, include = ("documents", "metadatas"), with_total = None):
+        try:
+            if limit is not None and limit < 1:
+                return{"status": -1, "message": "limit must be at least 1"}
+            if offset is not None and offset < 0:
+                return{"status": -1, "message": "offset must not be negative"}
+            include = [field for field in include if field in ("documents", "metadatas")]
+            offset = offset or 0
+            with_total = not offset if with_total is None else with_total
+            # One extra row tells whether there is a next page
+            res = await asyncio.to_thread(self.collection.get, limit = limit + 1 if limit is not None else None,
+                                          offset = offset or None, include = include)
+            has_more = limit is not None and len(res["ids"]) > limit
+            ids = res["ids"][:limit] if limit is not None else res["ids"]
+            total = await asyncio.to_thread(self.collection.count) if with_total else None
+
             playload = {
                 "status": 0,
                 "message": "All list fetched sucessfully",
                 "data": 
                 {
-                    "ids" : self.collection.get()["ids"],
-                    "documents" : self.collection.get()["documents"],
-                    "metadatas" : self.collection.get()["metadatas"]
+                    "ids" : ids,
+                    "documents" : res["documents"][:len(ids)] if "documents" in include else None,
+                    "metadatas" : res["metadatas"][:len(ids)] if "metadatas" in include else None,
+                    "total" : total,
+                    "offset" : offset,
+                    "next_offset" : offset + len(ids) if has_more else None
                 }
             }
             return playload
         except Exception as e:
             return{"status": -1, "message": str(e)}
-        
 
-    async def query_estimates(self, query, search_string = ""):
+    # A single estimate with its document
+    async def get_estimate(self, id):
         try:
-            self.collection.query(
-                query_texts = [query],
-                where_document={"$contains":search_string},
-                n_results = 1
-            )
+            res = await asyncio.to_thread(self.collection.get, ids = [id], include = ["documents", "metadatas"])
+            if not res["ids"]:
+                return{"status": -1, "message": f"Estimate {id} not found"}
+            return {
+                "status": 0,
+                "message": "Estimate fetched sucessfully",
+                "data": {"id": id, "document": res["documents"][0], "metadata": res["metadatas"][0]}
+            }
+        except Exception as e:
+            return{"status": -1, "message": str(e)}
+
+    # Every estimate, page by page (for exports)
+    async def iter_estimates(self, page_size = 50, include = ("documents", "metadatas")):
+        offset = 0
+        while True:
+            res = await asyncio.to_thread(self.collection.get, limit = page_size, offset = offset or None, include = list(include))
+            for i, id in enumerate(res["ids"]):
+                yield {
+                    "id": id,
+                    "document": res["documents"][i] if res.get("documents") is not None else None,
+                    "metadata": res["metadatas"][i] if res.get("metadatas") is not None else None,
+                }
+            if len(res["ids"]) < page_size:
+                break
+            offset += page_size
+
+    # Distance of the collection's metric -> similarity in [0, 1] (embeddings are normalised)
+    def _similarity(self, distance):
+        space = (self.collection.configuration_json or {}).get("hnsw", {}).get("space", "l2")
+        if space in ("cosine", "ip"):
+            return 1 - distance     # Chroma's ip distance is 1 - dot product
+        return 1 - distance / 2     # squared L2 between unit vectors
+
+    # Document filter for a "Python, React / Node.js" style technologies string
+    def _technologies_filter(self, search_string, match):
+        terms = [term.strip() for term in re.split(r",|/|;|\band\b", search_string or "") if term.strip()]
+        if match == "none" or not terms:
+            return None
+        if len(terms) == 1:
+            return {"$contains": terms[0]}
+        return {"$or" if match == "any" else "$and": [{"$contains": term} for term in terms]}
+
+    def _query(self, query, k, where, where_document):
+        return self.collection.query(
+            query_texts = [query],
+            n_results = k,
+            where = where or None,
+            where_document = where_document,
+            include = ["documents", "metadatas", "distances"],
+        )
+
+    # Top-k most similar estimates from a single vector query.
+    # match: "any" / "all" of the technologies must appear in the document, or "none" to ignore them;
+    # with fallback=True an empty filtered result is retried without the technologies filter.
+    # Results are cached until the next write to the collection (use_cache=False skips the cache).
+    async def query_estimates(self, query, search_string = "", k = RETRIEVAL_TOP_K, min_similarity = RETRIEVAL_MIN_SIMILARITY,
+                              where = None, match = "any", fallback = True, use_cache = True):
+        try:
+            collection_name = self.collection.name
+            cache_key = retrieval_cache.make_key(collection_name, query, search_string, k, min_similarity, where, match, fallback)
+            if use_cache:
+                cached = await retrieval_cache.get(collection_name, cache_key)
+                if cached is not None:
+                    return {"status": 0, "message": "Query fetched sucessfully", "data": cached}
+            # Read before the search, so a write landing meanwhile invalidates this result
+            generation = await retrieval_cache.generation(collection_name)
+
+            count = await asyncio.to_thread(self.collection.count)
+            ids, documents, metadatas, distances = [], [], [], []
+            if count and query:
+                k = max(1, min(k, count))
+                where_document = self._technologies_filter(search_string, match)
+                res = await asyncio.to_thread(self._query, query, k, where, where_document)
+                if not res["ids"][0] and where_document is not None and fallback:
+                    res = await asyncio.to_thread(self._query, query, k, where, None)
+
+                for id, document, metadata, distance in zip(res["ids"][0], res["documents"][0], res["metadatas"][0], res["distances"][0]):
+                    if min_similarity is not None and self._similarity(distance) < min_similarity:
+                        continue
+                    ids.append(id)
+                    documents.append(document)
+                    metadatas.append(metadata)
+                    distances.append(distance)
+
             playload = {
                 "status": 0,
                 "message": "Query fetched sucessfully",
                 "data": 
                 {
-                    "ids" : self.collection.get()["ids"],
-                    "documents" : self.collection.get()["documents"],
-                    "metadatas" : self.collection.get()["metadatas"]
+                    "ids" : ids,
+                    "documents" : documents,
+                    "metadatas" : metadatas,
+                    "distances" : distances,
+                    "similarities" : [self._similarity(distance) for distance in distances]
                 }
             }
+            await retrieval_cache.set(collection_name, cache_key, generation, playload["data"])
             return playload
         except Exception as e:
             return{"status": -1, "message": str(e)}
@@ -62,7 +227,8 @@ class EstimateVectorDB():
 
     async def delete_estimate(self, id):
         try:
-            self.collection.delete(ids = [id])
+            await asyncio.to_thread(self.collection.delete, ids = [id])
+            await retrieval_cache.invalidate(self.collection.name)
             return{"status": 0, "message": "Estimate deleted successfully"}
         except Exception as e:
             return{"status": -1, "message": str(e)}
\ No newline at end of file
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# Bulk ingestion settings
+INGEST_JOBS_DIR = os.getenv("INGEST_JOBS_DIR", "cache/ingest_jobs")
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "16"))
+INGEST_HEARTBEAT_INTERVAL = float(os.getenv("INGEST_HEARTBEAT_INTERVAL", "10"))
+INGEST_STALE_AFTER = float(os.getenv("INGEST_STALE_AFTER", "60"))     # no heartbeat for this long = worker lost
+
+
+# Background ingestion of many estimate files: markdown extraction and metadata
+# calls run on a bounded worker pool, rows are written to the vector DB in
+# batches. Job state lives on disk so progress can be polled from any worker
+# and a failed or interrupted job can be resumed. Which worker runs a job is
+# decided by an atomic claim in SQLite, so two workers never run the same job.
+class IngestionJobs:
+
+    def __init__(self, vector_db, ai_process, extract_markdown, jobs_dir = INGEST_JOBS_DIR,
+                 concurrency = INGEST_CONCURRENCY, batch_size = INGEST_BATCH_SIZE):
+        self.vector_db = vector_db
+        self.ai_process = ai_process
+        self.extract_markdown = extract_markdown
+        self.jobs_dir = jobs_dir
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks = {}     # job_id -> running asyncio task (this worker only)
+        self.db_lock = threading.Lock()
+        self._db = None
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.jobs_dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.jobs_dir, "jobs.sqlite3"), timeout=30,
+                                 check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ingest_jobs ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " worker TEXT,"
+                " heartbeat_at REAL)"
+            )
+            self._db = db
+        return self._db
+
+    # Take the job for this worker unless another live worker runs it (True if taken)
+    def _claim(self, job_id):
+        now = time.time()
+        with self.db_lock:
+            db = self._connect()
+            db.execute("INSERT OR IGNORE INTO ingest_jobs (id, status) VALUES (?, 'queued')", (job_id,))
+            return db.execute(
+                "UPDATE ingest_jobs SET status = 'running', worker = ?, heartbeat_at = ? "
+                "WHERE id = ? AND (status != 'running' OR heartbeat_at < ?)",
+                (self.worker, now, job_id, now - INGEST_STALE_AFTER),
+            ).rowcount == 1
+
+    def _heartbeat(self, job_id):
+        with self.db_lock:
+            self._connect().execute("UPDATE ingest_jobs SET heartbeat_at = ? WHERE id = ? AND worker = ?",
+                                    (time.time(), job_id, self.worker))
+
+    def _release(self, job_id, status):
+        with self.db_lock:
+            self._connect().execute("UPDATE ingest_jobs SET status = ?, worker = NULL WHERE id = ? AND worker = ?",
+                                    (status, job_id, self.worker))
+
+    def _load(self, job_id):
+        path = os.path.join(self._job_dir(job_id), "state.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self, state):
+        state["updated_at"] = time.time()
+        state["done"] = sum(1 for f in state["files"] if f["status"] in ("done", "skipped"))
+        state["failed"] = sum(1 for f in state["files"] if f["status"] == "failed")
+        path = os.path.join(self._job_dir(state["job_id"]), "state.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    # Keep the spooled uploads in the job folder and start processing them
+    def create_job(self, uploads, title = None):
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+
+        files = []
+        for i, upload in enumerate(uploads):
+            path = os.path.join(job_dir, f"{i}{os.path.splitext(upload.name or '')[1]}")
+            upload.owned = False    # the job folder owns the file from here on
+            upload.close()
+            shutil.move(upload.path, path)
+            files.append({
+                "name": upload.name,
+                "path": path,
+                "sha256": upload.sha256,
+                "status": "pending",
+                "error": None,
+                "id": None,
+            })
+
+        state = {
+            "job_id": job_id,
+            "status": "queued",
+            "title": title,
+            "total": len(files),
+            "created_at": time.time(),
+            "files": files,
+        }
+        self._save(state)
+        self._claim(job_id)
+        self.start(job_id)
+        return job_id
+
+    def start(self, job_id):
+        if job_id in self.tasks and not self.tasks[job_id].done():
+            return
+        task = asyncio.create_task(self.run(job_id))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+
+    # Job state for polling
+    def get(self, job_id):
+        state = self._load(job_id)
+        if state is not None:
+            state = {**state, "files": [{k: v for k, v in f.items() if k != "path"} for f in state["files"]]}
+        return state
+
+    # Run the files that are not done yet again (failed ones included). A job
+    # another worker is running is left alone ("resumed" is False then).
+    def resume(self, job_id):
+        state = self._load(job_id)
+        if state is None:
+            return None
+        if job_id in self.tasks or not self._claim(job_id):
+            return {**state, "resumed": False}
+        for f in state["files"]:
+            if f["status"] == "failed":
+                f["status"] = "pending"
+                f["error"] = None
+        state["status"] = "queued"
+        self._save(state)
+        self.start(job_id)
+        return {**state, "resumed": True}
+
+    async def run(self, job_id):
+        state = self._load(job_id)
+        state["status"] = "running"
+        self._save(state)
+
+        pending = [f for f in state["files"] if f["status"] not in ("done", "skipped")]
+
+        # Files already in the knowledge base (e.g. written before a crash) are skipped
+        try:
+            stored = await self.vector_db.existing_hashes([f["sha256"] for f in pending])
+        except Exception as e:
+            print(f"Could not check existing estimates: {e}")
+            stored = set()
+        for f in pending:
+            if f["sha256"] in stored:
+                f["status"] = "skipped"
+        pending = [f for f in pending if f["status"] == "pending"]
+        self._save(state)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batch = []
+        batch_lock = asyncio.Lock()
+
+        async def prepare(file_state):
+            async with semaphore:
+                try:
+                    markdown = await self.extract_markdown(file_state["path"], sha256=file_state["sha256"])
+                    metadata_res = await self.ai_process.extract_metadata(markdown)
+                    metadata = metadata_res.get("response") or {}
+                    metadata["title"] = state["title"] or file_state["name"]
+                    metadata["content_sha256"] = file_state["sha256"]
+                except Exception as e:
+                    file_state["status"] = "failed"
+                    file_state["error"] = str(e)
+                    self._save(state)
+                    return
+            async with batch_lock:
+                batch.append((file_state, markdown, metadata))
+                if len(batch) >= self.batch_size:
+                    await flush()
+
+        # Write the collected rows in one DB call
+        async def flush():
+            if not batch:
+                return
+            rows = batch[:]
+            batch.clear()
+            db_res = await self.vector_db.add_estimates([row[1] for row in rows], [row[2] for row in rows])
+            for i, (file_state, _, _) in enumerate(rows):
+                if db_res.get("status") == 0:
+                    file_state["status"] = "done"
+                    file_state["id"] = db_res["data"]["ids"][i]
+                    if os.path.exists(file_state["path"]):
+                        os.remove(file_state["path"])
+                else:
+                    file_state["status"] = "failed"
+                    file_state["error"] = db_res.get("message")
+            self._save(state)
+
+        # Keep the claim alive while the job runs
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(INGEST_HEARTBEAT_INTERVAL)
+                await asyncio.to_thread(self._heartbeat, job_id)
+
+        beat = asyncio.create_task(heartbeat())
+        try:
+            await asyncio.gather(*(prepare(f) for f in pending))
+            async with batch_lock:
+                await flush()
+        except BaseException as e:
+            state["status"] = "interrupted"
+            state["error"] = str(e) or e.__class__.__name__
+            self._save(state)
+            self._release(job_id, state["status"])
+            raise
+        finally:
+            beat.cancel()
+
+        state["status"] = "completed_with_errors" if any(f["status"] == "failed" for f in state["files"]) else "completed"
+        self._save(state)
+        self._release(job_id, state["status"])
+        print(f"Ingestion job {job_id} {state['status']}...")
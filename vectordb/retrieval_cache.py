@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cache settings
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "1") == "1"
+RETRIEVAL_CACHE_PATH = os.getenv("RETRIEVAL_CACHE_PATH", "cache/retrieval_cache.sqlite3")
+RETRIEVAL_CACHE_MEMORY_ITEMS = int(os.getenv("RETRIEVAL_CACHE_MEMORY_ITEMS", "512"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", str(24 * 3600)))   # seconds
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+
+# Vector query results keyed by the normalised query, filters and k. Each entry
+# remembers the collection generation it was computed at; any write to the
+# collection bumps the generation (in SQLite, so every worker sees it) and
+# older entries stop matching.
+class RetrievalCache:
+
+    def __init__(self, path = RETRIEVAL_CACHE_PATH, memory_items = RETRIEVAL_CACHE_MEMORY_ITEMS,
+                 ttl = RETRIEVAL_CACHE_TTL, enabled = RETRIEVAL_CACHE_ENABLED):
+        self.path = path
+        self.memory_items = memory_items
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self.memory = OrderedDict()     # key -> (generation, expires_at, json payload)
+        self.lock = threading.Lock()      # memory tier + counters
+        self.db_lock = threading.Lock()   # sqlite connection
+        self.counters = {"hits": 0, "misses": 0, "writes": 0, "invalidations": 0}
+        self._db = None
+
+    def make_key(self, collection, query, search_string, k, min_similarity, where, match, fallback):
+        # Case is kept: the technologies filter ($contains) is case sensitive
+        terms = sorted({term.strip() for term in re.split(r",|/|;|\band\b", search_string or "") if term.strip()})
+        parts = {
+            "collection": collection,
+            "query": _normalize(query),
+            "terms": terms,
+            "k": k,
+            "min_similarity": min_similarity,
+            "where": where,
+            "match": match,
+            "fallback": fallback,
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def get(self, collection, key):
+        if not self.enabled:
+            return None
+        generation, entry = await asyncio.to_thread(self._lookup, collection, key)
+        with self.lock:
+            if entry is None or entry[0] != generation or entry[1] <= time.time():
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            self._remember(key, *entry)
+        return json.loads(entry[2])
+
+    async def set(self, collection, key, generation, value):
+        if not self.enabled:
+            return
+        payload = json.dumps(value)
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self.counters["writes"] += 1
+            self._remember(key, generation, expires_at, payload)
+        await asyncio.to_thread(self._disk_set, collection, key, generation, expires_at, payload)
+
+    # Current generation of a collection (read before querying, stored with the result)
+    async def generation(self, collection):
+        return await asyncio.to_thread(self._generation, collection)
+
+    # Called after every write to the collection
+    async def invalidate(self, collection):
+        await asyncio.to_thread(self.bump, collection)
+
+    def bump(self, collection):
+        with self.db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT INTO generations (collection, value) VALUES (?, 1) "
+                "ON CONFLICT(collection) DO UPDATE SET value = value + 1",
+                (collection,),
+            )
+            db.execute("DELETE FROM retrieval_cache WHERE collection = ?", (collection,))
+            db.commit()
+        with self.lock:
+            self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            memory_entries = len(self.memory)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_ratio": (counters["hits"] / lookups) if lookups else 0.0,
+            "memory_entries": memory_entries,
+            "enabled": self.enabled,
+        }
+
+    def _remember(self, key, generation, expires_at, payload):
+        self.memory[key] = (generation, expires_at, payload)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _connect(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS generations (collection TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS retrieval_cache ("
+                " key TEXT PRIMARY KEY,"
+                " collection TEXT NOT NULL,"
+                " generation INTEGER NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _generation(self, collection):
+        with self.db_lock:
+            row = self._connect().execute("SELECT value FROM generations WHERE collection = ?", (collection,)).fetchone()
+        return row[0] if row else 0
+
+    # (current generation, entry) with the entry from memory first, then disk
+    def _lookup(self, collection, key):
+        generation = self._generation(collection)
+        with self.lock:
+            entry = self.memory.get(key)
+        if entry is not None and entry[0] == generation:
+            return generation, entry
+        with self.db_lock:
+            row = self._connect().execute(
+                "SELECT generation, expires_at, value FROM retrieval_cache WHERE key = ?", (key,)
+            ).fetchone()
+        return generation, row
+
+    def _disk_set(self, collection, key, generation, expires_at, payload):
+        with self.db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO retrieval_cache (key, collection, generation, value, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (key, collection, generation, payload, expires_at),
+            )
+            db.execute("DELETE FROM retrieval_cache WHERE expires_at <= ?", (time.time(),))
+            db.commit()
+
+
+# Shared instance used by EstimateVectorDB
+retrieval_cache = RetrievalCache()